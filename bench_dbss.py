@@ -0,0 +1,334 @@
+"""bench_dbss -- Benchmark dbss commands against the simulated server
+
+Runs each dbss command against dbss_simulator with injected network
+latency and white lists of varying size, recording per command the
+connections opened (logins), round trips (batches sent), statements,
+rows transferred and wall time. Results are written as JSON; given a
+baseline report, any increase in logins, round trips or rows (or wall
+time beyond tolerance) is reported and the run fails.
+
+'startup' runs dbss.py in fresh interpreters instead, timing each command
+from process start to exit (median of --repeat runs) and counting the
+modules it imports with their import time (python -X importtime).
+
+Usage:
+   bench_dbss.py [--sizes=<list>] [--latency=<s>] [--login-latency=<s>]
+                 [--page-cost=<s>] [--commands=<list>] [--output=<file>]
+                 [--baseline=<file>] [--tolerance=<ratio>]
+   bench_dbss.py startup [--repeat=<n>] [--output=<file>]
+   bench_dbss.py (-h | --help)
+
+Options:
+   -h --help               Show help screen
+   --sizes=<list>          White list sizes [default: 1,10,100,500]
+   --latency=<s>           Seconds of latency per round trip [default: 0.001]
+   --login-latency=<s>     Seconds of latency per login [default: 0.01]
+   --page-cost=<s>         Seconds per 1000 pages created/restored [default: 0]
+   --commands=<list>       Scenarios to run (default: all)
+   --output=<file>         Report file [default: bench_output.json]
+   --baseline=<file>       Earlier report to check for regressions
+   --tolerance=<ratio>     Allowed wall time growth over baseline [default: 1.5]
+   --repeat=<n>            Startup runs per command [default: 10]
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import docopt
+
+import dbss
+import dbss_simulator
+
+# benchmark scenarios -- name, dbss arguments, setup commands, and
+# ... client connections per database ('{db}' is first white list entry,
+# ... setup 'write {db}' has a simulated client change the database)
+SCENARIOS = (
+    ('list', 'list', (), 0),
+    ('test', 'test {db}', (), 0),
+    ('survey', 'survey', (), 0),
+    ('check_baseline', 'check_baseline', ('generate_baseline',), 0),
+    ('stats', 'stats', ('generate_baseline', 'write {db}'), 0),
+    ('create', 'create {db}', (), 0),
+    ('restore', 'restore {db}', ('generate_baseline',), 0),
+    ('destroy', 'destroy {db}', ('generate_baseline',), 0),
+    ('kill_connections', 'kill_connections', (), 1),
+    ('generate_baseline', 'generate_baseline', (), 0),
+    ('generate_baseline_jobs', 'generate_baseline --jobs=8', (), 0),
+    ('generate_baseline_current', 'generate_baseline',
+     ('generate_baseline', 'write {db}'), 0),
+    ('generate_baseline_recreate', 'generate_baseline --force-recreate',
+     ('generate_baseline',), 0),
+    ('revert_environment', 'revert_environment', ('generate_baseline',), 0),
+    ('revert_environment_changed', 'revert_environment',
+     ('generate_baseline', 'write {db}'), 0),
+    ('revert_environment_force', 'revert_environment --force',
+     ('generate_baseline',), 0),
+    ('revert_environment_jobs', 'revert_environment --jobs=8 --force',
+     ('generate_baseline',), 0),
+    ('revert_environment_batch', 'revert_environment --batch --force',
+     ('generate_baseline',), 0),
+    ('revert_environment_prewarm', 'revert_environment --force --prewarm',
+     ('generate_baseline',), 0),
+    ('clean_slate', 'clean_slate', ('generate_baseline',), 0),
+    ('clean_slate_jobs', 'clean_slate --jobs=8', ('generate_baseline',), 0),
+    ('clean_slate_batch', 'clean_slate --batch', ('generate_baseline',), 0),
+    ('generate_baseline_server_side', 'generate_baseline --server-side',
+     ('install',), 0),
+    ('revert_environment_server_side',
+     'revert_environment --server-side --force',
+     ('install', 'generate_baseline'), 0),
+    ('clean_slate_server_side', 'clean_slate --server-side',
+     ('install', 'generate_baseline'), 0),
+)
+
+# counters that must not grow between runs (deterministic)
+COUNTERS = ('logins', 'batches', 'statements', 'rows')
+
+# startup scenarios -- name and dbss arguments ('interpreter' runs no
+# ... dbss at all, the floor every command pays)
+STARTUP_COMMANDS = (
+    ('interpreter', None),
+    ('version', '--version'),
+    ('help', '--help'),
+    ('list', 'list'),
+    ('test', 'test CXSCORE'),
+    ('survey', 'survey --environment=sim'),
+)
+
+
+def bench_environment(size,clients,settings):
+    """Configure simulated environment with white list of given size."""
+    env = dbss.configure_environment('sim', True)
+    db_list = list()
+    for i in range(size):
+        db_list.append('BENCH{:04d}'.format(i + 1))
+    env['db_server'] = 'bench_{}'.format(size)
+    env['db_white_list'] = tuple(db_list)
+    env['sim_latency'] = settings['latency']
+    env['sim_login_latency'] = settings['login_latency']
+    env['sim_page_cost'] = settings['page_cost']
+    env['sim_clients'] = clients
+    # change marks kept apart from the user's own
+    env['state_dir'] = settings['state_dir']
+    return env
+
+
+def run_dbss(arguments,env):
+    """Run dbss command line (narration discarded), return exit code."""
+    argv = arguments.split() + ['--environment=sim']
+    stdout = sys.stdout
+    exit_code = 0
+    try:
+        # env is quiet, yet listings still print, keep report readable
+        sys.stdout = open(os.devnull, 'w')
+        dbss.main(argv, env)
+    except SystemExit as e:
+        exit_code = e.code or 0
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        dbss.close_session(env)
+    return exit_code
+
+
+def run_scenario(scenario,size,settings):
+    """Measure one scenario on a freshly seeded server."""
+    name, arguments, setup_list, clients = scenario
+    dbss_simulator.reset_servers()
+    env = bench_environment(size,clients,settings)
+    first_db = env['db_white_list'][0]
+    for setup in setup_list:
+        setup_env = bench_environment(size,clients,settings)
+        if setup.startswith('write '):
+            dbss_simulator.write_database(setup_env,
+                                          setup.split()[1].format(db=first_db))
+            continue
+        setup_result = run_dbss(setup, setup_env)
+        if setup_result != 0:
+            raise RuntimeError("setup '{0}' for {1} failed ({2})"
+                               .format(setup, name, setup_result))
+    before = dbss_simulator.server_stats(env)
+    started = time.time()
+    exit_code = run_dbss(arguments.format(db=first_db), env)
+    wall_time = time.time() - started
+    after = dbss_simulator.server_stats(env)
+    result = dict()
+    result['command'] = name
+    result['databases'] = size
+    result['exit_code'] = exit_code
+    result['wall_time'] = round(wall_time, 4)
+    for counter in COUNTERS:
+        result[counter] = after[counter] - before[counter]
+    return result
+
+
+def compare_reports(report,baseline,tolerance):
+    """List regressions of report against baseline."""
+    regressions = list()
+    baseline_results = dict()
+    for result in baseline['results']:
+        baseline_results[(result['command'], result['databases'])] = result
+    for result in report['results']:
+        key = (result['command'], result['databases'])
+        if key not in baseline_results:
+            continue
+        earlier = baseline_results[key]
+        label = '{0} ({1} databases)'.format(key[0], key[1])
+        if result['exit_code'] != earlier['exit_code']:
+            regressions.append('{0}: exit code {1}, was {2}'
+                               .format(label, result['exit_code'],
+                                       earlier['exit_code']))
+        for counter in COUNTERS:
+            if result[counter] > earlier[counter]:
+                regressions.append('{0}: {1} {2}, was {3}'
+                                   .format(label, counter, result[counter],
+                                           earlier[counter]))
+        # small absolute allowance keeps tiny timings from flapping
+        allowed = earlier['wall_time'] * tolerance + 0.05
+        if result['wall_time'] > allowed:
+            regressions.append('{0}: wall time {1}s, was {2}s'
+                               .format(label, result['wall_time'],
+                                       earlier['wall_time']))
+    return regressions
+
+
+def startup_command(arguments,import_time=False):
+    """Build interpreter command line for startup scenario."""
+    command = [sys.executable]
+    if import_time:
+        command += ['-X', 'importtime']
+    if arguments is None:
+        command += ['-c', 'pass']
+    else:
+        dbss_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'dbss.py')
+        command += [dbss_script] + arguments.split()
+    return command
+
+
+def import_cost(arguments):
+    """Count modules imported by command and total their import time."""
+    command = startup_command(arguments, True)
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=devnull,
+                                   stderr=subprocess.PIPE)
+        errors = process.communicate()[1].decode('utf-8')
+    modules = 0
+    microseconds = 0
+    for line in errors.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        # header line names the columns
+        if not fields[0].strip().isdigit():
+            continue
+        modules += 1
+        microseconds += int(fields[0])
+    return modules, microseconds / 1000000.0
+
+
+def run_startup(scenario,repeat):
+    """Time command in fresh interpreters, median of repeat runs."""
+    name, arguments = scenario
+    command = startup_command(arguments)
+    timings = list()
+    exit_code = 0
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            started = time.time()
+            exit_code = subprocess.call(command, stdout=devnull,
+                                        stderr=devnull)
+            timings.append(time.time() - started)
+    timings.sort()
+    modules, import_time = import_cost(arguments)
+    result = dict()
+    result['command'] = name
+    result['exit_code'] = exit_code
+    result['wall_time'] = round(timings[len(timings) // 2], 4)
+    result['modules'] = modules
+    result['import_time'] = round(import_time, 4)
+    return result
+
+
+def startup_main(config):
+    """Run startup benchmark, write report."""
+    repeat = max(1, int(config['--repeat']))
+    report = dict()
+    report['dbss_version'] = dbss.VERSION
+    report['python'] = sys.version.split()[0]
+    report['startup'] = list()
+    print('{0:<14} {1:>5} {2:>8} {3:>10} {4:>9}'
+          .format('command', 'exit', 'modules', 'import s', 'seconds'))
+    for scenario in STARTUP_COMMANDS:
+        result = run_startup(scenario,repeat)
+        report['startup'].append(result)
+        print('{0:<14} {1:>5} {2:>8} {3:>10.4f} {4:>9.4f}'
+              .format(result['command'], result['exit_code'],
+                      result['modules'], result['import_time'],
+                      result['wall_time']))
+    with open(config['--output'], 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    print('Report written to {}'.format(config['--output']))
+
+
+def main(argv=None):
+    config = docopt.docopt(__doc__, argv=argv)
+    if config['startup']:
+        startup_main(config)
+        return
+    settings = dict()
+    settings['latency'] = float(config['--latency'])
+    settings['login_latency'] = float(config['--login-latency'])
+    settings['page_cost'] = float(config['--page-cost'])
+    settings['state_dir'] = tempfile.mkdtemp(prefix='bench_dbss_')
+    sizes = list()
+    for size in config['--sizes'].split(','):
+        sizes.append(int(size))
+    scenarios = SCENARIOS
+    if config['--commands']:
+        names = config['--commands'].split(',')
+        scenarios = list()
+        for scenario in SCENARIOS:
+            if scenario[0] in names:
+                scenarios.append(scenario)
+    report = dict()
+    report['dbss_version'] = dbss.VERSION
+    report['settings'] = settings
+    report['results'] = list()
+    print('{0:<32} {1:>5} {2:>7} {3:>7} {4:>7} {5:>7} {6:>9}'
+          .format('command', 'dbs', 'logins', 'trips', 'stmts', 'rows',
+                  'seconds'))
+    try:
+        for size in sizes:
+            for scenario in scenarios:
+                result = run_scenario(scenario,size,settings)
+                report['results'].append(result)
+                print('{0:<32} {1:>5} {2:>7} {3:>7} {4:>7} {5:>7} {6:>9.3f}'
+                      .format(result['command'], size, result['logins'],
+                              result['batches'], result['statements'],
+                              result['rows'], result['wall_time']))
+    finally:
+        shutil.rmtree(settings['state_dir'])
+    with open(config['--output'], 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    print('Report written to {}'.format(config['--output']))
+    if config['--baseline']:
+        with open(config['--baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_reports(report, baseline,
+                                      float(config['--tolerance']))
+        if regressions != []:
+            print('REGRESSIONS against {}:'.format(config['--baseline']))
+            for regression in regressions:
+                print('   ' + regression)
+            sys.exit(1)
+        print('No regressions against {}.'.format(config['--baseline']))
+
+
+if __name__ == "__main__":
+    main()
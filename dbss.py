@@ -11,29 +11,142 @@ of Microsoft SQL Server.
 Use dbss.py to create a database snapshot, restore a database to its snapshot
 or destroy a snapshot. 'test' will reveal the Transact-SQL statements used
 (any database accepted, whereas other commands check against white list).
+A snapshot's files follow its source's data files, which dbss keeps in
+~/.dbss with a checksum of the file layout, so data files are read again
+only when files move, in one sys.master_files query for every database that
+moved ('test' shows the kept statement when it has one).
 
 For environments: 'generate_baseline' captures databases. 'clean_slate' 
-removes snapshots. 'revert_environment' restores databases via snapshots.
+removes snapshots. 'revert_environment' restores databases via snapshots,
+skipping databases not written since their snapshot was taken (or their last
+restore), judged by write counts and snapshot sparse file sizes
+(sys.dm_io_virtual_file_stats) recorded in ~/.dbss. With --force, every
+database is restored. A failing database does not stop the run, failures
+are collected and summarized at its end. With --jobs, databases are handled
+concurrently (longest expected first). With --batch, restores or drops
+travel to the server as a single batch (--jobs ignored).
+
+'generate_baseline' keeps snapshots still current, their source unwritten
+since the snapshot was taken (by the same marks, or for unmarked databases
+the source's last user update in sys.dm_db_index_usage_stats, a source with
+no usage stats counting as written) and no older than snapshot_max_age hours
+when set. A baseline cut short thus resumes where
+it stopped. With --force-recreate, every snapshot is recreated.
+
+'install' puts stored procedure dbss_environment in each host's master
+database. With --server-side, generate_baseline, revert_environment and
+clean_slate call it once per host with the databases to handle, the server
+creating, restoring or dropping each snapshot and answering with one row per
+database (no statement per database crosses the network). Reinstall after
+upgrading dbss.
+
+An environment may spread its databases over several hosts (db_hosts maps
+database to server). Environment commands then run on every host at once,
+each host with its own connection, and their results are merged.
+
+Snapshots grow as source pages are written (copy on write). 'stats' shows
+each snapshot's on-disk size against its source, with --refresh it recreates
+snapshots grown past the bloat ratio (after reverting changed sources, so the
+baseline is kept); databases holding other generations are reported and left
+be (exit 17). 'check_baseline' warns of bloated snapshots.
+
+A database may hold several snapshot generations (--generation, e.g. nightly
+or pre-migration, named DB_dbss_<generation>; 'baseline' is DB_dbss). SQL
+Server reverts a database only while it has a single snapshot, so a restore
+would drop the database's other generations: dbss refuses it (exit 17) unless
+given --drop-generations, and 'stats --refresh' leaves such databases be.
+Each snapshot adds copy-on-write work to every write on its source, so an
+environment may set limits (count, total size, age, none by default) beyond
+which generations are evicted oldest first whenever one is created
+('generations' lists them, --prune evicts now). Baseline is never evicted.
+
+Imported as a module, open_environment, take_baseline, dirty_databases and
+restore_databases (with close_environment) do the same work without exiting,
+failures raise DbssError. pytest_dbss.py builds a pytest plugin on them,
+restoring between tests only the databases a test wrote to.
+
+'create' and 'restore' may run as a job (--progress or --timeout): the
+statement runs on its own connection while dbss polls sys.dm_exec_requests,
+printing percent complete and time left (JSON lines with --quiet); past the
+timeout the job's session is killed and the state the database was left in
+is reported (a killed restore may leave it RESTORING or SUSPECT, re-run).
+Imported, submit_job, poll_job, wait_job and cancel_job do the same.
+
+Restored databases start cold (pages out of the buffer pool). 'restore' and
+'revert_environment' with --prewarm then read each database's hot tables or
+indexes (prewarm_objects in env, else its largest tables), several databases
+at once, and report the time taken.
+
+Creates, restores, drops and kills are recorded (duration, snapshot size,
+outcome) in ~/.dbss/history.sqlite. Runs by --batch or procedure record each
+database with the whole batch's duration, flagged batched (marked * and kept
+apart by 'history'). 'history' shows percentiles per database and flags runs
+slower than --slow times that database's median; --jobs starts the databases
+expected to take longest (by history, batched runs aside) first.
 
 White lists are used to validate commands. The lists are environment specific,
 use command 'list' to examine a desired white list.
 
-kill_connections will kill client SQL SERVER connections, useful for testing.
+'serve' keeps a dbss daemon running with a warm connection and catalog,
+taking requests (one JSON object per line) on a Unix socket, by default
+~/.dbss/daemon_<env>.sock, readable and writable by its owner only. 'call' is
+the thin client, e.g. 'dbss.py call restore CXSCORE'. Requests are queued and
+run one at a time. A TCP port on loopback (--listen=127.0.0.1:7733) must be
+asked for, other hosts are refused; it has no authentication, any local user
+could then run commands with the daemon's credentials. Requests may not
+ask for --profile or --trace-file (the daemon would write what they name).
+
+Database access goes through a driver chosen per environment ('mssql',
+'pymssql', 'pyodbc' or 'simulator'). Environment 'sim' runs against an
+in-process simulated server (dbss_simulator.py), handy for timing dbss
+without SQL Server.
+
+kill_connections will kill client SQL SERVER connections to white-listed
+databases (--server-wide for every client connection), useful for testing.
 Your connection pooling library may automatically reconnect though, so this
-cannot be relied upon for reliable automation... 
+cannot be relied upon for reliable automation... For restores, eviction
+'kill' kills connections to the database just before its restore, and
+'single_user' wraps the restore in SET SINGLE_USER WITH ROLLBACK IMMEDIATE
+(then MULTI_USER), so lock waits end at once.
 
 Usage:
-   dbss.py create (<database>) [--environment=<env>] [--quiet]
-   dbss.py restore (<database>) [--environment=<env>] [--quiet]
-   dbss.py destroy (<database>) [--environment=<env>] [--quiet]
+   dbss.py create (<database>) [--environment=<env>] [--generation=<name>]
+           [--progress] [--timeout=<s>] [--quiet] [--profile]
+           [--trace-file=<file>]
+   dbss.py restore (<database>) [--environment=<env>] [--generation=<name>]
+           [--evict=<mode>] [--drop-generations] [--progress] [--timeout=<s>]
+           [--prewarm] [--quiet] [--profile] [--trace-file=<file>]
+   dbss.py destroy (<database>) [--environment=<env>] [--generation=<name>]
+           [--quiet] [--profile] [--trace-file=<file>]
    dbss.py test (<database>) [--environment=<env>]
    dbss.py list [--environment=<env>]
-   dbss.py survey [--environment=<env>]
+   dbss.py survey [--environment=<env>] [--profile] [--trace-file=<file>]
    dbss.py check_baseline [--environment=<env>]
-   dbss.py kill_connections [--environment=<env>]
-   dbss.py generate_baseline [--environment=<env>] [--quiet]
-   dbss.py revert_environment [--environment=<env>] [--quiet]
-   dbss.py clean_slate [--environment=<env>] [--quiet]
+           [--profile] [--trace-file=<file>]
+   dbss.py stats [--environment=<env>] [--bloat=<ratio>] [--refresh]
+           [--drop-generations] [--quiet] [--profile] [--trace-file=<file>]
+   dbss.py kill_connections [--environment=<env>] [--server-wide]
+           [--profile] [--trace-file=<file>]
+   dbss.py generations [--environment=<env>] [--prune] [--quiet]
+           [--profile] [--trace-file=<file>]
+   dbss.py history [--environment=<env>] [--slow=<ratio>]
+   dbss.py generate_baseline [--environment=<env>] [--jobs=<n>]
+           [--server-side] [--generation=<name>] [--force-recreate] [--quiet]
+           [--profile] [--trace-file=<file>]
+   dbss.py revert_environment [--environment=<env>] [--jobs=<n>] [--batch]
+           [--server-side] [--generation=<name>] [--evict=<mode>] [--force]
+           [--drop-generations] [--prewarm] [--quiet] [--profile]
+           [--trace-file=<file>]
+   dbss.py clean_slate [--environment=<env>] [--jobs=<n>] [--batch]
+           [--server-side] [--quiet] [--profile] [--trace-file=<file>]
+   dbss.py install [--environment=<env>] [--quiet] [--profile]
+           [--trace-file=<file>]
+   dbss.py serve [--environment=<env>] [--listen=<address>] [--quiet]
+   dbss.py call [--listen=<address>] [--environment=<env>] <command>
+           [<database>] [--evict=<mode>] [--drop-generations]
+           [--jobs=<n>] [--batch] [--server-side] [--force] [--force-recreate]
+           [--bloat=<ratio>] [--refresh] [--generation=<name>] [--prune]
+           [--prewarm] [--quiet]
    dbss.py (-h | --help)
    dbss.py --version
 
@@ -41,17 +154,57 @@ Options:
    -h --help            Show help screen
    --version            Show version
    --environment=<env>  Environment (e.g. test, staging) [default: test]
+   --jobs=<n>           Databases processed at once, largest first [default: 1]
+   --batch              Send environment operation as one T-SQL batch
+   --server-side        Run environment operation by installed procedure
+   --evict=<mode>       Before restore: none, kill or single_user [default: none]
+   --drop-generations   Let restore drop database's other snapshot generations
+   --server-wide        Kill all client connections, not only white list
+   --force              Restore every database, changed since snapshot or not
+   --force-recreate     Recreate every snapshot, current or not
+   --bloat=<ratio>      Snapshot to source size ratio counted as bloated
+   --refresh            Recreate bloated snapshots (from baseline)
+   --generation=<name>  Snapshot generation [default: baseline]
+   --prune              Evict generations beyond retention limits
+   --progress           Report progress of create/restore while it runs
+   --timeout=<s>        Cancel create/restore still running after s seconds
+   --prewarm            Read hot tables into memory after restore
+   --slow=<ratio>       Flag runs over ratio times median [default: 2]
+   --listen=<address>   Daemon socket path or loopback host:port
+                        (default: socket in ~/.dbss)
+   --profile            Print hot spots (time by statement and step)
+   --trace-file=<file>  Write spans (one JSON object per line) to file
    --quiet              Suppress narration [default: False]
 """
 
-import docopt
-import _mssql
 import sys
+import time
+
+# docopt, json, threading and the database driver are imported where
+# ... used, so offline commands (--help, --version, list, test) start
+# ... without loading them (see main)
 
 # constants and sql-server conventions
 # ... intial version taken from docopts examples
 VERSION = '1.0.0rc2'
 
+# commands accepted by daemon (see serve), with short aliases
+DAEMON_COMMANDS = ('create', 'restore', 'destroy', 'survey', 'check_baseline',
+                   'stats', 'generations', 'kill_connections', 'generate_baseline',
+                   'revert_environment', 'clean_slate')
+DAEMON_ALIASES = {'check': 'check_baseline', 'revert': 'revert_environment',
+                  'generate': 'generate_baseline', 'clean': 'clean_slate'}
+
+# daemon re-reads catalog after this many seconds (others change it too)
+DAEMON_CATALOG_TTL = 60
+
+# hosts a daemon may listen on by TCP (requests are not authenticated)
+DAEMON_LOOPBACK_HOSTS = ('127.0.0.1', '::1', 'localhost')
+
+# options refused in daemon requests, they write files or output of the
+# ... daemon's choosing (docopt accepts any unique prefix, so do these)
+DAEMON_REFUSED_OPTIONS = ('--profile', '--trace-file')
+
 
 # configure environment
 # ... do not use globals in functions, as they may
@@ -60,39 +213,170 @@ VERSION = '1.0.0rc2'
 def configure_environment(environment,quiet_mode):
     """Assign 'env' configuration for environment."""
     env = None
+    db_list = ('CXSCORE', 'CXSERVER', 'IXDIRECTORY', 'IXDIRECTORY_PXQUOTE',
+               'IXDOC_CRU4', 'IXDOC_PXQUOTE_CRU4', 'IXLIBRARY_CRU4',
+               'IXLOG', 'IXLOGIC_CRU4', 'IXPROFILER', 'IXRELAY',
+               'IXVOCAB', 'PXCENTRAL_CRU4', 'PXGATEWAY_CRU4',
+               'PXPAY_CRU4', 'PXPOWER_CRU4', 'PXPROGRAM_CRU4',
+               'PXSERVER_CRU4', 'PXVAULT_CRU4')
     if environment == 'test':
-        db_list = ('CXSCORE', 'CXSERVER', 'IXDIRECTORY', 'IXDIRECTORY_PXQUOTE',
-                   'IXDOC_CRU4', 'IXDOC_PXQUOTE_CRU4', 'IXLIBRARY_CRU4',
-                   'IXLOG', 'IXLOGIC_CRU4', 'IXPROFILER', 'IXRELAY',
-                   'IXVOCAB', 'PXCENTRAL_CRU4', 'PXGATEWAY_CRU4',
-                   'PXPAY_CRU4', 'PXPOWER_CRU4', 'PXPROGRAM_CRU4',
-                   'PXSERVER_CRU4', 'PXVAULT_CRU4')
         env = {}
+        env['db_driver'] = 'mssql'
         env['db_server'] = 'db_test_01'
         env['db_user'] = 'RedactedAppUser'
         env['db_pswd'] = 'edward_snowden'
         env['db_white_list'] = db_list
+        # databases kept on other hosts than db_server (see database_host)
+        env['db_hosts'] = dict()
+    if environment == 'sim':
+        # in-process stand-in for test server (see dbss_simulator)
+        env = {}
+        env['db_driver'] = 'simulator'
+        env['db_server'] = 'sim_test_01'
+        env['db_user'] = 'sim'
+        env['db_pswd'] = 'sim'
+        env['db_white_list'] = db_list
+        env['db_hosts'] = dict()
+        env['sim_latency'] = 0.002
+        env['sim_login_latency'] = 0.02
+    if environment == 'sim_hosts':
+        # simulated tier spread over three hosts (IX*, PX* moved off)
+        env = {}
+        env['db_driver'] = 'simulator'
+        env['db_server'] = 'sim_test_01'
+        env['db_user'] = 'sim'
+        env['db_pswd'] = 'sim'
+        env['db_white_list'] = db_list
+        env['db_hosts'] = dict()
+        for db in db_list:
+            if db.startswith('IX'):
+                env['db_hosts'][db] = 'sim_test_02'
+            elif db.startswith('PX'):
+                env['db_hosts'][db] = 'sim_test_03'
+        env['sim_latency'] = 0.002
+        env['sim_login_latency'] = 0.02
+    if env is not None:
+        env['environment'] = environment
         env['quiet_mode'] = quiet_mode
         env['snapshot_suffix'] = '_dbss'
         env['snapshot_file_type'] = 'ss'
+        env['db_session'] = new_session()
+        # sessions and catalogs of further hosts (see host_environment)
+        env['host_pools'] = dict()
+        # seconds before cached catalog is re-read (None, trust for run)
+        env['catalog_ttl'] = None
+        env['catalog_cache'] = new_catalog_cache()
+        # span recorder when profiling/tracing (see new_tracer)
+        env['tracer'] = None
+        # connection eviction before restore (see RESTORE_EVICTIONS)
+        env['restore_eviction'] = 'none'
+        # restore may drop database's other generations (else refused)
+        env['drop_generations'] = False
+        # environment operations run by dbss procedure (see install)
+        env['server_side'] = False
+        # snapshot on disk size (versus source data) counted as bloated
+        env['snapshot_bloat_ratio'] = 0.25
+        # snapshot generation dbss works on (see --generation)
+        env['snapshot_generation'] = BASELINE_GENERATION
+        # generation retention per database, None for no limit (the
+        # ... count includes baseline, size is bytes, age is hours)
+        env['generation_max_count'] = None
+        env['generation_max_bytes'] = None
+        env['generation_max_age'] = None
+        # change marks, revert_environment skips unchanged databases
+        env['state_dir'] = '~/.dbss'
+        env['change_marks'] = new_change_marks()
+        # snapshot statement plans, kept while file layout holds
+        env['snapshot_plans'] = new_snapshot_plans()
+        # hours after which generate_baseline recreates a snapshot even
+        # ... when its source is unwritten (None, no limit)
+        env['snapshot_max_age'] = None
+        # seconds between progress polls of background jobs
+        env['job_poll_interval'] = 1.0
+        # objects read after restore with --prewarm, by database (else
+        # ... its prewarm_top largest tables), prewarm_jobs at once
+        env['prewarm_objects'] = dict()
+        env['prewarm_top'] = 5
+        env['prewarm_jobs'] = 4
+        # operation history (see save_history), recent runs used for
+        # ... expected durations
+        env['keep_history'] = True
+        env['history'] = new_history()
+        env['history_runs'] = 20
     return env
 
 
+# connection eviction before restore
+# ... kill: kill connections to database, then restore
+# ... single_user: SINGLE_USER WITH ROLLBACK IMMEDIATE, restore, MULTI_USER
+RESTORE_EVICTIONS = ('none', 'kill', 'single_user')
+
+
+# snapshot generations
+# ... a database may hold several named snapshots, generation 'baseline'
+# ... is named DB_dbss, any other DB_dbss_<generation>
+BASELINE_GENERATION = 'baseline'
+
+
+# server-side execution
+# ... procedure installed in master by 'install' (see call_procedure)
+SERVER_PROCEDURE = 'dbss_environment'
+
+
+# operation history
+# ... tasks recorded under another operation's name, against the
+# ... snapshot's source database (destroy_snapshot drops via drop_database)
+TASK_OPERATIONS = {'destroy_snapshot': 'drop_database'}
+
+
 # string utility functions
+def generation_suffix(env):
+    """Suffix of snapshot (and its files) for env's generation."""
+    suffix = env['snapshot_suffix']
+    if env['snapshot_generation'] != BASELINE_GENERATION:
+        suffix += '_' + env['snapshot_generation']
+    return suffix
+
+
 def snapshot_name(db,env):
-    """Convert database name to snapshot name."""
-    dbss = db + env['snapshot_suffix']
+    """Convert database name to snapshot name (env's generation)."""
+    dbss = db + generation_suffix(env)
     return dbss
 
 
 def original_db_name(dbss,env):
     """Convert snapshot database name to source database name."""
     # use only if you *know* string is snapshot name
-    last_char = -len(env['snapshot_suffix'])
+    # ... last suffix, generation names follow it
+    last_char = dbss.rfind(env['snapshot_suffix'])
     base_db = dbss[:last_char]
     return base_db
 
 
+def snapshot_generation(dbss,env):
+    """Name generation of snapshot database."""
+    last_char = dbss.rfind(env['snapshot_suffix']) + len(env['snapshot_suffix'])
+    generation = dbss[last_char:].lstrip('_')
+    if generation == '':
+        generation = BASELINE_GENERATION
+    return generation
+
+
+def generation_name(name,suffix):
+    """Normalize generation name (None if unusable in database names).
+
+    A generation containing the snapshot suffix is unusable: original
+    database and generation of snapshot names split at its last
+    occurrence.
+    """
+    generation = name.lower().replace('-', '_')
+    if generation == '' or not generation.replace('_', '').isalnum():
+        return None
+    if suffix.lower() in '_' + generation:
+        return None
+    return generation
+
+
 def is_snapshot(db,env):
     """Determine if database is a snapshot (based on name convention)."""
     if db.find(env['snapshot_suffix']) == -1:
@@ -101,22 +385,496 @@ def is_snapshot(db,env):
         return True
 
 
+# tracing
+# ... spans nest command > database > operation > statement (and
+# ... login), each with duration, error code and row count; with no
+# ... tracer in env the span functions do nothing
+def new_tracer(trace_file=None):
+    """Create span recorder, optionally writing spans as JSON lines."""
+    import threading
+    tracer = dict()
+    tracer['spans'] = list()
+    tracer['lock'] = threading.Lock()
+    tracer['local'] = threading.local()
+    tracer['next_id'] = 1
+    tracer['root'] = None
+    tracer['started'] = time.time()
+    tracer['trace_file'] = None
+    if trace_file is not None:
+        tracer['trace_file'] = open(trace_file, 'w')
+    return tracer
+
+
+def close_tracer(env):
+    """Close trace file (spans stay available for profile)."""
+    tracer = env['tracer']
+    if tracer is not None and tracer['trace_file'] is not None:
+        tracer['trace_file'].close()
+        tracer['trace_file'] = None
+
+
+def start_span(kind,name,env,db=None):
+    """Open span under current span of this thread (None if no tracer)."""
+    tracer = env['tracer']
+    if tracer is None:
+        return None
+    import threading
+    stack = getattr(tracer['local'], 'stack', None)
+    if stack is None:
+        stack = list()
+        tracer['local'].stack = stack
+    span = dict()
+    with tracer['lock']:
+        span['id'] = tracer['next_id']
+        tracer['next_id'] += 1
+        if tracer['root'] is None:
+            tracer['root'] = span['id']
+    # worker threads hang their spans off the command span
+    if stack != []:
+        span['parent'] = stack[-1]['id']
+    elif tracer['root'] != span['id']:
+        span['parent'] = tracer['root']
+    else:
+        span['parent'] = None
+    span['kind'] = kind
+    span['name'] = name
+    span['db'] = db
+    span['thread'] = threading.current_thread().name
+    span['start'] = time.time()
+    span['error'] = None
+    span['rows'] = None
+    stack.append(span)
+    return span
+
+
+def end_span(span,env,error=None,rows=None):
+    """Close span, record it (and write trace line)."""
+    if span is None:
+        return
+    tracer = env['tracer']
+    span['duration'] = time.time() - span['start']
+    span['error'] = error
+    span['rows'] = rows
+    stack = tracer['local'].stack
+    if span in stack:
+        stack.remove(span)
+    with tracer['lock']:
+        tracer['spans'].append(span)
+        if tracer['trace_file'] is not None:
+            import json
+            tracer['trace_file'].write(json.dumps(span, sort_keys=True))
+            tracer['trace_file'].write('\n')
+
+
+class TracedBlock(object):
+    """Span around with-block (see traced)."""
+
+    def __init__(self,kind,name,env,db):
+        self.kind = kind
+        self.name = name
+        self.env = env
+        self.db = db
+        self.span = None
+
+    def __enter__(self):
+        self.span = start_span(self.kind,self.name,self.env,self.db)
+        return self.span
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        error = None
+        if exc_type is not None and issubclass(exc_type, SystemExit):
+            error = exc_value.code
+        elif exc_type is not None and issubclass(exc_type, Exception):
+            error = exc_type.__name__
+        end_span(self.span,self.env,error)
+        return False
+
+
+def traced(kind,name,env,db=None):
+    """Span around block, exit code of sys.exit recorded as error."""
+    # plain class rather than contextlib, keeps contextlib off startup
+    return TracedBlock(kind,name,env,db)
+
+
+def statement_label(sql):
+    """Short label grouping statements of the same shape."""
+    words = sql.replace(';', ' ').split()
+    while len(words) > 2 and words[0].upper() in ('USE', 'SET'):
+        if words[0].upper() == 'SET':
+            words = words[3:]
+        else:
+            words = words[2:]
+    if 'BEGIN TRY' in ' '.join(words).upper():
+        return 'BATCH TRY/CATCH'
+    label = ' '.join(words[:2]).upper()
+    upper_words = list()
+    for word in words:
+        upper_words.append(word.upper())
+    if upper_words[:1] == ['SELECT'] and 'FROM' in upper_words:
+        source = words[upper_words.index('FROM') + 1]
+        # drop database part of three-part names
+        if source.count('.') == 2:
+            source = source[source.index('.') + 1:]
+        label = 'SELECT FROM ' + source
+    return label
+
+
+def print_profile(env):
+    """Print hot spots, span time summed by kind and name."""
+    tracer = env['tracer']
+    if tracer is None:
+        return
+    totals = dict()
+    database_list = list()
+    for span in tracer['spans']:
+        key = (span['kind'], span['name'])
+        # databases summed as one line, slowest listed after
+        if span['kind'] == 'database':
+            key = ('database', '(all databases)')
+            database_list.append((span['duration'], span['name']))
+        if key not in totals:
+            totals[key] = [0, 0.0, 0.0, 0]
+        totals[key][0] += 1
+        totals[key][1] += span['duration']
+        totals[key][2] = max(totals[key][2], span['duration'])
+        if span['error'] not in (None, 0):
+            totals[key][3] += 1
+    hot_list = list()
+    for key in totals:
+        hot_list.append((totals[key][1], key))
+    hot_list.sort(reverse=True)
+    lines = list()
+    lines.append('Profile ({0:.3f}s wall, {1} spans):'\
+                 .format(time.time() - tracer['started'],
+                         len(tracer['spans'])))
+    lines.append('   {0:<10} {1:<34} {2:>6} {3:>9} {4:>9} {5:>9} {6:>6}'\
+                 .format('kind', 'name', 'count', 'total s', 'mean ms',
+                         'max ms', 'errors'))
+    for total, key in hot_list:
+        count, total, longest, errors = totals[key]
+        lines.append('   {0:<10} {1:<34} {2:>6} {3:>9.3f} {4:>9.1f} '
+                     '{5:>9.1f} {6:>6}'\
+                     .format(key[0], key[1][:34], count, total,
+                             1000 * total / count, 1000 * longest, errors))
+    database_list.sort(reverse=True)
+    if database_list != []:
+        slowest_list = list()
+        for duration, db in database_list[:5]:
+            slowest_list.append('{0} {1:.3f}s'.format(db, duration))
+        lines.append('   slowest databases: ' + ', '.join(slowest_list))
+    # narration suppressed, profile still wanted (on stderr)
+    if not env['quiet_mode']:
+        print('\n'.join(lines))
+    else:
+        sys.stderr.write('\n'.join(lines) + '\n')
+
+
+# database drivers
+# ... env['db_driver'] names the driver, imported on first login so
+# ... commands without database work never load it
+DB_DRIVERS = ('mssql', 'pymssql', 'pyodbc', 'simulator')
+
+
+def load_driver(env):
+    """Import database driver named in env, return driver record.
+
+    Driver record holds 'connect' (env to connection), 'errors' (tuple
+    of exception classes raised for sql and link failures). Connections
+    follow the _mssql interface: execute_non_query, execute_query then
+    iterate rows, cancel, close and 'connected'.
+    """
+    name = env['db_driver']
+    driver = dict()
+    driver['name'] = name
+    try:
+        if name == 'mssql':
+            import _mssql
+            driver['connect'] = mssql_connector(_mssql)
+            driver['errors'] = (_mssql.MSSQLException,)
+        elif name == 'pymssql':
+            # pymssql 2.x bundles the _mssql interface
+            from pymssql import _mssql
+            driver['connect'] = mssql_connector(_mssql)
+            driver['errors'] = (_mssql.MSSQLException,)
+        elif name == 'pyodbc':
+            import pyodbc
+            driver['connect'] = odbc_connector(pyodbc)
+            driver['errors'] = (pyodbc.Error,)
+        elif name == 'simulator':
+            import dbss_simulator
+            driver['connect'] = dbss_simulator.connect
+            driver['errors'] = (dbss_simulator.SimulatedError,)
+        else:
+            driver = None
+            message = "Driver '{0}' Unknown (choose from {1})"\
+                      .format(name, ', '.join(DB_DRIVERS))
+    except ImportError as e:
+        driver = None
+        message = "Driver '{0}' could not be loaded ({1})".format(name,e)
+    if driver is None:
+        if not env['quiet_mode']:
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(4)
+    return driver
+
+
+def mssql_connector(mssql_module):
+    """Build connect function for _mssql style module."""
+    def connect(env):
+        dbs = env['db_server']
+        dbu = env['db_user']
+        dbp = env['db_pswd']
+        return mssql_module.connect(server=dbs,user=dbu,password=dbp)
+    return connect
+
+
+def odbc_connector(pyodbc):
+    """Build connect function for pyodbc."""
+    def connect(env):
+        return OdbcConnection(pyodbc,env)
+    return connect
+
+
+class OdbcConnection(object):
+    """Adapt pyodbc connection to the _mssql connection interface."""
+
+    # sqlstate classes reported when the link itself is lost
+    LINK_STATES = ('08S01', '08003', '08001', 'HYT00')
+
+    def __init__(self, pyodbc, env):
+        # optional env['odbc_driver'], pyodbc only
+        odbc_driver = env.get('odbc_driver', 'ODBC Driver 17 for SQL Server')
+        connection_string = "DRIVER={{{0}}};SERVER={1};UID={2};PWD={3}"\
+                            .format(odbc_driver, env['db_server'],
+                                    env['db_user'], env['db_pswd'])
+        self.pyodbc = pyodbc
+        # snapshot ddl cannot run inside a transaction
+        self.connection = pyodbc.connect(connection_string, autocommit=True)
+        self.cursor = None
+        self.connected = True
+
+    def run(self, sql):
+        """Execute batch on fresh cursor, noting a lost link."""
+        self.cancel()
+        self.cursor = self.connection.cursor()
+        try:
+            self.cursor.execute(sql)
+        except self.pyodbc.Error as e:
+            if e.args and e.args[0] in self.LINK_STATES:
+                self.connected = False
+            raise
+        return self.cursor
+
+    def execute_non_query(self, sql):
+        cursor = self.run(sql)
+        # drain remaining result sets so errors surface here
+        while cursor.nextset():
+            pass
+
+    def execute_query(self, sql):
+        cursor = self.run(sql)
+        # skip row counts ahead of first result set
+        while cursor.description is None and cursor.nextset():
+            pass
+
+    def __iter__(self):
+        if self.cursor is None or self.cursor.description is None:
+            return
+        columns = list()
+        for column in self.cursor.description:
+            columns.append(column[0])
+        for record in self.cursor:
+            row = dict()
+            for position, value in enumerate(record):
+                row[position] = value
+                row[columns[position]] = value
+            yield row
+
+    def cancel(self):
+        if self.cursor is not None:
+            self.cursor.cancel()
+            self.cursor = None
+
+    def close(self):
+        self.connected = False
+        self.connection.close()
+
+
+def driver_errors(env):
+    """Exception classes of session driver (none until loaded)."""
+    driver = env['db_session']['driver']
+    if driver is None:
+        return ()
+    return driver['errors']
+
+
+def driver_error_number(e):
+    """Extract server error number from driver exception (if known)."""
+    number = getattr(e, 'number', None)
+    if number is None and getattr(e, 'args', None):
+        # pyodbc reports sqlstate as first argument
+        number = e.args[0]
+    return number
+
+
+def driver_message(e):
+    """Extract message text from driver exception."""
+    message = getattr(e, 'message', None)
+    if not isinstance(message, str):
+        message = str(e)
+    return message
+
+
+# database sessions
+# ... each run logs in once and reuses the connection, the session
+# ... travels in env so every function shares it (see sql_command)
+def new_session():
+    """Create database session (connection opened on first use)."""
+    session = dict()
+    session['driver'] = None
+    session['connection'] = None
+    session['logins'] = 0
+    session['requests'] = 0
+    return session
+
+
+def session_connection(env):
+    """Obtain pooled connection for environment, logging in if required."""
+    session = env['db_session']
+    connection = session['connection']
+    # link may have been severed (e.g. kill, timeout) since last use
+    if connection is not None and not connection.connected:
+        reset_session(env)
+        connection = None
+    if connection is None:
+        with traced('login',env['db_driver'],env):
+            if session['driver'] is None:
+                session['driver'] = load_driver(env)
+            connection = session['driver']['connect'](env)
+        session['connection'] = connection
+        session['logins'] += 1
+    session['requests'] += 1
+    return connection
+
+
+def reset_session(env):
+    """Discard pooled connection, next request will log in again."""
+    session = env['db_session']
+    connection = session['connection']
+    session['connection'] = None
+    if connection is not None:
+        try:
+            connection.close()
+        except driver_errors(env):
+            pass
+
+
+def close_session(env):
+    """Close pooled connection (and those of further hosts) at end of run."""
+    reset_session(env)
+    for server in sorted(env['host_pools']):
+        reset_session(host_environment(server,env))
+
+
+def session_report(env):
+    """Describe logins made versus logins saved by session reuse."""
+    logins = env['db_session']['logins']
+    requests = env['db_session']['requests']
+    for server in sorted(env['host_pools']):
+        session = env['host_pools'][server]['db_session']
+        logins += session['logins']
+        requests += session['requests']
+    saved = requests - logins
+    report = "Connections: {0} login(s), {1} saved by session reuse."\
+             .format(logins,saved)
+    return report
+
+
+def link_broken(env):
+    """Determine if pooled connection was lost (versus sql error)."""
+    connection = env['db_session']['connection']
+    if connection is None:
+        return True
+    return not connection.connected
+
+
+# catalog cache
+# ... sys.databases is read once per run, dbss's own DDL then keeps
+# ... the cached survey current (create/restore/drop update it)
+def new_catalog_cache():
+    """Create empty catalog cache (database name to state)."""
+    cache = dict()
+    cache['survey'] = None
+    cache['taken'] = None
+    # cache is shared by worker sessions (see run_environment_jobs)
+    cache['lock'] = new_lock()
+    return cache
+
+
+def new_lock():
+    """Create lock (low-level thread module, cheaper to load than threading)."""
+    try:
+        import _thread
+    except ImportError:
+        import thread as _thread
+    return _thread.allocate_lock()
+
+
+def catalog_expired(env):
+    """Determine if cached catalog is missing or older than its ttl."""
+    cache = env['catalog_cache']
+    if cache['survey'] is None:
+        return True
+    ttl = env['catalog_ttl']
+    if ttl is not None and time.time() - cache['taken'] > ttl:
+        return True
+    return False
+
+
+def catalog_update(db,state,env):
+    """Record database state after dbss DDL (state None when dropped)."""
+    cache = env['catalog_cache']
+    with cache['lock']:
+        if cache['survey'] is None:
+            return
+        if state is None:
+            cache['survey'].pop(db, None)
+        else:
+            cache['survey'][db] = state
+
+
+def catalog_invalidate(env):
+    """Discard cached catalog, next survey reads sys.databases."""
+    cache = env['catalog_cache']
+    cache['survey'] = None
+    cache['taken'] = None
+    # file layouts re-checked too (a failed create may be a moved file)
+    plans = env['snapshot_plans']
+    with plans['lock']:
+        plans['checked'].pop(env['db_server'], None)
+
+
 # datbase interaction
 # ... simple crud functions, build workflow into command functions
 def sql_command(sql,env,err_code):
     """Execute SQL command statement."""
     db_result = 0
-    dbs = env['db_server']
-    dbu = env['db_user']
-    dbp = env['db_pswd']
     quiet_mode = env['quiet_mode']
+    span = start_span('statement',statement_label(sql),env)
+    error = None
     try:
-        connection = None
-        connection = _mssql.connect(server=dbs,user=dbu,password=dbp)
+        connection = session_connection(env)
         connection.execute_non_query(sql)
-    except _mssql.MSSQLDatabaseException as e:
+    except driver_errors(env) as e:
+        error = driver_error_number(e)
+        # commands are not retried, statement may have been applied
+        # ... but drop a dead link so later requests log in afresh
+        if link_broken(env):
+            reset_session(env)
         db_result = err_code
-        message = e.message
+        message = driver_message(e)
         first_period = message.find('.')
         message = message[:first_period]
         redundant_msg = message.find('DB-Lib error message')
@@ -127,31 +885,49 @@ def sql_command(sql,env,err_code):
         else:
             sys.stderr.write("[dbss/mssql] {}".format(message))
     finally:
-        # note: if credentials refused, connection would be unbound
-        # ... thus, assign to None, and test before closing
-        if connection is not None:
-            connection.close()
+        end_span(span,env,error)
     if not db_result == 0:
         sys.exit(db_result)
 
 
-def sql_query(sql,env,err_code):
-    """Execute SQL query statement, return results as list of rows."""
+def sql_rows(sql,env,err_code):
+    """Execute SQL query statement, yield rows as they arrive.
+
+    Rows are dictionaries keyed by column name. The pooled connection
+    is busy until the rows are consumed, so finish iterating before
+    issuing another statement.
+    """
     db_result = 0
-    dbs = env['db_server']
-    dbu = env['db_user']
-    dbp = env['db_pswd']
     quiet_mode = env['quiet_mode']
-    query_result = list()
+    connection = None
+    span = start_span('statement',statement_label(sql),env)
+    error = None
+    row_count = 0
     try:
-        connection = None
-        connection = _mssql.connect(server=dbs,user=dbu,password=dbp)
-        connection.execute_query(sql)
+        connection = session_connection(env)
+        try:
+            connection.execute_query(sql)
+        except driver_errors(env):
+            # queries are safe to repeat, retry once on fresh login
+            # ... when the pooled link was found broken
+            if not link_broken(env):
+                raise
+            reset_session(env)
+            connection = session_connection(env)
+            connection.execute_query(sql)
         for row in connection:
-            query_result.append(row)
-    except _mssql.MSSQLDatabaseException as e:
+            row_count += 1
+            yield named_row(row)
+    except GeneratorExit:
+        # abandoned early, discard pending rows so session is reusable
+        connection.cancel()
+        raise
+    except driver_errors(env) as e:
+        error = driver_error_number(e)
+        if link_broken(env):
+            reset_session(env)
         db_result = err_code
-        message = e.message
+        message = driver_message(e)
         first_period = message.find('.')
         message = message[:first_period]
         if not quiet_mode:
@@ -159,89 +935,188 @@ def sql_query(sql,env,err_code):
         else:
             sys.stderr.write("[dbss/mssql] {}".format(message))
     finally:
-        # note: if credentials refused, connection would be unbound
-        # ... thus, assign to None, and test before closing
-        if connection is not None:
-            connection.close()
+        end_span(span,env,error,row_count)
     if not db_result == 0:
         sys.exit(db_result)
-    else:
-        return query_result
 
 
-def kill_connections(env):
-    """Sever all database connections to allow snapshot restore."""
+def sql_query(sql,env,err_code):
+    """Execute SQL query statement, return results as list of rows."""
+    query_result = list()
+    for row in sql_rows(sql,env,err_code):
+        query_result.append(row)
+    return query_result
+
+
+def named_row(row):
+    """Keep column names of driver row (drop positional keys)."""
+    column_row = dict()
+    for key in row:
+        if not isinstance(key, int):
+            column_row[key] = row[key]
+    return column_row
+
+
+def sql_name_list(names):
+    """Format names as quoted list for an IN clause."""
+    quoted_list = list()
+    for name in names:
+        quoted_list.append("'{}'".format(name.replace("'", "''")))
+    return ', '.join(quoted_list)
+
+
+def sql_like_literal(text):
+    """Escape LIKE wildcards so text matches literally."""
+    for wildcard in ('[', '_', '%'):
+        text = text.replace(wildcard, '[' + wildcard + ']')
+    return text
+
+
+def kill_connections(env,db_list=None):
+    """Sever database connections to allow snapshot restore.
+
+    Connections to databases in db_list are killed, or every client
+    connection on the server when db_list is None.
+    """
     db_result = 0
     err_code = 73
     this_spid = None
     spid_list = list()
-    dbs = env['db_server']
-    dbu = env['db_user']
-    dbp = env['db_pswd']
     quiet_mode = env['quiet_mode']
     sql_kill_list = ''
     sql_this_connection = "select @@SPID;"
-    sql_all_connections = "select spid from master.dbo.sysprocesses;"
+    sql_all_connections = "select spid from master.dbo.sysprocesses "
+    sql_all_connections += "where spid > 50"
+    if db_list is not None:
+        sql_all_connections += " and dbid in (select database_id "
+        sql_all_connections += "from sys.databases where name in ({}))"\
+                               .format(sql_name_list(db_list))
+    sql_all_connections += ";"
     # note: spid up through 50 are reserved for sql server internals
+    # ... our own (pooled) spid is spared, so session survives
+    span = start_span('operation','kill_connections',env)
+    started = time.time()
+    error = None
     try:
-        connection = None
-        connection = _mssql.connect(server=dbs,user=dbu,password=dbp)
-        connection.execute_query(sql_this_connection)
-        for row in connection:
-            this_spid = row[0]
-        connection.execute_query(sql_all_connections)
-        for row in connection:
-            spid = row['spid']
-            if (spid > 50) and (spid != this_spid):
-                spid_list.append(spid)
+        connection = session_connection(env)
+        with traced('statement',statement_label(sql_this_connection),env):
+            connection.execute_query(sql_this_connection)
+            for row in connection:
+                this_spid = row[0]
+        with traced('statement',statement_label(sql_all_connections),env):
+            connection.execute_query(sql_all_connections)
+            for row in connection:
+                spid = row['spid']
+                if (spid > 50) and (spid != this_spid):
+                    spid_list.append(spid)
         for spid in spid_list:
             sql_kill_list += "kill {};".format(spid)
         if sql_kill_list != '':
-            connection.execute_non_query(sql_kill_list)
-    except _mssql.MSSQLDatabaseException as e:
+            with traced('statement','KILL',env):
+                connection.execute_non_query(sql_kill_list)
+    except driver_errors(env) as e:
+        error = driver_error_number(e)
+        if link_broken(env):
+            reset_session(env)
         db_result = err_code
-        message = e.message
+        message = driver_message(e)
         first_period = message.find('.')
         message = message[:first_period]
         if not quiet_mode:
             print(message)
         else:
             sys.stderr.write("[dbss/mssql] {}".format(message))
-    finally:
-        # note: if credentials refused, connection would be unbound
-        # ... thus, assign to None, and test before closing
-        if connection is not None:
-            connection.close()
+    end_span(span,env,error,len(spid_list))
+    # one database, or whole white list (server) recorded as NULL
+    history_db = None
+    if db_list is not None and len(db_list) == 1:
+        history_db = db_list[0]
+    record_history('kill_connections',history_db,env,started,db_result)
 
 
-def survey_databases(env,testing=False):
+def survey_databases(env,testing=False,refresh=False):
     """Obtain survey of databases (each with associated status)."""
-    sql = "SELECT * FROM sys.databases;"
+    # filtered on server to white list and snapshots (of any database,
+    # ... so snapshots left behind by a changed white list still show)
+    sql  = "SELECT name, state_desc FROM sys.databases "
+    sql += "WHERE name IN ({0}) OR name LIKE '%{1}%';"\
+           .format(sql_name_list(env['db_white_list']),
+                   sql_like_literal(env['snapshot_suffix']))
     if testing:
         print('   ' + sql)
         return
-    server_survey = dict()
-    query_result = sql_query(sql,env,85)
-    for row in query_result:
-        server_survey[row['name']] = row['state_desc']
+    if refresh or catalog_expired(env):
+        server_survey = dict()
+        for row in sql_rows(sql,env,85):
+            server_survey[row['name']] = row['state_desc']
+        cache = env['catalog_cache']
+        with cache['lock']:
+            cache['survey'] = server_survey
+            cache['taken'] = time.time()
+    # hand out a copy, callers may alter it freely
+    cache = env['catalog_cache']
+    with cache['lock']:
+        server_survey = dict(cache['survey'])
     return server_survey
 
 
-def survey_datafiles(db,env,testing=False):
-    """Obtain survey of files associated with database."""
-    sql  = "USE {}; ".format(db)
-    sql += "SELECT * FROM sys.database_files WHERE type_desc<>'LOG';"
+def catalog_mismatch(name_list,expected,env):
+    """Names whose presence on server is not as expected (one refresh).
+
+    Catalog cache follows dbss's own DDL, so verifying a CREATE or DROP
+    takes a fresh read; callers verify a whole run with one.
+    """
+    db_survey = survey_databases(env,refresh=True)
+    mismatch_list = list()
+    for name in name_list:
+        if (name in db_survey) != expected:
+            mismatch_list.append(name)
+    return mismatch_list
+
+
+def survey_datafiles(db_list,env,testing=False):
+    """Obtain data files of listed databases (one query for all).
+
+    Returns dictionary of database to list of files (name, filename,
+    pages), in file order.
+    """
+    sql  = "SELECT d.name AS db, f.name, f.physical_name, f.size "
+    sql += "FROM sys.master_files f JOIN sys.databases d "
+    sql += "ON d.database_id = f.database_id "
+    sql += "WHERE f.type_desc<>'LOG' "
+    sql += "AND d.name IN ({}) ".format(sql_name_list(db_list))
+    sql += "ORDER BY d.name, f.file_id;"
     if testing:
         print('   ' + sql)
         return
-    server_file_list = list()
-    query_result = sql_query(sql,env,79)
-    for row in query_result:
+    file_survey = dict()
+    for row in sql_rows(sql,env,79):
         server_file = dict()
-        server_file['name'] = row[5]
-        server_file['filename'] = row[6]
-        server_file_list.append(server_file)
-    return server_file_list
+        server_file['name'] = row['name']
+        server_file['filename'] = row['physical_name']
+        server_file['pages'] = row['size']
+        file_survey.setdefault(row['db'], list()).append(server_file)
+    return file_survey
+
+
+def survey_database_sizes(db_list,env):
+    """Obtain data file size (in 8 KB pages) of listed databases."""
+    file_survey = prefetch_datafiles(db_list,env)
+    size_survey = dict()
+    for db in file_survey:
+        size_survey[db] = 0
+        for db_file in file_survey[db]:
+            size_survey[db] += db_file['pages']
+    return size_survey
+
+
+def survey_server_databases(env):
+    """Obtain names of all databases on server (unfiltered survey)."""
+    sql = "SELECT name FROM sys.databases ORDER BY name;"
+    database_list = list()
+    for row in sql_rows(sql,env,85):
+        database_list.append(row['name'])
+    return database_list
 
 
 def database_exists(db,env):
@@ -252,33 +1127,403 @@ def database_exists(db,env):
     return database_available
 
 
-def capture_database(db,env,testing=False):
-    """Create snapshot of database (core SQL command)."""
-    snapshot_db = snapshot_name(db,env)
-    snapshot_file_type = env['snapshot_file_type']
+# change detection
+# ... a database is unchanged since its snapshot was taken (or it was
+# ... last restored) while its write count and its snapshot's sparse
+# ... file size stand where dbss marked them; marks persist between
+# ... runs in state_dir, one file per environment, and are kept per
+# ... generation (creating one generation leaves the others' marks)
+def new_change_marks():
+    """Create empty change marks (loaded from state_dir on first use)."""
+    marks = dict()
+    marks['servers'] = None
+    # marks are shared by host and worker environments
+    marks['lock'] = new_lock()
+    return marks
+
+
+def change_marks_file(env):
+    """Path of file holding change marks of environment."""
+    import os
+    state_dir = os.path.expanduser(env['state_dir'])
+    return os.path.join(state_dir, 'marks_{}.json'.format(env['environment']))
+
+
+def server_change_marks(env):
+    """Marks of env's server by database (caller holds marks lock)."""
+    marks = env['change_marks']
+    if marks['servers'] is None:
+        marks['servers'] = read_state_file(change_marks_file(env))
+    if env['db_server'] not in marks['servers']:
+        marks['servers'][env['db_server']] = dict()
+    return marks['servers'][env['db_server']]
+
+
+def held_mark(server_marks,db,env):
+    """Mark of database for env's generation (None when unmarked)."""
+    return server_marks.get(db, dict()).get(env['snapshot_generation'])
+
+
+def hold_mark(server_marks,db,mark,env):
+    """Set (or with mark None, discard) database's mark for env's generation."""
+    db_marks = server_marks.get(db, dict())
+    if mark is None:
+        db_marks.pop(env['snapshot_generation'], None)
+    else:
+        db_marks[env['snapshot_generation']] = mark
+    if db_marks == {}:
+        server_marks.pop(db, None)
+    else:
+        server_marks[db] = db_marks
+
+
+def save_change_marks(env):
+    """Write change marks to state_dir (caller holds marks lock)."""
+    write_state_file(change_marks_file(env),env['change_marks']['servers'])
+
+
+def read_state_file(path):
+    """Load JSON state file, empty dictionary if missing or unreadable."""
+    import json
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return dict()
+
+
+def write_state_file(path,state):
+    """Write JSON state file (in state_dir, created when missing)."""
+    import json
+    import os
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    # replace in one step, a reader never sees half a file
+    getattr(os, 'replace', os.rename)(path + '.tmp', path)
+
+
+def survey_write_marks(db_list,env):
+    """Obtain write count of databases and sparse size of their snapshots.
+
+    Databases without snapshot are left out.
+    """
+    name_list = list()
+    for db in db_list:
+        name_list.append(db)
+        name_list.append(snapshot_name(db,env))
+    sql  = "SELECT DB_NAME(database_id) AS name, SUM(num_of_writes) AS writes, "
+    sql += "SUM(size_on_disk_bytes) AS bytes "
+    sql += "FROM sys.dm_io_virtual_file_stats(NULL, NULL) "
+    sql += "WHERE DB_NAME(database_id) IN ({}) ".format(sql_name_list(name_list))
+    sql += "GROUP BY database_id;"
+    file_stats = dict()
+    for row in sql_rows(sql,env,74):
+        file_stats[row['name']] = [row['writes'], row['bytes']]
+    history = env['history']
+    with history['lock']:
+        for db in db_list:
+            snapshot_db = snapshot_name(db,env)
+            if snapshot_db in file_stats:
+                history['sizes'][(env['db_server'], db)] = \
+                    file_stats[snapshot_db][1]
+    write_marks = dict()
+    for db in db_list:
+        snapshot_db = snapshot_name(db,env)
+        if db in file_stats and snapshot_db in file_stats:
+            write_marks[db] = [file_stats[db][0], file_stats[snapshot_db][1]]
+    return write_marks
+
+
+def mark_unchanged(db_list,env):
+    """Record databases as matching their snapshots (created/restored)."""
+    if db_list == []:
+        return
+    write_marks = survey_write_marks(db_list,env)
+    with env['change_marks']['lock']:
+        server_marks = server_change_marks(env)
+        for db in db_list:
+            hold_mark(server_marks,db,write_marks.get(db),env)
+        save_change_marks(env)
+
+
+def forget_marks(db_list,env,every_generation=False):
+    """Discard marks of databases (their snapshots dropped).
+
+    Only env's generation is forgotten, unless every_generation.
+    """
+    with env['change_marks']['lock']:
+        server_marks = server_change_marks(env)
+        for db in db_list:
+            if every_generation:
+                server_marks.pop(db, None)
+            else:
+                hold_mark(server_marks,db,None,env)
+        save_change_marks(env)
+
+
+def changed_databases(db_list,env):
+    """Split databases into changed and unchanged since marked.
+
+    Unmarked databases (and those without snapshot) count as changed.
+    """
+    write_marks = survey_write_marks(db_list,env)
+    with env['change_marks']['lock']:
+        server_marks = dict(server_change_marks(env))
+    changed_list = list()
+    unchanged_list = list()
+    for db in db_list:
+        if db in write_marks and \
+           held_mark(server_marks,db,env) == write_marks[db]:
+            unchanged_list.append(db)
+        else:
+            changed_list.append(db)
+    return changed_list, unchanged_list
+
+
+# snapshot freshness
+# ... generate_baseline keeps a snapshot whose source has not been written
+# ... since it was taken: judged by change marks where dbss holds them,
+# ... else (e.g. baseline interrupted before marking) by the source's
+# ... last user update (sys.dm_db_index_usage_stats) against the
+# ... snapshot's creation; those stats are emptied when the server or
+# ... database restarts, so no usage row counts as written (unknown is
+# ... stale); snapshots older than snapshot_max_age hours are stale
+# ... regardless
+def survey_snapshot_writes(db_list,env):
+    """Obtain age of databases' snapshots and whether sources were written.
+
+    Returns dictionary of database to (age in seconds, written since
+    snapshot creation), databases without snapshot are left out. A
+    source without usage stats counts as written (not known otherwise).
+    """
+    name_list = list()
+    for db in db_list:
+        name_list.append(snapshot_name(db,env))
+    sql  = "SELECT s.name, DATEDIFF(second, s.create_date, GETDATE()) AS age, "
+    sql += "CASE WHEN MAX(u.last_user_update) IS NULL "
+    sql += "OR MAX(u.last_user_update) > s.create_date "
+    sql += "THEN 1 ELSE 0 END AS written FROM sys.databases s "
+    sql += "LEFT JOIN sys.dm_db_index_usage_stats u "
+    sql += "ON u.database_id = s.source_database_id "
+    sql += "WHERE s.source_database_id IS NOT NULL "
+    sql += "AND s.name IN ({}) ".format(sql_name_list(name_list))
+    sql += "GROUP BY s.name, s.create_date;"
+    snapshot_writes = dict()
+    for row in sql_rows(sql,env,98):
+        snapshot_writes[original_db_name(row['name'],env)] = \
+            (row['age'], row['written'] == 1)
+    return snapshot_writes
+
+
+def stale_snapshots(db_list,env):
+    """Split databases into those needing a snapshot and those current.
+
+    Current snapshots found by last user update are marked (write counts
+    just surveyed), so revert_environment can skip their databases.
+    """
+    db_survey = survey_databases(env)
+    snapshot_list = list()
+    for db in db_list:
+        if snapshot_name(db,env) in db_survey:
+            snapshot_list.append(db)
+    if snapshot_list == []:
+        return list(db_list), list()
+    snapshot_writes = survey_snapshot_writes(snapshot_list,env)
+    write_marks = survey_write_marks(snapshot_list,env)
+    with env['change_marks']['lock']:
+        server_marks = dict(server_change_marks(env))
+    max_age = env['snapshot_max_age']
+    stale_list = list()
+    current_list = list()
+    unmarked_list = list()
+    for db in db_list:
+        if db not in snapshot_writes:
+            stale_list.append(db)
+            continue
+        age, written = snapshot_writes[db]
+        if max_age is not None and age > max_age * 3600:
+            stale_list.append(db)
+        elif held_mark(server_marks,db,env) is not None:
+            if held_mark(server_marks,db,env) == write_marks.get(db):
+                current_list.append(db)
+            else:
+                stale_list.append(db)
+        elif written or db not in write_marks:
+            stale_list.append(db)
+        else:
+            current_list.append(db)
+            unmarked_list.append(db)
+    if unmarked_list != []:
+        with env['change_marks']['lock']:
+            server_marks = server_change_marks(env)
+            for db in unmarked_list:
+                hold_mark(server_marks,db,write_marks[db],env)
+            save_change_marks(env)
+    return stale_list, current_list
+
+
+# snapshot plans
+# ... a snapshot's ON clause names every data file of its source, read
+# ... from sys.master_files; file layouts rarely change, so the file
+# ... list is kept in state_dir with a fingerprint of the layout, one
+# ... query per host and run checks every fingerprint of the white list,
+# ... files are read (in bulk) only for databases whose layout moved
+def new_snapshot_plans():
+    """Create empty plan cache (loaded from state_dir on first use)."""
+    plans = dict()
+    plans['servers'] = None
+    # by server, layouts checked and files prefetched this run (see
+    # ... checked_layouts)
+    plans['checked'] = dict()
+    # plans are shared by host and worker environments
+    plans['lock'] = new_lock()
+    return plans
+
+
+def snapshot_plans_file(env):
+    """Path of file holding snapshot plans of environment."""
+    import os
+    state_dir = os.path.expanduser(env['state_dir'])
+    return os.path.join(state_dir, 'plans_{}.json'.format(env['environment']))
+
+
+def server_snapshot_plans(env):
+    """Plans of env's server by database (caller holds plans lock)."""
+    plans = env['snapshot_plans']
+    if plans['servers'] is None:
+        plans['servers'] = read_state_file(snapshot_plans_file(env))
+    if env['db_server'] not in plans['servers']:
+        plans['servers'][env['db_server']] = dict()
+    return plans['servers'][env['db_server']]
+
+
+def survey_layout_fingerprints(db_list,env,testing=False):
+    """Obtain checksum of data file layout (names and paths) of databases."""
+    sql  = "SELECT DB_NAME(database_id) AS name, "
+    sql += "CHECKSUM_AGG(CHECKSUM(file_id, name, physical_name)) AS layout "
+    sql += "FROM sys.master_files WHERE type_desc<>'LOG' "
+    sql += "AND DB_NAME(database_id) IN ({}) ".format(sql_name_list(db_list))
+    sql += "GROUP BY database_id;"
     if testing:
-        # build simple create snapshot statement (example)
-        file_dir  = r"D:\Program Files\Microsoft SQL Server"
-        file_dir += r"\MSSQL10_50.MSSQLSERVER\MSSQL\DATA"
-        logical_db = db + '_Data'
-        snapshot_file = snapshot_db + '.' + snapshot_file_type
-        dbss_path = file_dir + '\\' + snapshot_file
-        sql  = "CREATE DATABASE {}".format(snapshot_db)
-        sql += "\n      "
-        sql += "ON ( NAME = {0}, FILENAME = '{1}' ) ".format(logical_db, dbss_path)
-        sql += "\n      "
-        sql += "AS SNAPSHOT OF {};".format(database)
         print('   ' + sql)
         return
-    # build real-world snapshot statement
-    # ... obtain list of database files for 'On' clause
+    fingerprints = dict()
+    for row in sql_rows(sql,env,90):
+        fingerprints[row['name']] = row['layout']
+    return fingerprints
+
+
+def checked_layouts(env):
+    """Layouts and files of env's server seen this run (caller holds lock).
+
+    Dropped once older than the catalog (see catalog_ttl).
+    """
+    plans = env['snapshot_plans']
+    checked = plans['checked'].get(env['db_server'])
+    ttl = env['catalog_ttl']
+    if checked is not None and ttl is not None \
+       and time.time() - checked['taken'] > ttl:
+        checked = None
+    if checked is None:
+        checked = dict()
+        checked['taken'] = time.time()
+        checked['layouts'] = dict()
+        checked['files'] = dict()
+        plans['checked'][env['db_server']] = checked
+    return checked
+
+
+def layout_fingerprint(db,env):
+    """Fingerprint of database's file layout (None when not found).
+
+    Checked for the whole white list of env's server at once, then
+    trusted for the run (as long as the catalog, see catalog_ttl).
+    """
+    plans = env['snapshot_plans']
+    # held while surveying, concurrent workers wait for the one query
+    with plans['lock']:
+        checked = checked_layouts(env)
+        if db not in checked['layouts']:
+            db_list = list(env['db_white_list'])
+            if db not in db_list:
+                db_list.append(db)
+            checked['layouts'] = survey_layout_fingerprints(db_list,env)
+        return checked['layouts'].get(db)
+
+
+def prefetch_datafiles(db_list,env):
+    """Survey data files of databases not yet seen this run, in one query.
+
+    Returns files of every listed database found (see survey_datafiles).
+    """
+    plans = env['snapshot_plans']
+    with plans['lock']:
+        checked = checked_layouts(env)
+        fetch_list = list()
+        for db in db_list:
+            if db not in checked['files']:
+                fetch_list.append(db)
+        if fetch_list != []:
+            checked['files'].update(survey_datafiles(fetch_list,env))
+        file_survey = dict()
+        for db in db_list:
+            if db in checked['files']:
+                file_survey[db] = checked['files'][db]
+    return file_survey
+
+
+def snapshot_files(db,env):
+    """Data files of database (name, filename), from plan when current.
+
+    Without current plan, files of every white list database lacking
+    one are prefetched together and their plans kept.
+    """
+    fingerprint = layout_fingerprint(db,env)
+    plans = env['snapshot_plans']
+    with plans['lock']:
+        server_plans = server_snapshot_plans(env)
+        layouts = checked_layouts(env)['layouts']
+        plan = server_plans.get(db)
+        if plan is not None and fingerprint is not None \
+           and plan['fingerprint'] == fingerprint:
+            return plan['files']
+        stale_list = [db]
+        for white_db in env['db_white_list']:
+            white_plan = server_plans.get(white_db)
+            if white_db != db and white_db in layouts and \
+               (white_plan is None
+                or white_plan['fingerprint'] != layouts[white_db]):
+                stale_list.append(white_db)
+    file_survey = prefetch_datafiles(stale_list,env)
+    with plans['lock']:
+        server_plans = server_snapshot_plans(env)
+        for stale_db in stale_list:
+            if stale_db not in file_survey or stale_db not in layouts:
+                continue
+            plan = dict()
+            plan['fingerprint'] = layouts[stale_db]
+            plan['files'] = list()
+            # sizes change without the layout, plans keep names only
+            for db_file in file_survey[stale_db]:
+                plan_file = dict()
+                plan_file['name'] = db_file['name']
+                plan_file['filename'] = db_file['filename']
+                plan['files'].append(plan_file)
+            server_plans[stale_db] = plan
+        write_state_file(snapshot_plans_file(env),plans['servers'])
+    return file_survey.get(db, list())
+
+
+def snapshot_statement(db,file_list,env):
+    """Build statement creating snapshot of database over its data files."""
     # adding "_dbss" to datafile name is not strictly
     # ... required as we are changing file extension
     # ... but this is a documented hack which adds
     # ... flexibility (for multiple snapshots)
     # alas, beware of case where database files
     # ... differ only by filename extension
-    file_list = survey_datafiles(db,env)
     sql_file_list = ''
     file_count = 0
     for db_file in file_list:
@@ -287,50 +1532,486 @@ def capture_database(db,env,testing=False):
             sql_file_list += ',\n'
         name = db_file['name']
         path_parts = db_file['filename'].split('.')
-        path_parts[-2] += env['snapshot_suffix']
+        path_parts[-2] += generation_suffix(env)
         if len(file_list) > 1:
             path_parts[-2] += '_' + str(file_count).zfill(2)
-        path_parts[-1] = snapshot_file_type
+        path_parts[-1] = env['snapshot_file_type']
         filename = '.'.join(path_parts)
         file_clause = "( NAME = {0}, FILENAME = '{1}' )".format(name,filename)
         sql_file_list += file_clause
-    # build sql command
-    sql  = "CREATE DATABASE {} ON".format(snapshot_db)
+    sql  = "CREATE DATABASE {} ON".format(snapshot_name(db,env))
     sql += "\n" + sql_file_list + "\n"
-    sql += "AS SNAPSHOT OF {};".format(database)
-    sql_command(sql,env,86)
+    sql += "AS SNAPSHOT OF {};".format(db)
+    return sql
 
 
-def restore_database(db,env,testing=False):
-    """Revert database to snapshot (core SQL command)."""
-    dbss = snapshot_name(db,env)
-    sql  = "USE master; "
-    sql += "RESTORE DATABASE {0} FROM DATABASE_SNAPSHOT = '{1}';".format(db,dbss)
-    if testing:
-        print('   ' + sql)
-        return
-    sql_command(sql,env,87)
+# operation history
+# ... creates, restores, drops and kills are recorded (environment,
+# ... database, seconds, snapshot size, exit code) and kept in SQLite
+# ... in state_dir; records gather in env during a run and are written
+# ... at its end (see save_history), snapshot sizes are those last
+# ... surveyed (see survey_write_marks), so recording costs no queries;
+# ... batched and server-side runs record each database with the whole
+# ... batch's seconds, flagged batched and left out of expected durations
+def new_history():
+    """Create empty history buffer (written to state_dir by save_history)."""
+    history = dict()
+    history['records'] = list()
+    # snapshot bytes by (server, database) as last surveyed
+    history['sizes'] = dict()
+    # buffer is shared by host and worker environments
+    history['lock'] = new_lock()
+    return history
 
 
-def drop_database(db,env,testing=False):
-    """Drop database (core SQL command, restricted to snapshots)."""
-    # WARNING: destructive! command handler filters to be sure
-    # ... only called on snapshot databases, but we add a
-    # ... safety check -- remove if it hampers reuse
-    sql = 'DROP DATABASE {};'.format(db)
-    if testing:
-        print('   ' + sql)
+def history_file(env):
+    """Path of operation history database (all environments)."""
+    import os
+    return os.path.join(os.path.expanduser(env['state_dir']),
+                        'history.sqlite')
+
+
+def record_history(operation,db,env,started,outcome,batched=False):
+    """Record operation on database, started at time, with exit code."""
+    if not env['keep_history']:
         return
-    quiet_mode = env['quiet_mode']
-    if not is_snapshot(db,env):
-        message = "Request to drop {}, only snapshots may be dropped."\
-                  .format(db)
+    record = dict()
+    record['started'] = started
+    record['environment'] = env['environment']
+    record['server'] = env['db_server']
+    record['operation'] = operation
+    record['database'] = db
+    record['generation'] = env['snapshot_generation']
+    record['seconds'] = time.time() - started
+    record['outcome'] = outcome
+    record['batched'] = batched
+    history = env['history']
+    with history['lock']:
+        record['bytes'] = history['sizes'].get((env['db_server'], db))
+        history['records'].append(record)
+
+
+class RecordedBlock(object):
+    """History record around with-block (see recorded)."""
+
+    def __init__(self,operation,db,env):
+        self.operation = operation
+        self.db = db
+        self.env = env
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        outcome = 0
+        if exc_type is not None and issubclass(exc_type, SystemExit):
+            outcome = exc_value.code
+        elif exc_type is not None:
+            outcome = 1
+        record_history(self.operation,self.db,self.env,self.started,outcome)
+        return False
+
+
+def recorded(operation,db,env):
+    """Record block in history, exit code of sys.exit as outcome."""
+    return RecordedBlock(operation,db,env)
+
+
+def record_batch(operation,outcomes,env,started):
+    """Record each database of a batch with its exit code."""
+    for db in outcomes:
+        record_history(operation,db,env,started,outcomes[db],True)
+
+
+def open_history(path):
+    """Connect to history database, creating its table when new."""
+    import sqlite3
+    connection = sqlite3.connect(path, timeout=10)
+    connection.execute("CREATE TABLE IF NOT EXISTS history "
+                       "(started REAL, environment TEXT, "
+                       "server TEXT, operation TEXT, database TEXT, "
+                       "generation TEXT, seconds REAL, "
+                       "bytes INTEGER, outcome INTEGER, "
+                       "batched INTEGER)")
+    connection.execute("CREATE INDEX IF NOT EXISTS history_database "
+                       "ON history (environment, operation, "
+                       "database)")
+    return connection
+
+
+def save_history(env):
+    """Write buffered records to history database (failure only warned)."""
+    history = env['history']
+    with history['lock']:
+        record_list = history['records']
+        history['records'] = list()
+        for record in record_list:
+            if record['bytes'] is None:
+                key = (record['server'], record['database'])
+                record['bytes'] = history['sizes'].get(key)
+    if record_list == []:
+        return
+    import os
+    import sqlite3
+    path = history_file(env)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        connection = open_history(path)
+        try:
+            row_list = list()
+            for record in record_list:
+                row_list.append((record['started'], record['environment'],
+                                 record['server'], record['operation'],
+                                 record['database'], record['generation'],
+                                 record['seconds'], record['bytes'],
+                                 record['outcome'], int(record['batched'])))
+            connection.executemany("INSERT INTO history VALUES "
+                                   "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row_list)
+            connection.commit()
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError, IOError) as e:
+        sys.stderr.write("dbss -- history not saved ({})\n".format(e))
+
+
+def read_history(env,operation=None,db_list=None):
+    """Read history records of environment, oldest first.
+
+    Returns an empty list when no history has been kept yet.
+    """
+    import os
+    path = history_file(env)
+    if not os.path.exists(path):
+        return list()
+    sql  = "SELECT started, server, operation, database, generation, "
+    sql += "seconds, bytes, outcome, batched FROM history "
+    sql += "WHERE environment = ?"
+    parameters = [env['environment']]
+    if operation is not None:
+        sql += " AND operation = ?"
+        parameters.append(operation)
+    if db_list is not None:
+        sql += " AND database IN ({})".format(', '.join('?' * len(db_list)))
+        parameters.extend(db_list)
+    sql += " ORDER BY started"
+    record_list = list()
+    connection = open_history(path)
+    try:
+        for row in connection.execute(sql, parameters):
+            record = dict()
+            record['started'] = row[0]
+            record['server'] = row[1]
+            record['operation'] = row[2]
+            record['database'] = row[3]
+            record['generation'] = row[4]
+            record['seconds'] = row[5]
+            record['bytes'] = row[6]
+            record['outcome'] = row[7]
+            record['batched'] = bool(row[8])
+            record_list.append(record)
+    finally:
+        connection.close()
+    return record_list
+
+
+def percentile(value_list,percent):
+    """Nearest-rank percentile of values."""
+    ordered = sorted(value_list)
+    rank = int(-(-percent * len(ordered) // 100))
+    return ordered[max(rank, 1) - 1]
+
+
+def expected_durations(db_list,operation,env):
+    """Median seconds of recent successful runs of operation, by database.
+
+    Databases without history (on env's server) are left out, batched
+    runs count for none (their seconds are the whole batch's).
+    """
+    import sqlite3
+    try:
+        record_list = read_history(env,operation,db_list)
+    except sqlite3.Error:
+        return dict()
+    durations = dict()
+    for record in record_list:
+        if record['outcome'] != 0 or record['server'] != env['db_server']:
+            continue
+        if record['batched']:
+            continue
+        durations.setdefault(record['database'], list()).append(
+            record['seconds'])
+    expected = dict()
+    for db in durations:
+        # recent runs only, servers and data change
+        expected[db] = percentile(durations[db][-env['history_runs']:], 50)
+    return expected
+
+
+# snapshot growth
+# ... each source page written after capture is copied into the
+# ... snapshot's sparse files, so snapshots grow as tests run (and
+# ... restores take longer); bloated snapshots are refreshed from
+# ... the baseline (source restored first when changed)
+def survey_snapshot_sizes(db_list,env):
+    """Obtain on-disk size of snapshots and data size of sources (bytes).
+
+    Returns dictionary of database to [snapshot bytes, source bytes],
+    databases without snapshot are left out.
+    """
+    name_list = list()
+    for db in db_list:
+        name_list.append(db)
+        name_list.append(snapshot_name(db,env))
+    # log files left out by type, as in file layouts (snapshots have none)
+    sql  = "SELECT DB_NAME(f.database_id) AS name, "
+    sql += "SUM(f.size_on_disk_bytes) AS bytes "
+    sql += "FROM sys.dm_io_virtual_file_stats(NULL, NULL) f "
+    sql += "JOIN sys.master_files m ON m.database_id = f.database_id "
+    sql += "AND m.file_id = f.file_id "
+    sql += "WHERE m.type_desc<>'LOG' AND DB_NAME(f.database_id) IN ({}) "\
+           .format(sql_name_list(name_list))
+    sql += "GROUP BY f.database_id;"
+    file_sizes = dict()
+    for row in sql_rows(sql,env,75):
+        file_sizes[row['name']] = row['bytes']
+    snapshot_sizes = dict()
+    for db in db_list:
+        snapshot_db = snapshot_name(db,env)
+        if db in file_sizes and snapshot_db in file_sizes:
+            snapshot_sizes[db] = [file_sizes[snapshot_db], file_sizes[db]]
+    return snapshot_sizes
+
+
+def bloat_ratio(sizes):
+    """Ratio of snapshot size to source size."""
+    snapshot_bytes, source_bytes = sizes
+    if source_bytes == 0:
+        return 0.0
+    return float(snapshot_bytes) / source_bytes
+
+
+def refresh_snapshot(db,env):
+    """Recreate snapshot from baseline, restoring source first if changed.
+
+    Returns False, leaving all be, when the database holds generations a
+    restore would drop (see generations_in_way).
+    """
+    with traced('operation','refresh_snapshot',env,db):
+        if generations_in_way(db,env) != []:
+            return False
+        changed_list, unchanged_list = changed_databases([db],env)
+        if changed_list != []:
+            restore_snapshot(db,env)
+        create_snapshot(db,env)
+        mark_unchanged([db],env)
+        return True
+
+
+# generation retention
+# ... every snapshot is another copy-on-write target for each write to
+# ... its source, so generations beyond the environment's limits (count,
+# ... total sparse size, age; none set by default) are evicted, oldest
+# ... first; the baseline and the generation just created are kept
+def survey_generations(env):
+    """Obtain snapshots of white list databases with age and size.
+
+    Returns list of dictionaries (name, db, generation, age in seconds,
+    bytes on disk), oldest first.
+    """
+    sql  = "SELECT d.name, DATEDIFF(second, d.create_date, GETDATE()) AS age, "
+    sql += "SUM(f.size_on_disk_bytes) AS bytes FROM sys.databases d "
+    sql += "JOIN sys.dm_io_virtual_file_stats(NULL, NULL) f "
+    sql += "ON f.database_id = d.database_id "
+    sql += "WHERE d.source_database_id IS NOT NULL "
+    sql += "AND d.name LIKE '%{}%' ".format(sql_like_literal(env['snapshot_suffix']))
+    sql += "GROUP BY d.name, d.create_date;"
+    generation_list = list()
+    for row in sql_rows(sql,env,76):
+        db = original_db_name(row['name'],env)
+        if db not in env['db_white_list']:
+            continue
+        generation = dict()
+        generation['name'] = row['name']
+        generation['db'] = db
+        generation['generation'] = snapshot_generation(row['name'],env)
+        generation['age'] = row['age']
+        generation['bytes'] = row['bytes']
+        generation_list.append(generation)
+    aged_list = list()
+    for generation in generation_list:
+        aged_list.append((-generation['age'], generation['name'], generation))
+    aged_list.sort()
+    generation_list = list()
+    for age, name, generation in aged_list:
+        generation_list.append(generation)
+    return generation_list
+
+
+def generation_evictions(generation_list,env):
+    """List generations to evict under environment's retention limits.
+
+    Returns (snapshot name, reason) pairs, generation_list holds one
+    database's generations, oldest first.
+    """
+    max_count = env['generation_max_count']
+    max_bytes = env['generation_max_bytes']
+    max_age = env['generation_max_age']
+    kept_list = list(generation_list)
+    candidate_list = list()
+    for generation in generation_list:
+        if generation['generation'] not in (BASELINE_GENERATION,
+                                             env['snapshot_generation']):
+            candidate_list.append(generation)
+    eviction_list = list()
+
+    def evict(generation,reason):
+        kept_list.remove(generation)
+        candidate_list.remove(generation)
+        eviction_list.append((generation['name'], reason))
+
+    if max_age is not None:
+        for generation in list(candidate_list):
+            if generation['age'] > max_age * 3600:
+                evict(generation,'older than {} hours'.format(max_age))
+    while max_count is not None and len(kept_list) > max_count and \
+          candidate_list != []:
+        evict(candidate_list[0],'over {} generations'.format(max_count))
+    while max_bytes is not None and candidate_list != []:
+        total_bytes = 0
+        for generation in kept_list:
+            total_bytes += generation['bytes']
+        if total_bytes <= max_bytes:
+            break
+        evict(candidate_list[0],'over {:.0f} MB of snapshots'\
+                                .format(max_bytes / 1048576.0))
+    return eviction_list
+
+
+def apply_retention(db_list,env):
+    """Evict generations of databases beyond retention limits."""
+    if env['generation_max_count'] is None and \
+       env['generation_max_bytes'] is None and \
+       env['generation_max_age'] is None:
+        return []
+    with traced('operation','apply_retention',env):
+        by_database = dict()
+        for generation in survey_generations(env):
+            db = generation['db']
+            if db not in by_database:
+                by_database[db] = list()
+            by_database[db].append(generation)
+        eviction_list = list()
+        for db in db_list:
+            eviction_list.extend(generation_evictions(
+                by_database.get(db, list()),env))
+        for dbss, reason in eviction_list:
+            if not env['quiet_mode']:
+                print('Evicting generation {0} ({1}).'.format(dbss,reason))
+            destroy_snapshot(dbss,env)
+        return eviction_list
+
+
+def capture_database(db,env,testing=False):
+    """Create snapshot of database (core SQL command)."""
+    snapshot_db = snapshot_name(db,env)
+    snapshot_file_type = env['snapshot_file_type']
+    if testing:
+        # real statement when a plan was kept for the database
+        with env['snapshot_plans']['lock']:
+            plan = server_snapshot_plans(env).get(db)
+        if plan is not None:
+            print('   ' + snapshot_statement(db,plan['files'],env))
+            return
+        # build simple create snapshot statement (example)
+        file_dir  = r"D:\Program Files\Microsoft SQL Server"
+        file_dir += r"\MSSQL10_50.MSSQLSERVER\MSSQL\DATA"
+        logical_db = db + '_Data'
+        snapshot_file = snapshot_db + '.' + snapshot_file_type
+        dbss_path = file_dir + '\\' + snapshot_file
+        sql  = "CREATE DATABASE {}".format(snapshot_db)
+        sql += "\n      "
+        sql += "ON ( NAME = {0}, FILENAME = '{1}' ) ".format(logical_db, dbss_path)
+        sql += "\n      "
+        sql += "AS SNAPSHOT OF {};".format(db)
+        print('   ' + sql)
+        return
+    # build real-world snapshot statement
+    # ... list of database files for 'On' clause (see snapshot plans)
+    file_list = snapshot_files(db,env)
+    sql = snapshot_statement(db,file_list,env)
+    sql_command(sql,env,86)
+    catalog_update(snapshot_db,'ONLINE',env)
+
+
+def restore_statement(db,env):
+    """Build statement reverting database to its snapshot."""
+    dbss = snapshot_name(db,env)
+    sql = "RESTORE DATABASE {0} FROM DATABASE_SNAPSHOT = '{1}';".format(db,dbss)
+    if env['restore_eviction'] == 'single_user':
+        # roll back other sessions at once (no lock wait), and leave
+        # ... database MULTI_USER whether or not the restore succeeds
+        restore_sql = sql
+        sql  = "ALTER DATABASE {} SET SINGLE_USER ".format(db)
+        sql += "WITH ROLLBACK IMMEDIATE;\n"
+        sql += "BEGIN TRY\n"
+        sql += "   " + restore_sql + "\n"
+        sql += "END TRY\n"
+        sql += "BEGIN CATCH\n"
+        sql += "   ALTER DATABASE {} SET MULTI_USER;\n".format(db)
+        # variable named per database, batches may hold several
+        sql += "   DECLARE @dbss_error_{} nvarchar(2048) = ERROR_MESSAGE();\n"\
+               .format(db)
+        # message passed as argument, a % in it is not a format
+        sql += "   RAISERROR(N'%s', 16, 1, @dbss_error_{});\n".format(db)
+        sql += "END CATCH\n"
+        sql += "ALTER DATABASE {} SET MULTI_USER;".format(db)
+    return sql
+
+
+def drop_statement(db):
+    """Build statement dropping database."""
+    sql = 'DROP DATABASE {};'.format(db)
+    return sql
+
+
+def restore_database(db,env,testing=False):
+    """Revert database to snapshot (core SQL command)."""
+    sql  = "USE master; "
+    sql += restore_statement(db,env)
+    if testing:
+        print('   ' + sql)
+        return
+    sql_command(sql,env,87)
+    catalog_update(db,'ONLINE',env)
+
+
+def drop_database(db,env,testing=False):
+    """Drop database (core SQL command, restricted to snapshots)."""
+    # WARNING: destructive! command handler filters to be sure
+    # ... only called on snapshot databases, but we add a
+    # ... safety check -- remove if it hampers reuse
+    sql = drop_statement(db)
+    if testing:
+        print('   ' + sql)
+        return
+    quiet_mode = env['quiet_mode']
+    if not is_snapshot(db,env):
+        message = "Request to drop {}, only snapshots may be dropped."\
+                  .format(db)
         if not quiet_mode:
             print('Command failed: {}'.format(message))
         else:
             sys.stderr.write("dbss -- {}".format(message))
         sys.exit(84)
-    sql_command(sql,env,88)
+    # recorded against source database (and generation dropped)
+    history_env = dict(env)
+    history_env['snapshot_generation'] = snapshot_generation(db,env)
+    with recorded('drop_database',original_db_name(db,env),history_env):
+        sql_command(sql,env,88)
+    catalog_update(db,None,env)
 
 
 def drop_snapshot(db,env,testing=False):
@@ -341,140 +2022,1468 @@ def drop_snapshot(db,env,testing=False):
 
 def create_snapshot(db,env):
     """Create database snapshot."""
-    # open question, what happens when you create snapshot
-    # ... and one already exists? chose certainty
-    quiet_mode = env['quiet_mode']
+    with traced('operation','create_snapshot',env,db), \
+         recorded('create_snapshot',db,env):
+        # open question, what happens when you create snapshot
+        # ... and one already exists? chose certainty
+        # ... (DDL failures exit in sql_command, generate_baseline
+        # ... verifies every create with one catalog refresh)
+        quiet_mode = env['quiet_mode']
+        snapshot_db = snapshot_name(db,env)
+        if database_exists(snapshot_db,env):
+            drop_database(snapshot_db,env)
+        # check datbase status
+        db_survey = survey_databases(env)
+        db_status = db_survey[db]
+        if db_status != 'ONLINE':
+            message = "Database '{0}' is '{1}', status must be ONLINE for snapshot."\
+                      .format(db,db_status)
+            if not quiet_mode:
+                print('Command failed: {}'.format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(77)
+        # create snapshot
+        capture_database(db,env)
+
+
+def restore_snapshot(db,env):
+    """Revert database to snapshot."""
+    with traced('operation','restore_snapshot',env,db), \
+         recorded('restore_snapshot',db,env):
+        quiet_mode = env['quiet_mode']
+        snapshot_db = snapshot_name(db,env)
+        if not database_exists(snapshot_db,env):
+            message = 'Snapshot {0} does not exist in {1}.'\
+                      .format(snapshot_db,env['environment'])
+            if not quiet_mode:
+                print('Command failed: {}'.format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(11)
+        # check datbase status
+        db_survey = survey_databases(env)
+        db_status = db_survey[db]
+        if db_status != 'ONLINE':
+            message = "Database '{0}' is '{1}', status must be ONLINE for restore."\
+                      .format(db,db_status)
+            if not quiet_mode:
+                print('Command failed: {}'.format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(78)
+        # server reverts only with a single snapshot of database
+        dbss_list = generations_in_way(db,env)
+        if dbss_list != []:
+            message = generations_message(db,dbss_list)
+            if not quiet_mode:
+                print('Command failed: {}'.format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(17)
+        for dbss in other_generations(db,env):
+            if not quiet_mode:
+                print('Dropping generation {0} (reverting to {1}).'\
+                      .format(dbss,snapshot_db))
+            drop_database(dbss,env)
+        if env['restore_eviction'] == 'kill':
+            kill_connections(env,[db])
+        # revert db to snapshot
+        restore_database(db,env)
+
+
+def other_generations(db,env):
+    """List snapshots of database other than env's generation (catalog)."""
     snapshot_db = snapshot_name(db,env)
-    if database_exists(snapshot_db,env):
-        drop_database(snapshot_db,env)
-    if database_exists(snapshot_db,env):
-        message = 'Snapshot {} could not be dropped (for replacement).'\
-                  .format(snapshot_db)
-        if not quiet_mode:
-            print('Command failed: {}'.format(message))
+    dbss_list = list()
+    for name in sorted(survey_databases(env)):
+        if is_snapshot(name,env) and name != snapshot_db and \
+           original_db_name(name,env) == db:
+            dbss_list.append(name)
+    return dbss_list
+
+
+def generations_in_way(db,env):
+    """Other generations a restore of database would drop, unless allowed."""
+    if env['drop_generations']:
+        return []
+    return other_generations(db,env)
+
+
+def generations_message(db,dbss_list):
+    """Explain restore refused for generations it would drop."""
+    return "Database {0} holds other generations ({1}), restore would drop "\
+           "them (--drop-generations to allow)".format(db, ', '.join(dbss_list))
+
+
+def destroy_snapshot(dbss,env):
+    """Drop snapshot database (failure exits, see sql_command)."""
+    with traced('operation','destroy_snapshot',env,dbss):
+        drop_database(dbss,env)
+
+
+# batched execution
+# ... one T-SQL batch per environment operation, each statement in its
+# ... own TRY/CATCH so one failure does not abort the rest, outcomes
+# ... come back as a single result set (one row per database)
+def sql_batch(statement_list,env,err_code):
+    """Execute (database, statement) pairs as one batch, return errors.
+
+    Returns dictionary of database to (error number, error message),
+    error number is 0 where the statement succeeded.
+    """
+    sql  = "SET NOCOUNT ON; USE master;\n"
+    sql += "DECLARE @dbss_result TABLE "
+    sql += "(name sysname, error_number int, error_message nvarchar(2048));\n"
+    for db, statement in statement_list:
+        sql += "BEGIN TRY\n"
+        sql += "   " + statement + "\n"
+        sql += "   INSERT INTO @dbss_result VALUES ('{}', 0, NULL);\n"\
+               .format(db)
+        sql += "END TRY\n"
+        sql += "BEGIN CATCH\n"
+        sql += "   INSERT INTO @dbss_result "
+        sql += "VALUES ('{}', ERROR_NUMBER(), ERROR_MESSAGE());\n".format(db)
+        sql += "END CATCH\n"
+    sql += "SELECT name, error_number, error_message FROM @dbss_result;"
+    batch_result = dict()
+    query_result = sql_query(sql,env,err_code)
+    for row in query_result:
+        batch_result[row['name']] = (row['error_number'], row['error_message'])
+    return batch_result
+
+
+def batch_failure(db,message,env):
+    """Narrate failure of one database within a batch."""
+    if not env['quiet_mode']:
+        print('Command failed: {0}: {1}'.format(db,message))
+    else:
+        sys.stderr.write("dbss -- {0}: {1}\n".format(db,message))
+
+
+def restore_snapshots_batch(db_list,env):
+    """Revert databases to snapshots in one batch, return exit codes."""
+    with traced('operation','restore_snapshots_batch',env):
+        started = time.time()
+        outcomes = dict()
+        statement_list = list()
+        # check snapshots and database status (one catalog read)
+        db_survey = survey_databases(env)
+        for db in db_list:
+            snapshot_db = snapshot_name(db,env)
+            if snapshot_db not in db_survey:
+                batch_failure(db,'Snapshot {} does not exist'.format(snapshot_db),env)
+                outcomes[db] = 11
+            elif db_survey.get(db) != 'ONLINE':
+                batch_failure(db,"status is '{}', must be ONLINE for restore"\
+                              .format(db_survey.get(db)),env)
+                outcomes[db] = 78
+            elif generations_in_way(db,env) != []:
+                batch_failure(db,generations_message(
+                    db,generations_in_way(db,env)),env)
+                outcomes[db] = 17
+            else:
+                # server reverts only with a single snapshot of database
+                statement = ''
+                for dbss in other_generations(db,env):
+                    statement += drop_statement(dbss) + '\n'
+                statement += restore_statement(db,env)
+                statement_list.append((db, statement))
+        if statement_list == []:
+            record_batch('restore_snapshot',outcomes,env,started)
+            return outcomes
+        if env['restore_eviction'] == 'kill':
+            evict_list = list()
+            for db, statement in statement_list:
+                evict_list.append(db)
+            kill_connections(env,evict_list)
+        batch_result = sql_batch(statement_list,env,87)
+        # verify server state (one catalog read)
+        db_survey = survey_databases(env,refresh=True)
+        for db, statement in statement_list:
+            error_number, error_message = batch_result.get(db, (-1, 'no result'))
+            if error_number != 0:
+                batch_failure(db,error_message,env)
+                outcomes[db] = 87
+            elif db_survey.get(db) != 'ONLINE':
+                batch_failure(db,"status is '{}' after restore"\
+                              .format(db_survey.get(db)),env)
+                outcomes[db] = 87
+            else:
+                outcomes[db] = 0
+        record_batch('restore_snapshot',outcomes,env,started)
+        return outcomes
+
+
+def drop_snapshots_batch(dbss_list,env):
+    """Drop snapshot databases in one batch, return exit codes."""
+    with traced('operation','drop_snapshots_batch',env):
+        started = time.time()
+        outcomes = dict()
+        statement_list = list()
+        for dbss in dbss_list:
+            # same safety check as drop_database
+            if not is_snapshot(dbss,env):
+                batch_failure(dbss,'only snapshots may be dropped',env)
+                outcomes[dbss] = 84
+            else:
+                statement_list.append((dbss, drop_statement(dbss)))
+        if statement_list == []:
+            return outcomes
+        batch_result = sql_batch(statement_list,env,88)
+        # verify server state (one catalog read)
+        db_survey = survey_databases(env,refresh=True)
+        for dbss, statement in statement_list:
+            error_number, error_message = batch_result.get(dbss, (-1, 'no result'))
+            if error_number != 0:
+                batch_failure(dbss,error_message,env)
+                outcomes[dbss] = 88
+            elif dbss in db_survey:
+                batch_failure(dbss,'Snapshot could not be dropped',env)
+                outcomes[dbss] = 80
+            else:
+                outcomes[dbss] = 0
+        # recorded as drop_database is, against source database (and
+        # ... generation dropped)
+        for dbss, statement in statement_list:
+            history_env = dict(env)
+            history_env['snapshot_generation'] = snapshot_generation(dbss,env)
+            record_history('drop_database',original_db_name(dbss,env),
+                           history_env,started,outcomes[dbss],True)
+        return outcomes
+
+
+# server-side execution
+# ... 'install' puts procedure dbss_environment in master, which does per
+# ... database what create_snapshot, restore_snapshot and clean_slate do
+# ... from here (ONLINE checks, file clauses as snapshot_statement builds
+# ... them, other generations dropped before restore, eviction), so an
+# ... environment operation costs one round trip per host
+def procedure_definition():
+    """Build CREATE PROCEDURE statement of dbss server-side procedure.
+
+    Generation retention is left to the caller, as for a create from
+    here (generate_baseline applies it to the databases created).
+    """
+    sql = """CREATE PROCEDURE dbo.{0}
+   @operation nvarchar(16),
+   @databases nvarchar(max),
+   @suffix sysname,
+   @file_type sysname,
+   @evict nvarchar(16) = N'none'
+AS
+BEGIN
+   -- dbss {1}: create, restore or drop snapshots of listed databases
+   -- ... (comma separated), one result row per database, error_number
+   -- ... 0 where it succeeded
+   SET NOCOUNT ON;
+   DECLARE @result TABLE
+      (name sysname, error_number int, error_message nvarchar(2048));
+   DECLARE @list nvarchar(max) = @databases + N',';
+   DECLARE @db sysname, @dbss sysname, @state nvarchar(60);
+   DECLARE @sql nvarchar(max), @message nvarchar(2048);
+   DECLARE @position int, @file_count int;
+   WHILE LEN(@list) > 0
+   BEGIN
+      SET @position = CHARINDEX(N',', @list);
+      SET @db = LTRIM(RTRIM(LEFT(@list, @position - 1)));
+      SET @list = SUBSTRING(@list, @position + 1, LEN(@list));
+      IF @db = N'' CONTINUE;
+      SET @dbss = @db + @suffix;
+      SET @message = NULL;
+      BEGIN TRY
+         SET @state = NULL;
+         SELECT @state = state_desc FROM sys.databases WHERE name = @db;
+         SET @state = ISNULL(@state, N'missing');
+         IF @operation IN (N'create', N'restore') AND @state <> N'ONLINE'
+            RAISERROR(N'Database ''%s'' is ''%s'', status must be ONLINE',
+                      16, 1, @db, @state);
+         IF @operation = N'create'
+         BEGIN
+            IF DB_ID(@dbss) IS NOT NULL
+            BEGIN
+               SET @sql = N'DROP DATABASE ' + QUOTENAME(@dbss) + N';';
+               EXEC (@sql);
+            END
+            -- file name gains suffix (and number when several files),
+            -- ... extension becomes file type
+            SELECT @file_count = COUNT(*) FROM sys.master_files
+            WHERE database_id = DB_ID(@db) AND type_desc <> N'LOG';
+            SET @sql = STUFF((
+               SELECT N',' + CHAR(10) + N'( NAME = ' + name
+                  + N', FILENAME = '''
+                  + LEFT(physical_name, LEN(physical_name)
+                         - CHARINDEX(N'.', REVERSE(physical_name)))
+                  + @suffix
+                  + CASE WHEN @file_count > 1
+                         THEN N'_' + RIGHT(N'0'
+                              + CAST(file_number AS nvarchar(10)), 2)
+                         ELSE N'' END
+                  + N'.' + @file_type + N''' )'
+               FROM (SELECT name, physical_name,
+                            ROW_NUMBER() OVER (ORDER BY file_id)
+                            AS file_number
+                     FROM sys.master_files
+                     WHERE database_id = DB_ID(@db)
+                     AND type_desc <> N'LOG') AS data_files
+               ORDER BY file_number
+               FOR XML PATH(''), TYPE).value('.', 'nvarchar(max)'), 1, 1, N'');
+            SET @sql = N'CREATE DATABASE ' + @dbss + N' ON' + @sql
+                     + CHAR(10) + N'AS SNAPSHOT OF ' + @db + N';';
+            EXEC (@sql);
+            IF DB_ID(@dbss) IS NULL
+               RAISERROR(N'Snapshot %s could not be created', 16, 1, @dbss);
+         END
+         ELSE IF @operation = N'restore'
+         BEGIN
+            IF DB_ID(@dbss) IS NULL
+               RAISERROR(N'Snapshot %s does not exist', 16, 1, @dbss);
+            -- server reverts only with a single snapshot of database
+            SET @sql = (SELECT N'DROP DATABASE ' + QUOTENAME(name) + N';'
+                        FROM sys.databases
+                        WHERE source_database_id = DB_ID(@db)
+                        AND name <> @dbss
+                        FOR XML PATH(''), TYPE).value('.', 'nvarchar(max)');
+            IF @sql <> N'' EXEC (@sql);
+            IF @evict = N'kill'
+            BEGIN
+               SET @sql = (SELECT N'KILL ' + CAST(spid AS nvarchar(10)) + N';'
+                           FROM master.dbo.sysprocesses
+                           WHERE dbid = DB_ID(@db) AND spid > 50
+                           AND spid <> @@SPID
+                           FOR XML PATH(''), TYPE).value('.', 'nvarchar(max)');
+               IF @sql <> N'' EXEC (@sql);
+            END
+            IF @evict = N'single_user'
+            BEGIN
+               SET @sql = N'ALTER DATABASE ' + QUOTENAME(@db)
+                        + N' SET SINGLE_USER WITH ROLLBACK IMMEDIATE;';
+               EXEC (@sql);
+            END
+            BEGIN TRY
+               SET @sql = N'RESTORE DATABASE ' + QUOTENAME(@db)
+                        + N' FROM DATABASE_SNAPSHOT = ''' + @dbss + N''';';
+               EXEC (@sql);
+            END TRY
+            BEGIN CATCH
+               SET @message = ERROR_MESSAGE();
+            END CATCH
+            -- database back to its users, restored or not
+            IF @evict = N'single_user'
+            BEGIN
+               SET @sql = N'ALTER DATABASE ' + QUOTENAME(@db)
+                        + N' SET MULTI_USER;';
+               EXEC (@sql);
+            END
+            -- message as argument, a % in it is not a format
+            IF @message IS NOT NULL
+               RAISERROR(N'%s', 16, 1, @message);
+            SELECT @state = state_desc FROM sys.databases WHERE name = @db;
+            IF @state <> N'ONLINE'
+               RAISERROR(N'Database %s is ''%s'' after restore',
+                         16, 1, @db, @state);
+         END
+         ELSE IF @operation = N'drop'
+         BEGIN
+            -- every generation, snapshots named by suffix
+            SET @sql = (SELECT N'DROP DATABASE ' + QUOTENAME(name) + N';'
+                        FROM sys.databases
+                        WHERE source_database_id = DB_ID(@db)
+                        AND name LIKE REPLACE(@dbss, N'_', N'[_]') + N'%'
+                        FOR XML PATH(''), TYPE).value('.', 'nvarchar(max)');
+            IF @sql <> N'' EXEC (@sql);
+            IF EXISTS (SELECT 1 FROM sys.databases
+                       WHERE source_database_id = DB_ID(@db)
+                       AND name LIKE REPLACE(@dbss, N'_', N'[_]') + N'%')
+               RAISERROR(N'Snapshots of %s could not be dropped', 16, 1, @db);
+         END
+         ELSE
+            RAISERROR(N'Operation %s unknown', 16, 1, @operation);
+         INSERT INTO @result VALUES (@db, 0, NULL);
+      END TRY
+      BEGIN CATCH
+         INSERT INTO @result VALUES (@db, ERROR_NUMBER(), ERROR_MESSAGE());
+      END CATCH
+   END
+   SELECT name, error_number, error_message FROM @result;
+END""".format(SERVER_PROCEDURE, VERSION)
+    return sql
+
+
+def install_procedure(env):
+    """Install (or replace) dbss procedure in master of env's server."""
+    with traced('operation','install_procedure',env):
+        sql  = "USE master; "
+        sql += "IF OBJECT_ID('dbo.{}', 'P') IS NOT NULL "\
+               .format(SERVER_PROCEDURE)
+        sql += "DROP PROCEDURE dbo.{};".format(SERVER_PROCEDURE)
+        sql_command(sql,env,96)
+        # CREATE PROCEDURE must be the only statement in its batch
+        sql_command(procedure_definition(),env,96)
+
+
+def procedure_statement(operation,db_list,env):
+    """Build call of dbss procedure for operation on databases."""
+    suffix = generation_suffix(env)
+    if operation == 'drop':
+        # every generation of the databases goes
+        suffix = env['snapshot_suffix']
+    sql  = "EXEC master.dbo.{} ".format(SERVER_PROCEDURE)
+    sql += "@operation = N'{}', ".format(operation)
+    sql += "@databases = N'{}', ".format(','.join(db_list))
+    sql += "@suffix = N'{}', ".format(suffix)
+    sql += "@file_type = N'{}', ".format(env['snapshot_file_type'])
+    sql += "@evict = N'{}';".format(env['restore_eviction'])
+    return sql
+
+
+def call_procedure(operation,db_list,env):
+    """Run operation on server by dbss procedure, return exit codes.
+
+    Failing databases get the exit code the same failure has when run
+    from here (create 82, restore 87, drop 88). Databases holding
+    generations a restore would drop are not sent (17).
+    """
+    err_code = {'create': 82, 'restore': 87, 'drop': 88}[operation]
+    history_operation = {'create': 'create_snapshot',
+                         'restore': 'restore_snapshot',
+                         'drop': 'drop_database'}[operation]
+    with traced('operation','{}_procedure'.format(operation),env):
+        started = time.time()
+        outcomes = dict()
+        procedure_list = list()
+        for db in db_list:
+            dbss_list = list()
+            if operation == 'restore':
+                dbss_list = generations_in_way(db,env)
+            if dbss_list != []:
+                batch_failure(db,generations_message(db,dbss_list),env)
+                outcomes[db] = 17
+            else:
+                procedure_list.append(db)
+        procedure_result = dict()
+        if procedure_list != []:
+            sql = procedure_statement(operation,procedure_list,env)
+            for row in sql_query(sql,env,97):
+                procedure_result[row['name']] = (row['error_number'],
+                                                 row['error_message'])
+            # server changed catalog out of sight of the cache
+            catalog_invalidate(env)
+        for db in procedure_list:
+            error_number, error_message = procedure_result.get(db, (-1, 'no result'))
+            if error_number != 0:
+                batch_failure(db,error_message,env)
+                outcomes[db] = err_code
+            else:
+                outcomes[db] = 0
+        history_env = env
+        if operation == 'drop':
+            # every generation of the databases went
+            history_env = dict(env)
+            history_env['snapshot_generation'] = None
+        record_batch(history_operation,outcomes,history_env,started)
+        return outcomes
+
+
+# database hosts
+# ... an environment may spread its white list over several servers
+# ... (db_hosts), each host gets a view of env with its own session
+# ... and catalog; environment commands fan out, one thread per host
+def database_host(db,env):
+    """Name server holding database."""
+    return env['db_hosts'].get(db, env['db_server'])
+
+
+def database_hosts(env):
+    """List servers holding white list databases, db_server first."""
+    host_list = list()
+    for db in env['db_white_list']:
+        server = database_host(db,env)
+        if server not in host_list:
+            host_list.append(server)
+    if env['db_server'] in host_list:
+        host_list.remove(env['db_server'])
+        host_list.insert(0, env['db_server'])
+    if host_list == []:
+        host_list.append(env['db_server'])
+    return host_list
+
+
+def host_environment(server,env):
+    """View of env for one server, its white list and its own session."""
+    if server == env['db_server']:
+        session = env['db_session']
+        cache = env['catalog_cache']
+    else:
+        pools = env['host_pools']
+        if server not in pools:
+            pools[server] = dict()
+            pools[server]['db_session'] = new_session()
+            pools[server]['catalog_cache'] = new_catalog_cache()
+        session = pools[server]['db_session']
+        cache = pools[server]['catalog_cache']
+    db_list = list()
+    for db in env['db_white_list']:
+        if database_host(db,env) == server:
+            db_list.append(db)
+    host_env = dict(env)
+    host_env['db_server'] = server
+    host_env['db_white_list'] = tuple(db_list)
+    host_env['db_hosts'] = dict()
+    host_env['host_pools'] = dict()
+    host_env['db_session'] = session
+    host_env['catalog_cache'] = cache
+    return host_env
+
+
+class LineOutput(object):
+    """Stream wrapper passing on whole lines only (one write per line)."""
+
+    def __init__(self,stream):
+        import threading
+        self.stream = stream
+        self.lock = new_lock()
+        self.local = threading.local()
+
+    def write(self,text):
+        pending = getattr(self.local, 'pending', '') + text
+        lines, newline, rest = pending.rpartition('\n')
+        self.local.pending = rest
+        if newline != '':
+            with self.lock:
+                self.stream.write(lines + newline)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def fan_out(task,env,args=()):
+    """Run task(host_env, *args) on every host at once.
+
+    Returns list of [host_env, exit code, result] in host order, exit
+    code taken from sys.exit in task (0 otherwise). Wall time is that
+    of the slowest host; other exceptions are raised once all finish.
+    """
+    import threading
+    outcomes = list()
+    for server in database_hosts(env):
+        outcomes.append([host_environment(server,env), 0, None, None])
+
+    def run_host(outcome):
+        try:
+            outcome[2] = task(outcome[0], *args)
+        except SystemExit as e:
+            outcome[1] = e.code or 0
+        except Exception as e:
+            outcome[3] = e
+
+    def run_traced_host(outcome):
+        with traced('host',outcome[0]['db_server'],outcome[0]):
+            run_host(outcome)
+
+    if len(outcomes) == 1:
+        run_host(outcomes[0])
+    else:
+        stdout = sys.stdout
+        # hosts narrate at once, keep their lines whole
+        sys.stdout = LineOutput(stdout)
+        try:
+            thread_list = list()
+            for outcome in outcomes:
+                thread = threading.Thread(target=run_traced_host,
+                                          args=(outcome,))
+                thread.daemon = True
+                thread_list.append(thread)
+                thread.start()
+            for thread in thread_list:
+                thread.join()
+        finally:
+            sys.stdout = stdout
+    host_results = list()
+    for host_env, code, result, error in outcomes:
+        if error is not None:
+            raise error
+        host_results.append([host_env, code, result])
+    return host_results
+
+
+def fan_out_result(host_results):
+    """Exit code of fan out run (first failing host, in host order)."""
+    for host_env, code, result in host_results:
+        if code != 0:
+            return code
+    return 0
+
+
+# environment scheduling
+# ... workers each hold their own session (connections are not
+# ... shared across threads), catalog cache is shared by all
+def worker_environment(env):
+    """Copy env for worker thread, with its own database session."""
+    worker_env = dict(env)
+    worker_env['db_session'] = new_session()
+    worker_env['host_pools'] = dict()
+    return worker_env
+
+
+def order_by_size(db_list,env):
+    """Order databases largest first, so longest operations start early."""
+    size_survey = survey_database_sizes(db_list,env)
+    sized_list = list()
+    for db in db_list:
+        sized_list.append((size_survey.get(db, 0), db))
+    sized_list.sort(reverse=True)
+    ordered_list = list()
+    for pages, db in sized_list:
+        ordered_list.append(db)
+    return ordered_list
+
+
+def order_by_expected(task,db_list,env):
+    """Order databases longest expected first (history, else by size).
+
+    Databases without history of task are expected to take as long per
+    page as those with history; without any, order is by size.
+    """
+    operation = TASK_OPERATIONS.get(task.__name__, task.__name__)
+    if operation in TASK_OPERATIONS.values():
+        # db_list holds snapshots, history their source databases
+        source = dict()
+        for dbss in db_list:
+            source[dbss] = original_db_name(dbss,env)
+    else:
+        source = dict((db, db) for db in db_list)
+    source_list = sorted(set(source.values()))
+    source_expected = expected_durations(source_list,operation,env)
+    expected = dict()
+    for db in db_list:
+        if source[db] in source_expected:
+            expected[db] = source_expected[source[db]]
+    if expected == {}:
+        return order_by_size(db_list,env)
+    size_survey = survey_database_sizes(db_list,env)
+    known_seconds = 0.0
+    known_pages = 0
+    for db in expected:
+        if size_survey.get(db, 0) > 0:
+            known_seconds += expected[db]
+            known_pages += size_survey[db]
+    if known_pages == 0:
+        return order_by_size(db_list,env)
+    timed_list = list()
+    for db in db_list:
+        if db in expected:
+            seconds = expected[db]
         else:
-            sys.stderr.write("dbss -- {}".format(message))
-        sys.exit(83)
-    # check datbase status
-    db_survey = survey_databases(env)
-    db_status = db_survey[db]
-    if db_status != 'ONLINE':
-        message = "Database '{0}' is '{1}', status must be ONLINE for snapshot."\
-                  .format(db,db_status)
+            seconds = size_survey.get(db, 0) * known_seconds / known_pages
+        timed_list.append((seconds, db))
+    timed_list.sort(reverse=True)
+    ordered_list = list()
+    for seconds, db in timed_list:
+        ordered_list.append(db)
+    return ordered_list
+
+
+def queue_module():
+    """Import queue module (Queue on Python 2)."""
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+    return queue
+
+
+def run_environment_jobs(task,db_list,env,jobs,mark=False,narration=None):
+    """Run task for each database on a bounded pool of worker threads.
+
+    Returns dictionary of database to exit code (0 for success), a
+    failing database does not stop work on the others. With mark, each
+    database is marked unchanged as soon as its task succeeds. Narration
+    (formatted with database and environment) is printed before each
+    task. With one job, databases run in turn on env's own session.
+    """
+    import threading
+    queue = queue_module()
+    outcomes = dict()
+    work = queue.Queue()
+    if jobs <= 1 or len(db_list) <= 1:
+        for db in db_list:
+            work.put(db)
+        run_environment_tasks(task,work,outcomes,env,mark,narration)
+        return outcomes
+    # read catalog once up front, rather than racing workers to it
+    survey_databases(env)
+    for db in order_by_expected(task,db_list,env):
+        work.put(db)
+    stdout = sys.stdout
+    # workers narrate at once, keep their lines whole (hosts run by
+    # ... fan_out already share a LineOutput)
+    if not isinstance(stdout, LineOutput):
+        sys.stdout = LineOutput(stdout)
+    try:
+        worker_list = list()
+        for i in range(min(jobs, len(db_list))):
+            worker_env = worker_environment(env)
+            worker = threading.Thread(target=environment_worker,
+                                      args=(task,work,outcomes,worker_env,
+                                            mark,narration))
+            worker.daemon = True
+            worker_list.append((worker, worker_env))
+            worker.start()
+        # fold worker logins into run session, for session report
+        session = env['db_session']
+        for worker, worker_env in worker_list:
+            worker.join()
+            session['logins'] += worker_env['db_session']['logins']
+            session['requests'] += worker_env['db_session']['requests']
+    finally:
+        sys.stdout = stdout
+    return outcomes
+
+
+def environment_worker(task,work,outcomes,env,mark=False,narration=None):
+    """Run tasks on worker's own session, closed when work runs out."""
+    run_environment_tasks(task,work,outcomes,env,mark,narration)
+    close_session(env)
+
+
+def run_environment_tasks(task,work,outcomes,env,mark=False,narration=None):
+    """Take databases from work queue until empty, record outcomes."""
+    queue = queue_module()
+    while True:
+        try:
+            db = work.get_nowait()
+        except queue.Empty:
+            break
+        if narration is not None and not env['quiet_mode']:
+            print(narration.format(db, env['environment']))
+        db_result = 0
+        try:
+            with traced('database',db,env,db):
+                task(db,env)
+                if mark:
+                    mark_unchanged([db],env)
+        except SystemExit as e:
+            db_result = e.code
+        except Exception as e:
+            db_result = 1
+            sys.stderr.write("dbss -- {0}: {1}\n".format(db,e))
+        if db_result != 0:
+            # failed statement leaves server state uncertain
+            catalog_invalidate(env)
+        outcomes[db] = db_result
+
+
+def report_outcomes(outcomes,env):
+    """Summarize per-database outcomes, return exit code for run."""
+    quiet_mode = env['quiet_mode']
+    failed_list = list()
+    for db in sorted(outcomes):
+        if outcomes[db] != 0:
+            failed_list.append(db)
+    if not quiet_mode:
+        print('Summary: {0} succeeded, {1} failed.'\
+              .format(len(outcomes) - len(failed_list), len(failed_list)))
+    for db in failed_list:
+        message = "'{0}' failed (exit code {1})".format(db,outcomes[db])
         if not quiet_mode:
-            print('Command failed: {}'.format(message))
+            print('   ' + message)
         else:
-            sys.stderr.write("dbss -- {}".format(message))
-        sys.exit(77)
-    # create snapshot
-    capture_database(db,env)
-    if not database_exists(snapshot_db,env):
-        message = 'Snapshot {0} could not be created in {1}.'\
-                  .format(snapshot_db,ENVIRONMENT)
-        if not quiet_mode:
+            sys.stderr.write("dbss -- {}\n".format(message))
+    if failed_list == []:
+        return 0
+    else:
+        return 89
+
+
+def command_name(config):
+    """Name of docopt command chosen in config."""
+    for key in sorted(config):
+        if not key.startswith('-') and not key.startswith('<') and \
+           config[key] is True:
+            return key
+    return '[none]'
+
+
+# prewarm
+# ... a restore leaves its database's pages out of the buffer pool, so
+# ... the first tests after a revert run cold; prewarm reads each
+# ... database's hot objects (prewarm_objects, else its largest
+# ... tables), one batch per database, prewarm_jobs databases at once
+def survey_largest_tables(db,env,testing=False):
+    """Obtain largest user tables of database (schema.table), largest first."""
+    sql  = "SELECT TOP {} s.name AS schema_name, o.name AS table_name, "\
+           .format(env['prewarm_top'])
+    sql += "SUM(p.used_page_count) AS pages "
+    sql += "FROM {0}.sys.dm_db_partition_stats p ".format(db)
+    sql += "JOIN {0}.sys.objects o ON o.object_id = p.object_id ".format(db)
+    sql += "JOIN {0}.sys.schemas s ON s.schema_id = o.schema_id ".format(db)
+    # index 0 is the heap, 1 the clustered index (the table's data)
+    sql += "WHERE o.is_ms_shipped = 0 AND p.index_id IN (0, 1) "
+    sql += "GROUP BY s.name, o.name ORDER BY pages DESC;"
+    if testing:
+        print('   ' + sql)
+        return
+    table_list = list()
+    for row in sql_rows(sql,env,93):
+        table_list.append(row['schema_name'] + '.' + row['table_name'])
+    return table_list
+
+
+def prewarm_statement(db,target):
+    """Build statement reading object into buffer pool.
+
+    Target is 'schema.table' (its data, heap or clustered index) or
+    'schema.table:index'.
+    """
+    table, separator, index = target.partition(':')
+    if index == '':
+        index = '0'
+    sql  = "SELECT COUNT_BIG(*) AS row_count FROM {0}.{1} ".format(db, table)
+    sql += "WITH (INDEX({}), NOLOCK);".format(index)
+    return sql
+
+
+def prewarm_database(db,env):
+    """Read hot objects of database (one batch)."""
+    with traced('operation','prewarm',env,db):
+        target_list = env['prewarm_objects'].get(db)
+        if target_list is None:
+            target_list = survey_largest_tables(db,env)
+        if target_list == []:
+            return
+        statement_list = list()
+        for target in target_list:
+            statement_list.append(prewarm_statement(db,target))
+        sql_command('\n'.join(statement_list),env,94)
+
+
+def prewarm_host(env,db_list):
+    """Prewarm listed databases held by this host, return outcomes."""
+    host_list = list()
+    for db in env['db_white_list']:
+        if db in db_list:
+            host_list.append(db)
+    if host_list == []:
+        return dict()
+    return run_each(prewarm_database,host_list,env,env['prewarm_jobs'])
+
+
+def prewarm_environment(db_list,env):
+    """Prewarm listed databases on their hosts, report time taken.
+
+    Returns exit code (89 when a database could not be read).
+    """
+    started = time.time()
+    host_results = fan_out(prewarm_host,env,(db_list,))
+    run_result = fan_out_result(host_results)
+    outcomes = dict()
+    for host_env, code, host_outcomes in host_results:
+        if host_outcomes is not None:
+            outcomes.update(host_outcomes)
+    # summary only when something failed, restores were summarized
+    if run_result == 0 and succeeded(outcomes) != sorted(outcomes):
+        run_result = report_outcomes(outcomes,env)
+    if not env['quiet_mode'] and run_result == 0:
+        print('Prewarmed {0} database(s) in {1:.1f}s.'\
+              .format(len(db_list), time.time() - started))
+    return run_result
+
+
+# background jobs
+# ... create or restore runs on a thread with its own session, while
+# ... the caller's session polls sys.dm_exec_requests for the job's
+# ... spid (percent_complete, estimated_completion_time); cancel ends
+# ... the job's session with KILL, no promise of rollback (a killed
+# ... restore may leave its database part reverted), so the database's
+# ... state is read again afterwards
+def submit_job(operation,db,env):
+    """Start create or restore of database on a thread, return job."""
+    import threading
+    job = dict()
+    job['operation'] = operation
+    job['db'] = db
+    job['env'] = worker_environment(env)
+    job['spid'] = None
+    job['started'] = time.time()
+    job['finished'] = None
+    job['exit_code'] = None
+    job['cancelled'] = False
+    job['thread'] = threading.Thread(target=job_worker, args=(job,))
+    job['thread'].daemon = True
+    job['thread'].start()
+    return job
+
+
+def job_worker(job):
+    """Run job's operation (thread), record its exit code."""
+    env = job['env']
+    exit_code = 0
+    try:
+        with traced('database',job['db'],env,job['db']):
+            # spid first, so the job can be watched (and killed)
+            for row in sql_rows("SELECT @@SPID AS spid;",env,91):
+                job['spid'] = row['spid']
+            if job['operation'] == 'create':
+                create_snapshot(job['db'],env)
+            else:
+                restore_snapshot(job['db'],env)
+    except SystemExit as e:
+        exit_code = e.code
+    except Exception as e:
+        exit_code = 1
+        sys.stderr.write("dbss -- {0}: {1}\n".format(job['db'],e))
+    finally:
+        try:
+            close_session(env)
+            if exit_code != 0:
+                # failed (or killed) statement leaves server state uncertain
+                catalog_invalidate(env)
+        finally:
+            # set whatever happened, wait_job stops on finished
+            job['exit_code'] = exit_code
+            job['finished'] = time.time()
+
+
+def poll_job(job,env):
+    """Progress of job (state, percent, seconds elapsed and left).
+
+    Percent and seconds left come from sys.dm_exec_requests while the
+    job's statement runs, None when the server has no estimate (e.g.
+    between statements, CREATE DATABASE).
+    """
+    progress = dict()
+    progress['operation'] = job['operation']
+    progress['database'] = job['db']
+    progress['percent'] = None
+    progress['remaining'] = None
+    if job['finished'] is not None:
+        if job['cancelled']:
+            progress['state'] = 'cancelled'
+        elif job['exit_code'] == 0:
+            progress['state'] = 'done'
+            progress['percent'] = 100.0
+        else:
+            progress['state'] = 'failed'
+        progress['exit_code'] = job['exit_code']
+        progress['elapsed'] = round(job['finished'] - job['started'], 1)
+        return progress
+    progress['state'] = 'running'
+    progress['elapsed'] = round(time.time() - job['started'], 1)
+    if job['spid'] is None:
+        return progress
+    sql  = "SELECT command, percent_complete, estimated_completion_time "
+    sql += "FROM sys.dm_exec_requests "
+    sql += "WHERE session_id = {};".format(job['spid'])
+    for row in sql_rows(sql,env,91):
+        # estimate (milliseconds) stays zero for commands not reporting
+        if row['percent_complete'] > 0 or row['estimated_completion_time'] > 0:
+            progress['percent'] = round(row['percent_complete'], 1)
+            progress['remaining'] = \
+                round(row['estimated_completion_time'] / 1000.0, 1)
+    return progress
+
+
+def wait_job(job,env,timeout=None,report=None):
+    """Wait for job, return its final progress (see poll_job).
+
+    Progress is handed to report every job_poll_interval seconds, and
+    once more at the end. Past timeout (seconds from submit) the job is
+    cancelled, final progress then holds the state its database was
+    left in (left_state, see cancel_job).
+    """
+    state = None
+    while job['finished'] is None:
+        wait = env['job_poll_interval']
+        if timeout is not None:
+            left = job['started'] + timeout - time.time()
+            if left <= 0:
+                state = cancel_job(job,env)
+                break
+            wait = min(wait, left)
+        job['thread'].join(wait)
+        if job['finished'] is None and report is not None:
+            report(poll_job(job,env))
+    progress = poll_job(job,env)
+    if state is not None:
+        progress['left_state'] = state
+    if report is not None:
+        report(progress)
+    return progress
+
+
+def cancel_job(job,env):
+    """End running job (KILL of its session), wait for its thread.
+
+    Returns state_desc the job's database (snapshot, for create) was
+    left in, 'missing' when it does not exist.
+    """
+    if job['finished'] is not None:
+        return left_state(job,env)
+    job['cancelled'] = True
+    # spid is known as soon as the job has logged in
+    while job['spid'] is None and job['finished'] is None:
+        job['thread'].join(0.05)
+    if job['finished'] is None:
+        try:
+            sql_command("KILL {};".format(job['spid']),env,92)
+        except SystemExit:
+            # job may have ended on its own meanwhile
+            job['thread'].join()
+            if job['exit_code'] != 0:
+                raise
+    job['thread'].join()
+    return left_state(job,env)
+
+
+def left_state(job,env):
+    """State of job's database (snapshot, for create) as server reports it."""
+    target = job['db']
+    if job['operation'] == 'create':
+        target = snapshot_name(job['db'],env)
+    db_survey = survey_databases(env,refresh=True)
+    return db_survey.get(target, 'missing')
+
+
+def print_progress(progress,env):
+    """Print job progress, one JSON object per line when quiet."""
+    if env['quiet_mode']:
+        import json
+        print(json.dumps(progress, sort_keys=True))
+        sys.stdout.flush()
+        return
+    line = '{0} {1}: {2}'.format(progress['operation'], progress['database'],
+                                 progress['state'])
+    if progress['percent'] is not None:
+        line += ' {:.0f}%'.format(progress['percent'])
+    if progress['remaining'] is not None and progress['state'] == 'running':
+        line += ', about {:.1f}s left'.format(progress['remaining'])
+    line += ' ({:.1f}s elapsed)'.format(progress['elapsed'])
+    print(line)
+    sys.stdout.flush()
+
+
+def run_job(operation,db,config,env):
+    """Run create or restore as job, with --progress and --timeout."""
+    timeout = None
+    if config['--timeout'] is not None:
+        timeout = float(config['--timeout'])
+    report = None
+    if config['--progress']:
+        def report(progress):
+            print_progress(progress,env)
+    job = submit_job(operation,db,env)
+    progress = wait_job(job,env,timeout,report)
+    if progress['state'] == 'cancelled':
+        message = '{0} of {1} cancelled after {2}s (timeout)'\
+                  .format(operation.capitalize(), db, config['--timeout'])
+        state = progress.get('left_state', 'unknown')
+        if operation == 'restore':
+            message += ', database left in state {}, re-run restore'\
+                       .format(state)
+        else:
+            message += ', snapshot {0} left {1}, re-run create'\
+                       .format(snapshot_name(db,env), state)
+        if not env['quiet_mode']:
             print('Command failed: {}'.format(message))
         else:
             sys.stderr.write("dbss -- {}".format(message))
-        sys.exit(82)
+        sys.exit(14)
+    if progress['state'] == 'failed':
+        sys.exit(progress['exit_code'])
 
 
-def restore_snapshot(db,env):
-    """Revert database to snapshot."""
-    snapshot_db = snapshot_name(db,env)
-    if not database_exists(snapshot_db,env):
-        message = 'Snapshot {0} does not exist in {1}.'\
-                  .format(snapshot_db,ENVIRONMENT)
-        if not QUIET_MODE:
-            print('Command failed: {}'.format(message))
+# offline commands
+# ... list and test need no server, so a plain invocation of either is
+# ... answered without docopt (see main), leaving startup to interpreter
+def print_test_statements(database,env):
+    """Print statements dbss would use for database (no server needed)."""
+    TEST_MODE = True
+    # plans kept for database's host give the real create statement
+    env = host_environment(database_host(database,env),env)
+    with env['snapshot_plans']['lock']:
+        plan = server_snapshot_plans(env).get(database)
+    print("SQL Statements used by dbss script...")
+    print("\n1] Query to obtain databases in environment.")
+    survey_databases(env,TEST_MODE)
+    print("\n2] Query to check file layouts against snapshot plans.")
+    survey_layout_fingerprints([database],env,TEST_MODE)
+    print("\n3] Query to obtain files associated with database "
+          "(layout changed or no plan).")
+    survey_datafiles([database],env,TEST_MODE)
+    print("\n4] Command to create database snapshot.")
+    if plan is None:
+        caveat  = "...[Warning: Create statement is purely example "
+        caveat += "(no plan kept for database yet). "
+        caveat += "File name and path must be built from query\n"
+        caveat += "...on sys.master_files due to use "
+        caveat += "of SQL Server filegroups. "
+        caveat += "Filegroups should be kept online\n"
+        caveat += "...to simplify snapshot use, "
+        caveat += "and FILESTREAMS must be avoided.]"
+    else:
+        caveat  = "...[From snapshot plan kept for {}, ".format(env['db_server'])
+        caveat += "file layout as last seen by dbss.]"
+    print(caveat)
+    capture_database(database,env,TEST_MODE)
+    print("\n5] Command to revert database to snapshot.")
+    restore_database(database,env,TEST_MODE)
+    print("\n6] Command to delete snapshot.")
+    drop_snapshot(database,env,TEST_MODE)
+    print("\n7] Call restoring environment by dbss procedure (--server-side, "
+          "see 'install').")
+    print('   ' + procedure_statement('restore',[database],env))
+    print("\n[finis]")
+    # here is a good place to put items for temporary testing
+
+
+def print_history(env,slow):
+    """Print duration percentiles by operation and database, flag slow runs.
+
+    A run is slow when over slow times its database's median (for that
+    operation), judged once three or more runs succeeded. Batched runs
+    (operation marked *) are kept apart, their seconds are the batch's.
+    """
+    import sqlite3
+    try:
+        record_list = read_history(env)
+    except sqlite3.Error as e:
+        message = "History unreadable ({})".format(e)
+        if not env['quiet_mode']:
+            print("Command failed: {}".format(message))
         else:
             sys.stderr.write("dbss -- {}".format(message))
-        sys.exit(11)
-    # check datbase status
-    db_survey = survey_databases(env)
-    db_status = db_survey[db]
-    if db_status != 'ONLINE':
-        message = "Database '{0}' is '{1}', status must be ONLINE for restore."\
-                  .format(db,db_status)
-        if not quiet_mode:
-            print('Command failed: {}'.format(message))
+        sys.exit(95)
+    groups = dict()
+    for record in record_list:
+        operation = record['operation']
+        if record['batched']:
+            operation += '*'
+        key = (operation, record['database'] or '(white list)')
+        groups.setdefault(key, list()).append(record)
+    print("History of operations in {0} environment (slow: over {1:g}x "
+          "median):".format(env['environment'], slow))
+    print('  {0:<17} {1:<22} {2:>5} {3:>8} {4:>8} {5:>8} {6:>9} {7:>6}'\
+          .format('operation', 'database', 'runs', 'p50 s', 'p90 s',
+                  'max s', 'last MB', 'failed'))
+    slow_list = list()
+    for key in sorted(groups):
+        seconds_list = list()
+        failed = 0
+        size = None
+        for record in groups[key]:
+            if record['outcome'] == 0:
+                seconds_list.append(record['seconds'])
+            else:
+                failed += 1
+            if record['bytes'] is not None:
+                size = record['bytes']
+        size_text = '-'
+        if size is not None:
+            size_text = '{:.1f}'.format(size / 1048576.0)
+        if seconds_list == []:
+            print('  {0:<17} {1:<22} {2:>5} {3:>8} {4:>8} {5:>8} {6:>9} '
+                  '{7:>6}'.format(key[0], key[1], len(groups[key]), '-',
+                                  '-', '-', size_text, failed))
+            continue
+        median = percentile(seconds_list,50)
+        print('  {0:<17} {1:<22} {2:>5} {3:>8.3f} {4:>8.3f} {5:>8.3f} {6:>9} '
+              '{7:>6}'.format(key[0], key[1], len(groups[key]), median,
+                              percentile(seconds_list,90),
+                              max(seconds_list), size_text, failed))
+        if len(seconds_list) < 3:
+            continue
+        for record in groups[key]:
+            if record['outcome'] == 0 and record['seconds'] > slow * median:
+                slow_list.append((record['started'], key, record['seconds'],
+                                  record['seconds'] / median))
+    if slow_list != []:
+        slow_list.sort()
+        print('Slow runs:')
+        for started, key, seconds, ratio in slow_list:
+            print('  {0}  {1:<17} {2:<22} {3:>8.3f}s ({4:.1f}x median)'\
+                  .format(time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.localtime(started)),
+                          key[0], key[1], seconds, ratio))
+    print('  [finis]')
+
+
+def print_white_list(env):
+    """Print database white list of environment."""
+    print("Database white list for {} environment:".format(env['environment']))
+    for db in env['db_white_list']:
+        if env['db_hosts'] == {}:
+            print('  ' + db)
+        else:
+            print('  {0} ({1})'.format(db, database_host(db,env)))
+    print('  [finis]')
+
+
+def offline_arguments(argv):
+    """Split plain list/test invocation into command, database, environment.
+
+    Returns None for anything else (options beyond --environment=<env>,
+    usage errors), which is left to docopt.
+    """
+    if argv[:1] not in (['list'], ['test']):
+        return None
+    command = argv[0]
+    database = None
+    # docopt default for --environment
+    environment = 'test'
+    for argument in argv[1:]:
+        if argument.startswith('--environment='):
+            environment = argument[len('--environment='):]
+        elif command == 'test' and database is None \
+                and not argument.startswith('-'):
+            database = argument.upper()
+        else:
+            return None
+    if command == 'test' and database is None:
+        return None
+    return command, database, environment
+
+
+# environment commands
+# ... each runs on one host's view of env (see fan_out), narration of
+# ... the environment as a whole is left to run_command
+def baseline_status(env):
+    """List white list databases without snapshot, survey snapshot sizes."""
+    required_snapshots = list()
+    databases_available = survey_databases(env)
+    for db in env['db_white_list']:
+        snapshot_db = snapshot_name(db,env)
+        if not snapshot_db in databases_available:
+            required_snapshots.append(db)
+    snapshot_sizes = dict()
+    if len(required_snapshots) < len(env['db_white_list']):
+        snapshot_sizes = survey_snapshot_sizes(env['db_white_list'],env)
+    return required_snapshots, snapshot_sizes
+
+
+def white_list_generations(env,prune):
+    """Survey generations of white list databases, evicting when prune."""
+    if prune:
+        apply_retention(list(env['db_white_list']),env)
+    return survey_generations(env)
+
+
+def white_list_snapshot_sizes(env):
+    """Survey snapshot sizes of white list databases."""
+    return survey_snapshot_sizes(env['db_white_list'],env)
+
+
+def refresh_snapshots(env,db_list):
+    """Refresh snapshots of listed databases held by this host.
+
+    Databases holding generations a restore would drop are left be and
+    reported first; returns (refreshed, left) databases.
+    """
+    host_list = list()
+    left_list = list()
+    for db in db_list:
+        if db not in env['db_white_list']:
+            continue
+        dbss_list = generations_in_way(db,env)
+        if dbss_list != []:
+            batch_failure(db,'snapshot not refreshed, '
+                          + generations_message(db,dbss_list),env)
+            left_list.append(db)
         else:
-            sys.stderr.write("dbss -- {}".format(message))
-        sys.exit(78)
-    # revert db to snapshot
-    restore_database(db,env)
+            host_list.append(db)
+    refreshed_list = list()
+    for db in host_list:
+        if not env['quiet_mode']:
+            print('Refreshing snapshot of "{0}" in {1}.'\
+                  .format(db, env['environment']))
+        with traced('database',db,env,db):
+            if refresh_snapshot(db,env):
+                refreshed_list.append(db)
+            else:
+                left_list.append(db)
+    return refreshed_list, left_list
 
 
-if __name__ == "__main__":
-    # docopt handles non-command invocations (e.g help and version)
-    config = docopt.docopt(__doc__, version=VERSION)
+def bloated_snapshots(snapshot_sizes,ratio,env):
+    """List white list databases whose snapshot size is over ratio."""
+    bloated_list = list()
+    for db in env['db_white_list']:
+        if db in snapshot_sizes and bloat_ratio(snapshot_sizes[db]) > ratio:
+            bloated_list.append(db)
+    return bloated_list
 
-    # assemble required status
-    TEST_MODE = config['test']
-    QUIET_MODE = config['--quiet']
-    ENVIRONMENT = config['--environment']
-    database_required = config['destroy'] or config['create'] or config['restore']
-    if database_required or TEST_MODE:
-        database = config['<database>'].upper()
+
+def kill_white_list_connections(env):
+    """Kill connections to white list databases."""
+    kill_connections(env,env['db_white_list'])
+
+
+def generate_baseline(env,jobs,force_recreate=False):
+    """Create snapshots of white list databases (stale or missing ones).
+
+    Returns databases whose snapshots were kept as current (none with
+    force_recreate) and per-database outcomes (None when none created),
+    a failing database does not stop the others.
+    """
+    if force_recreate:
+        create_list = list(env['db_white_list'])
+        current_list = list()
     else:
-        database = '[none]'
+        create_list, current_list = stale_snapshots(env['db_white_list'],env)
+    if create_list == []:
+        return current_list, None
+    # old marks go before their snapshots do, and each new snapshot is
+    # ... marked as soon as created, so a run cut short leaves no
+    # ... mismatched mark and the next run resumes after the last create
+    forget_marks(create_list,env)
+    if env['server_side']:
+        outcomes = call_procedure('create',create_list,env)
+        mark_unchanged(succeeded(outcomes),env)
+    else:
+        narration = 'Creating snapshot for "{0}" in {1}.'
+        outcomes = run_environment_jobs(create_snapshot,create_list,env,jobs,
+                                        True,narration)
+        # one catalog read for every create (procedure verifies its own)
+        missing_list = catalog_mismatch([snapshot_name(db,env)
+                                         for db in create_list],True,env)
+        for database in create_list:
+            if snapshot_name(database,env) in missing_list and \
+               outcomes[database] == 0:
+                batch_failure(database,'Snapshot could not be created',env)
+                outcomes[database] = 82
+    apply_retention(succeeded(outcomes),env)
+    return current_list, outcomes
 
-    # adjust environment-relevant configs
-    env = configure_environment(ENVIRONMENT, QUIET_MODE)
 
-    # validate environment
-    if env is None:
-        message = "Environment '{}' Unknown".format(ENVIRONMENT)
-        if not QUIET_MODE:
-            print("Command failed: {}".format(message))
-        else:
-            sys.stderr.write("dbss -- {}".format(message))
-        sys.exit(5)
+def revert_environment(env,jobs,batch,force):
+    """Restore changed white list databases from their snapshots.
 
-    # validate database - ensure in white list
-    if database_required:
-        if database not in env['db_white_list']:
-            message = "Database '{}' Unknown (check help for white list)"\
-                      .format(database)
-            if not QUIET_MODE:
-                print("Command failed: {}".format(message))
-            else:
-                sys.stderr.write("dbss -- {}".format(message))
-            sys.exit(6)
+    Returns databases skipped as unchanged (none with force) and
+    per-database outcomes (None when none restored), a failing database
+    does not stop the others.
+    """
+    if force:
+        restore_list = list(env['db_white_list'])
+        skipped_list = list()
+    else:
+        restore_list, skipped_list = changed_databases(env['db_white_list'],env)
+    if restore_list == []:
+        return skipped_list, None
+    if env['server_side']:
+        outcomes = call_procedure('restore',restore_list,env)
+    elif batch:
+        outcomes = restore_snapshots_batch(restore_list,env)
+    else:
+        narration = 'Restoring "{0}" from snapshot in {1}.'
+        outcomes = run_environment_jobs(restore_snapshot,restore_list,env,jobs,
+                                        False,narration)
+    mark_unchanged(succeeded(outcomes),env)
+    return skipped_list, outcomes
+
+
+def clean_slate(env,jobs,batch):
+    """Drop snapshots of white list databases.
+
+    Returns snapshots to drop and per-snapshot outcomes (None when none
+    dropped), a failing snapshot does not stop the others.
+    """
+    # differences exist in how 'clean_slate' and 
+    # ... 'destroy' check existence of snapshot
+    QUIET_MODE = env['quiet_mode']
+    drop_list = list()
+    dbss_list = list()
+    # obtain snapshots, filter against white_list
+    available_databases = survey_databases(env)
+    for db in available_databases:
+        if is_snapshot(db,env):
+            dbss_list.append(db)
+    for dbss in dbss_list:
+        base_db = original_db_name(dbss,env)
+        if base_db in env['db_white_list']:
+            drop_list.append(dbss)
+    if drop_list == []:
+        return drop_list, None
+    if not QUIET_MODE:
+        print('Database Snapshots to drop: ' + str(drop_list))
+    # drop snapshots (verified after by one catalog read, dbss's own DDL
+    # ... keeps the cache current so only a refresh can catch a failure)
+    base_list = list()
+    for dbss in drop_list:
+        base_list.append(original_db_name(dbss,env))
+    forget_marks(base_list,env,True)
+    if env['server_side']:
+        # procedure drops by source database, every generation at once
+        source_list = list()
+        for db in base_list:
+            if db not in source_list:
+                source_list.append(db)
+        source_outcomes = call_procedure('drop',source_list,env)
+        outcomes = dict()
+        for dbss in drop_list:
+            outcomes[dbss] = source_outcomes[original_db_name(dbss,env)]
+        return drop_list, outcomes
+    if batch:
+        return drop_list, drop_snapshots_batch(drop_list,env)
+    outcomes = run_environment_jobs(destroy_snapshot,drop_list,env,jobs)
+    for dbss in catalog_mismatch(drop_list,False,env):
+        if outcomes[dbss] == 0:
+            batch_failure(dbss,'Snapshot could not be dropped',env)
+            outcomes[dbss] = 80
+    return drop_list, outcomes
+
+
+def succeeded(outcomes):
+    """List databases whose outcome is success."""
+    db_list = list()
+    for db in sorted(outcomes):
+        if outcomes[db] == 0:
+            db_list.append(db)
+    return db_list
+
+
+def environment_result(host_results,env):
+    """Exit code of environment command, summarizing merged outcomes.
+
+    Per-database outcomes of all hosts are summarized as one (hosts
+    with nothing to do have none).
+    """
+    run_result = fan_out_result(host_results)
+    outcomes = None
+    for host_env, code, host_outcomes in host_results:
+        if host_outcomes is not None:
+            if outcomes is None:
+                outcomes = dict()
+            outcomes.update(host_outcomes)
+    if outcomes is not None and run_result == 0:
+        run_result = report_outcomes(outcomes,env)
+    return run_result
+
+
+def run_command(config,env,database,JOBS):
+    """Dispatch validated docopt command."""
+    QUIET_MODE = env['quiet_mode']
+    ENVIRONMENT = env['environment']
+    database_required = config['destroy'] or config['create'] or config['restore']
 
     # script interface
     if config['test']:
-        print("SQL Statements used by dbss script...")
-        print("\n1] Query to obtain databases in environment.")
-        survey_databases(env,TEST_MODE)
-        print("\n2] Query to obtain files associated with database.")
-        survey_datafiles(database,env,TEST_MODE)
-        print("\n3] Command to create database snapshot.")
-        caveat  = "...[Warning: Create statement is purely example. "
-        caveat += "File name and path must be built from query\n"
-        caveat += "...on sys.database_files due to use "
-        caveat += "of SQL Server filegroups. "
-        caveat += "Filegroups should be kept online\n"
-        caveat += "...to simplify snapshot use, "
-        caveat += "and FILESTREAMS must be avoided.]"
-        print(caveat)
-        capture_database(database,env,TEST_MODE)
-        print("\n4] Command to revert database to snapshot.")
-        restore_database(database,env,TEST_MODE)
-        print("\n5] Command to delete snapshot.")
-        drop_snapshot(database,env,TEST_MODE)
-        print("\n[finis]")
-        # here is a good place to put items for temporary testing
+        print_test_statements(database,env)
 
     if config['list']:
-        print("Database white list for {} environment:".format(ENVIRONMENT))
-        for db in env['db_white_list']:
-            print('  ' + db)
-        print('  [finis]')
+        print_white_list(env)
 
     if config['survey']:
-        databases_available = survey_databases(env)
-        database_list = databases_available.keys()
-        database_list.sort()
+        host_results = fan_out(survey_server_databases,env)
+        run_result = fan_out_result(host_results)
+        if run_result != 0:
+            sys.exit(run_result)
+        database_list = list()
+        for host_env, code, host_list in host_results:
+            for db in host_list:
+                if db not in database_list:
+                    database_list.append(db)
+        if len(host_results) > 1:
+            database_list.sort(key=str.lower)
         print("Survey of databases available in {} environment:".format(ENVIRONMENT))
         for db in database_list:
             print('  ' + db)
@@ -482,31 +3491,147 @@ if __name__ == "__main__":
 
     if config['check_baseline']:
         print("Checking snapshots available in {} environment against white list...".format(ENVIRONMENT))
+        host_results = fan_out(baseline_status,env)
+        run_result = fan_out_result(host_results)
+        if run_result != 0:
+            sys.exit(run_result)
+        missing_list = list()
+        snapshot_sizes = dict()
+        for host_env, code, host_status in host_results:
+            missing_list.extend(host_status[0])
+            snapshot_sizes.update(host_status[1])
         required_snapshots = list()
-        databases_available = survey_databases(env)
         for db in env['db_white_list']:
-            snapshot_db = snapshot_name(db,env)
-            if not snapshot_db in databases_available:
+            if db in missing_list:
                 required_snapshots.append(db)
         if required_snapshots == []:
             print("Baseline ready (snapshots exist for required databases).")
         else:
             print("Snapshots missing for these databases:")
             print(required_snapshots)
+        ratio = env['snapshot_bloat_ratio']
+        bloated_list = list()
+        for db in bloated_snapshots(snapshot_sizes,ratio,env):
+            bloated_list.append('{0} ({1:.0%})'\
+                                .format(db, bloat_ratio(snapshot_sizes[db])))
+        if bloated_list != []:
+            print("Snapshots bloated (over {0:.0%} of source size, "
+                  "see 'stats --refresh'):".format(ratio))
+            print(bloated_list)
+
+    if config['stats']:
+        ratio = env['snapshot_bloat_ratio']
+        if config['--bloat'] is not None:
+            ratio = float(config['--bloat'])
+        host_results = fan_out(white_list_snapshot_sizes,env)
+        run_result = fan_out_result(host_results)
+        if run_result != 0:
+            sys.exit(run_result)
+        sizes = dict()
+        for host_env, code, host_sizes in host_results:
+            sizes.update(host_sizes)
+        bloated_list = bloated_snapshots(sizes,ratio,env)
+        if not QUIET_MODE or not config['--refresh']:
+            print("Snapshot sizes in {0} environment (bloated over {1:.0%}):"\
+                  .format(ENVIRONMENT, ratio))
+            print('  {0:<28} {1:>12} {2:>12} {3:>7}'\
+                  .format('database', 'snapshot MB', 'source MB', 'ratio'))
+            for db in env['db_white_list']:
+                if db not in sizes:
+                    print('  {0:<28} {1:>12}'.format(db, '(none)'))
+                    continue
+                flag = ' bloated' if db in bloated_list else ''
+                print('  {0:<28} {1:>12.1f} {2:>12.1f} {3:>7.1%}{4}'\
+                      .format(db, sizes[db][0] / 1048576.0,
+                              sizes[db][1] / 1048576.0,
+                              bloat_ratio(sizes[db]), flag))
+            print('  [finis]')
+        if config['--refresh'] and bloated_list != []:
+            host_results = fan_out(refresh_snapshots,env,(bloated_list,))
+            run_result = fan_out_result(host_results)
+            if run_result != 0:
+                sys.exit(run_result)
+            refreshed_list = list()
+            left_list = list()
+            for host_env, code, host_lists in host_results:
+                refreshed_list.extend(host_lists[0])
+                left_list.extend(host_lists[1])
+            if not QUIET_MODE:
+                print('Snapshots refreshed: ' + str(refreshed_list))
+            if left_list != []:
+                # other generations kept, bloated snapshots too
+                sys.exit(17)
+
+    if config['generations']:
+        host_results = fan_out(white_list_generations,env,
+                               (config['--prune'],))
+        run_result = fan_out_result(host_results)
+        if run_result != 0:
+            sys.exit(run_result)
+        generation_list = list()
+        for host_env, code, host_list in host_results:
+            generation_list.extend(host_list)
+        print("Snapshot generations in {} environment:".format(ENVIRONMENT))
+        print('  {0:<28} {1:<16} {2:>10} {3:>12}'\
+              .format('database', 'generation', 'age hours', 'size MB'))
+        for db in env['db_white_list']:
+            for generation in generation_list:
+                if generation['db'] != db:
+                    continue
+                print('  {0:<28} {1:<16} {2:>10.1f} {3:>12.1f}'\
+                      .format(db, generation['generation'],
+                              generation['age'] / 3600.0,
+                              generation['bytes'] / 1048576.0))
+        print('  [finis]')
+
+    if config['history']:
+        print_history(env,float(config['--slow']))
+
+    if config['install']:
+        host_results = fan_out(install_procedure,env)
+        run_result = fan_out_result(host_results)
+        if run_result != 0:
+            sys.exit(run_result)
+        if not QUIET_MODE:
+            print('Procedure {0} installed in {1}!'\
+                  .format(SERVER_PROCEDURE, ENVIRONMENT))
 
     if config['kill_connections']:
-        kill_connections(env)
+        if config['--server-wide']:
+            host_results = fan_out(kill_connections,env)
+        else:
+            host_results = fan_out(kill_white_list_connections,env)
+        run_result = fan_out_result(host_results)
+        if run_result != 0:
+            sys.exit(run_result)
+
+    # single database commands run on the database's host
+    if database_required:
+        env = host_environment(database_host(database,env),env)
 
     if config['create']:
-        create_snapshot(database,env)
+        if config['--progress'] or config['--timeout'] is not None:
+            run_job('create',database,config,env)
+        else:
+            create_snapshot(database,env)
+        mark_unchanged([database],env)
+        apply_retention([database],env)
         if not QUIET_MODE:
             print('Snapshot created!')
 
     if config['restore']:
         # revert database to snapshot
-        restore_snapshot(database,env)
+        if config['--progress'] or config['--timeout'] is not None:
+            run_job('restore',database,config,env)
+        else:
+            restore_snapshot(database,env)
+        mark_unchanged([database],env)
         if not QUIET_MODE:
             print('Database restored!')
+        if config['--prewarm']:
+            run_result = prewarm_environment([database],env)
+            if run_result != 0:
+                sys.exit(run_result)
 
     if config['destroy']:
         snapshot_db = snapshot_name(database,env)
@@ -518,8 +3643,9 @@ if __name__ == "__main__":
                 print(message)
             sys.exit(0)
         # drop snapshot
+        forget_marks([database],env)
         drop_snapshot(database,env)
-        if database_exists(snapshot_db,env):
+        if catalog_mismatch([snapshot_db],False,env) != []:
             message = 'Snapshot {} could not be dropped'.format(snapshot_db)
             if not QUIET_MODE:
                 print('Command failed: {}'.format(message))
@@ -530,60 +3656,734 @@ if __name__ == "__main__":
             print('Snapshot destroyed!')
 
     if config['generate_baseline']:
-        # generate baseline snapshots for environment
-        for database in env['db_white_list']:
-            if not QUIET_MODE:
-                message = 'Creating snapshot for "{0}" in {1}.'\
-                          .format(database, ENVIRONMENT)
-                print(message)
-            create_snapshot(database,env)
+        if not QUIET_MODE and config['--server-side']:
+            message = 'Creating snapshots in {} (server side).'\
+                      .format(ENVIRONMENT)
+            print(message)
+        elif not QUIET_MODE and JOBS > 1:
+            message = 'Creating snapshots in {0} ({1} jobs).'\
+                      .format(ENVIRONMENT, JOBS)
+            print(message)
+        host_results = fan_out(generate_baseline,env,
+                               (JOBS,config['--force-recreate']))
+        host_current_list = list()
+        for host_result in host_results:
+            if host_result[2] is not None:
+                host_current_list.extend(host_result[2][0])
+                host_result[2] = host_result[2][1]
+        current_list = list()
+        for db in env['db_white_list']:
+            if db in host_current_list:
+                current_list.append(db)
+        run_result = environment_result(host_results,env)
+        if run_result != 0:
+            sys.exit(run_result)
         if not QUIET_MODE:
+            if current_list != []:
+                print('Snapshots current (kept): ' + str(current_list))
             print('Environment baseline generated!')
 
     if config['revert_environment']:
-        # revert environment databases to baseline
-        for database in env['db_white_list']:
-            if not QUIET_MODE:
-                message = 'Restoring "{0}" from snapshot in {1}.'\
-                          .format(database, ENVIRONMENT)
-                print(message)
-            restore_snapshot(database,env)
+        if not QUIET_MODE and config['--server-side']:
+            message = 'Restoring databases from snapshots in {} (server side).'\
+                      .format(ENVIRONMENT)
+            print(message)
+        elif not QUIET_MODE and config['--batch']:
+            message = 'Restoring databases from snapshots in {} (batch).'\
+                      .format(ENVIRONMENT)
+            print(message)
+        elif not QUIET_MODE and JOBS > 1:
+            message = 'Restoring databases from snapshots in {0} ({1} jobs).'\
+                      .format(ENVIRONMENT, JOBS)
+            print(message)
+        host_results = fan_out(revert_environment,env,
+                               (JOBS,config['--batch'],config['--force']))
+        host_skipped_list = list()
+        for host_result in host_results:
+            if host_result[2] is not None:
+                host_skipped_list.extend(host_result[2][0])
+                host_result[2] = host_result[2][1]
+        skipped_list = list()
+        for db in env['db_white_list']:
+            if db in host_skipped_list:
+                skipped_list.append(db)
+        run_result = environment_result(host_results,env)
+        if run_result != 0:
+            sys.exit(run_result)
         if not QUIET_MODE:
+            if skipped_list != []:
+                print('Unchanged since snapshot (skipped): ' +
+                      str(skipped_list))
             print('Environment reverted to baseline!')
+        if config['--prewarm']:
+            restored_list = list()
+            for db in env['db_white_list']:
+                if db not in skipped_list:
+                    restored_list.append(db)
+            if restored_list != []:
+                run_result = prewarm_environment(restored_list,env)
+                if run_result != 0:
+                    sys.exit(run_result)
 
     if config['clean_slate']:
         # drop snapshots from white_list in environment
-        # differences exist in how 'clean_slate' and 
-        # ... 'destroy' check existence of snapshot
+        host_results = fan_out(clean_slate,env,(JOBS,config['--batch']))
         drop_list = list()
-        dbss_list = list()
-        # obtain snapshots, filter against white_list
-        available_databases = survey_databases(env)
-        for db in available_databases:
-            if is_snapshot(db,env):
-                dbss_list.append(db)
-        for dbss in dbss_list:
-            base_db = original_db_name(dbss,env)
-            if base_db in env['db_white_list']:
-                drop_list.append(dbss)
+        for host_result in host_results:
+            if host_result[2] is not None:
+                drop_list.extend(host_result[2][0])
+                host_result[2] = host_result[2][1]
+        run_result = environment_result(host_results,env)
+        if run_result != 0:
+            sys.exit(run_result)
         if not QUIET_MODE:
             if drop_list == []:
                 print('Slate clean (no snapshots to drop)')
-                sys.exit(0)
             else:
-                print('Database Snapshots to drop: ' + str(drop_list))
-        # drop snapshots (with redundant error check)
-        for dbss in drop_list:
-            drop_database(dbss,env)
-            if database_exists(dbss,env):
-                message = 'Snapshot {} could not be dropped'.format(dbss)
-                if not QUIET_MODE:
-                    print('Command failed: {}'.format(message))
+                print('Snapshots dropped!')
+
+
+# library interface
+# ... for use from python (e.g. pytest_dbss): failures raise DbssError
+# ... rather than exiting, env comes from open_environment and spans
+# ... hosts as on the command line
+class DbssError(Exception):
+    """dbss operation failed, code is the command line's exit code."""
+
+    def __init__(self,code,message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def open_environment(environment,quiet_mode=True):
+    """Configure environment for library use."""
+    env = configure_environment(environment, quiet_mode)
+    if env is None:
+        raise DbssError(5, "Environment '{}' Unknown".format(environment))
+    return env
+
+
+def close_environment(env):
+    """Close pooled connections of environment, save its history."""
+    save_history(env)
+    close_session(env)
+
+
+def api_databases(db_list,env):
+    """Validate databases against white list (all when None)."""
+    if db_list is None:
+        return list(env['db_white_list'])
+    unknown_list = list()
+    for db in db_list:
+        if db not in env['db_white_list']:
+            unknown_list.append(db)
+    if unknown_list != []:
+        raise DbssError(6, "Databases {} Unknown (not in white list)"\
+                        .format(unknown_list))
+    return list(db_list)
+
+
+def api_outcomes(host_results,action):
+    """Merge host outcomes, raise DbssError naming failed databases."""
+    outcomes = dict()
+    for host_env, code, host_outcomes in host_results:
+        if code != 0:
+            raise DbssError(code, "{0} failed on {1} (exit code {2})"\
+                            .format(action, host_env['db_server'], code))
+        outcomes.update(host_outcomes)
+    failed_list = list()
+    for db in sorted(outcomes):
+        if outcomes[db] != 0:
+            failed_list.append('{0} ({1})'.format(db, outcomes[db]))
+    if failed_list != []:
+        raise DbssError(89, "{0} failed for {1}"\
+                        .format(action, ', '.join(failed_list)))
+    return outcomes
+
+
+def run_each(task,db_list,env,jobs):
+    """Run task for each database, return outcomes (exit codes).
+
+    Concurrent with jobs (see run_environment_jobs), otherwise in turn
+    on env's own session.
+    """
+    if jobs > 1 and len(db_list) > 1:
+        return run_environment_jobs(task,db_list,env,jobs)
+    outcomes = dict()
+    for db in db_list:
+        db_result = 0
+        try:
+            with traced('database',db,env,db):
+                task(db,env)
+        except SystemExit as e:
+            db_result = e.code
+        if db_result != 0:
+            # failed statement leaves server state uncertain
+            catalog_invalidate(env)
+        outcomes[db] = db_result
+    return outcomes
+
+
+def host_baseline(env,db_list,recreate,jobs):
+    """Create missing (or all) snapshots, revert changed databases."""
+    host_list = list()
+    for db in env['db_white_list']:
+        if db in db_list:
+            host_list.append(db)
+    create_list = list()
+    if recreate:
+        create_list = host_list
+    else:
+        db_survey = survey_databases(env)
+        for db in host_list:
+            if snapshot_name(db,env) not in db_survey:
+                create_list.append(db)
+    outcomes = run_each(create_snapshot,create_list,env,jobs)
+    mark_unchanged(succeeded(outcomes),env)
+    # existing snapshots kept, their databases brought back to them
+    restore_list = list()
+    for db in host_list:
+        if db not in create_list:
+            restore_list.append(db)
+    if restore_list != []:
+        outcomes.update(host_restore(env,restore_list,False,jobs))
+    return outcomes
+
+
+def host_restore(env,db_list,force,jobs):
+    """Restore changed (or all) databases of db_list held by host."""
+    host_list = list()
+    for db in env['db_white_list']:
+        if db in db_list:
+            host_list.append(db)
+    if host_list == []:
+        return dict()
+    if not force:
+        host_list, unchanged_list = changed_databases(host_list,env)
+    outcomes = run_each(restore_snapshot,host_list,env,jobs)
+    mark_unchanged(succeeded(outcomes),env)
+    return outcomes
+
+
+def host_dirty(env,db_list):
+    """List databases of db_list held by host changed since marked."""
+    host_list = list()
+    for db in env['db_white_list']:
+        if db in db_list:
+            host_list.append(db)
+    if host_list == []:
+        return list()
+    changed_list, unchanged_list = changed_databases(host_list,env)
+    return changed_list
+
+
+def take_baseline(env,db_list=None,recreate=False,jobs=1):
+    """Bring databases to a baseline, return databases created/restored.
+
+    Snapshots are created where missing (every one when recreate),
+    databases with existing snapshots are reverted if changed.
+    """
+    db_list = api_databases(db_list,env)
+    host_results = fan_out(host_baseline,env,(db_list,recreate,jobs))
+    return sorted(api_outcomes(host_results,'baseline'))
+
+
+def dirty_databases(env,db_list=None):
+    """List databases written since baseline (or their last restore)."""
+    db_list = api_databases(db_list,env)
+    host_results = fan_out(host_dirty,env,(db_list,))
+    if fan_out_result(host_results) != 0:
+        raise DbssError(fan_out_result(host_results),
+                        'change detection failed')
+    dirty_list = list()
+    for host_env, code, host_list in host_results:
+        dirty_list.extend(host_list)
+    return sorted(dirty_list)
+
+
+def restore_databases(env,db_list=None,force=False,jobs=1):
+    """Restore databases from snapshots, return databases restored.
+
+    Only databases changed since baseline are restored, unless force
+    (databases given are restored whether or not changes were seen).
+    """
+    db_list = api_databases(db_list,env)
+    host_results = fan_out(host_restore,env,(db_list,force,jobs))
+    return sorted(api_outcomes(host_results,'restore'))
+
+
+def prewarm_databases(env,db_list=None):
+    """Read hot objects of databases into memory, return seconds taken."""
+    db_list = api_databases(db_list,env)
+    started = time.time()
+    host_results = fan_out(prewarm_host,env,(db_list,))
+    api_outcomes(host_results,'prewarm')
+    return time.time() - started
+
+
+# daemon
+# ... one worker thread runs requests in arrival order on a long-lived
+# ... env (warm session and catalog), socket handlers only queue them
+def daemon_socket(env):
+    """Default daemon address, Unix socket in state_dir (per environment)."""
+    import os
+    state_dir = os.path.expanduser(env['state_dir'])
+    return os.path.join(state_dir, 'daemon_{}.sock'.format(env['environment']))
+
+
+def daemon_address(address):
+    """Split address into socket family and address.
+
+    A host:port address must be on loopback (see DAEMON_LOOPBACK_HOSTS).
+    """
+    import socket
+    if '/' in address or '\\' in address:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('Unix sockets unavailable, listen on '
+                             '127.0.0.1:port instead')
+        return socket.AF_UNIX, address
+    if ':' not in address:
+        raise ValueError('address must be a socket path or host:port')
+    host, port = address.rsplit(':', 1)
+    host = host.strip('[]')
+    if host not in DAEMON_LOOPBACK_HOSTS:
+        raise ValueError('host {0} is not loopback ({1})'\
+                         .format(host, ', '.join(DAEMON_LOOPBACK_HOSTS)))
+    if host == '::1':
+        return socket.AF_INET6, (host, int(port))
+    return socket.AF_INET, (host, int(port))
+
+
+def daemon_invalidate(env):
+    """Discard catalog of every host, a failed request leaves it uncertain."""
+    for server in database_hosts(env):
+        catalog_invalidate(host_environment(server,env))
+
+
+def daemon_request(argv,env):
+    """Run one daemon request (dbss arguments), return response."""
+    response = dict()
+    started = time.time()
+    command = argv[0] if argv else ''
+    command = DAEMON_ALIASES.get(command, command)
+    if command not in DAEMON_COMMANDS:
+        response['status'] = 2
+        response['output'] = "Command '{0}' not served (choose from {1})\n"\
+                             .format(command, ', '.join(DAEMON_COMMANDS))
+        return response
+    for argument in argv[1:]:
+        option = argument.split('=', 1)[0]
+        if not option.startswith('--') or option == '--':
+            continue
+        for refused in DAEMON_REFUSED_OPTIONS:
+            if refused.startswith(option):
+                response['status'] = 2
+                response['output'] = "Option '{}' not served by daemon\n"\
+                                     .format(refused)
+                return response
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    argv = [command] + argv[1:] + ['--environment=' + env['environment']]
+    stdout = sys.stdout
+    stderr = sys.stderr
+    output = StringIO()
+    sys.stdout = output
+    sys.stderr = output
+    status = 0
+    try:
+        main(argv,env)
+    except SystemExit as e:
+        status = e.code or 0
+        if not isinstance(status, int):
+            # docopt usage error
+            output.write('{}\n'.format(status))
+            status = 2
+        if status != 0:
+            daemon_invalidate(env)
+    except Exception as e:
+        status = 1
+        output.write('dbss -- {0}: {1}\n'.format(type(e).__name__, e))
+        daemon_invalidate(env)
+    finally:
+        sys.stdout = stdout
+        sys.stderr = stderr
+    response['status'] = status
+    response['output'] = output.getvalue()
+    response['elapsed'] = round(time.time() - started, 3)
+    return response
+
+
+def daemon_worker(requests,env,quiet_mode):
+    """Take queued requests, run them in order, hand back responses."""
+    while True:
+        argv, reply = requests.get()
+        # each request chooses its own narration (see main)
+        env['quiet_mode'] = quiet_mode
+        response = daemon_request(argv,env)
+        if not quiet_mode:
+            print('[{0}] {1} -> {2} ({3}s)'.format(time.strftime('%H:%M:%S'),
+                  ' '.join(argv), response['status'],
+                  response.get('elapsed', 0)))
+        reply.put(response)
+
+
+def serve(address,env):
+    """Serve requests on address until interrupted.
+
+    Without address, a Unix socket in state_dir (see daemon_socket),
+    created for its owner only (mode 0600).
+    """
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+    import json
+    import os
+    import socket
+    import threading
+    queue = queue_module()
+    quiet_mode = env['quiet_mode']
+    if address is None:
+        address = daemon_socket(env)
+    try:
+        family, bind_address = daemon_address(address)
+    except ValueError as e:
+        message = "Cannot listen on {0} ({1})".format(address,e)
+        if not quiet_mode:
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(16)
+    requests = queue.Queue()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    argv = list(request['argv'])
+                except (ValueError, KeyError, TypeError):
+                    response = {'status': 2, 'output': 'Malformed request\n'}
                 else:
-                    sys.stderr.write("dbss -- {}".format(message))
-                sys.exit(80)
+                    reply = queue.Queue()
+                    requests.put((argv, reply))
+                    response = reply.get()
+                self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+    class DaemonServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        address_family = family
+        allow_reuse_address = True
+        daemon_threads = True
+
+    if family == socket.AF_UNIX:
+        socket_dir = os.path.dirname(bind_address)
+        if socket_dir != '' and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, 0o700)
+        if os.path.exists(bind_address):
+            os.remove(bind_address)
+        # socket is born owner only, no window where others may connect
+        umask = os.umask(0o177)
+        try:
+            server = DaemonServer(bind_address, RequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(bind_address, 0o600)
+    else:
+        server = DaemonServer(bind_address, RequestHandler)
+        if not quiet_mode:
+            print('Warning: TCP requests are not authenticated, any local '
+                  'user may send them')
+    # warm up: log in and read catalog before first request
+    env['catalog_ttl'] = DAEMON_CATALOG_TTL
+    fan_out(survey_databases,env)
+    worker = threading.Thread(target=daemon_worker,
+                              args=(requests,env,quiet_mode))
+    worker.daemon = True
+    worker.start()
+    if not quiet_mode:
+        print('dbss serving {0} environment on {1} (Ctrl-C to stop)'\
+              .format(env['environment'], address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        close_session(env)
+        if family == socket.AF_UNIX:
+            os.remove(bind_address)
+
+
+def call_daemon(address,argv):
+    """Send request to daemon, return its response."""
+    import json
+    import socket
+    family, connect_address = daemon_address(address)
+    connection = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        connection.connect(connect_address)
+        request = json.dumps({'argv': argv}) + '\n'
+        connection.sendall(request.encode('utf-8'))
+        reply = connection.makefile('rb')
+        response = json.loads(reply.readline().decode('utf-8'))
+    finally:
+        connection.close()
+    return response
+
+
+def call_command(config):
+    """Client for daemon, forward command and relay its output."""
+    quiet_mode = config['--quiet']
+    address = config['--listen']
+    if address is None:
+        env = configure_environment(config['--environment'],quiet_mode)
+        if env is None:
+            message = "Environment '{}' Unknown".format(config['--environment'])
+            if not quiet_mode:
+                print("Command failed: {}".format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(5)
+        address = daemon_socket(env)
+    argv = [config['<command>']]
+    if config['<database>'] is not None:
+        argv.append(config['<database>'])
+    if config['--evict'] != 'none':
+        argv.append('--evict=' + config['--evict'])
+    if config['--drop-generations']:
+        argv.append('--drop-generations')
+    if config['--jobs'] != '1':
+        argv.append('--jobs=' + config['--jobs'])
+    if config['--batch']:
+        argv.append('--batch')
+    if config['--server-side']:
+        argv.append('--server-side')
+    if config['--force']:
+        argv.append('--force')
+    if config['--force-recreate']:
+        argv.append('--force-recreate')
+    if config['--bloat'] is not None:
+        argv.append('--bloat=' + config['--bloat'])
+    if config['--refresh']:
+        argv.append('--refresh')
+    if config['--generation'] != BASELINE_GENERATION:
+        argv.append('--generation=' + config['--generation'])
+    if config['--prune']:
+        argv.append('--prune')
+    if config['--prewarm']:
+        argv.append('--prewarm')
+    if quiet_mode:
+        argv.append('--quiet')
+    try:
+        response = call_daemon(address,argv)
+    except (IOError, OSError, ValueError) as e:
+        message = "Daemon at {0} unavailable ({1})".format(address,e)
+        if not quiet_mode:
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(9)
+    if response['output'] != '':
+        if response['status'] == 0:
+            sys.stdout.write(response['output'])
+        else:
+            sys.stderr.write(response['output'])
+    sys.exit(response['status'])
+
+
+def main(argv=None,env=None):
+    """Run dbss command line (argv defaults to sys.argv).
+
+    An env may be handed in (e.g. by benchmarks or the daemon), in
+    place of the configuration named by --environment; its session is
+    then left open for the caller.
+    """
+    # help and version answered before docopt is even loaded
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv == ['--version']:
+        print(VERSION)
+        sys.exit(0)
+    if argv in (['-h'], ['--help']):
+        print(__doc__.strip('\n'))
+        sys.exit(0)
+
+    # offline commands, likewise answered without docopt
+    offline = offline_arguments(argv)
+    if offline is not None and env is None:
+        command, database, ENVIRONMENT = offline
+        env = configure_environment(ENVIRONMENT, False)
+        # unknown environment is reported below
+        if env is not None:
+            if command == 'test':
+                print_test_statements(database,env)
+            else:
+                print_white_list(env)
+            sys.exit(0)
+
+    # docopt handles remaining non-command invocations (e.g usage errors)
+    import docopt
+    config = docopt.docopt(__doc__, argv=argv, version=VERSION)
+
+    # client for daemon, no environment needed locally
+    if config['call']:
+        call_command(config)
+
+    # assemble required status
+    TEST_MODE = config['test']
+    QUIET_MODE = config['--quiet']
+    ENVIRONMENT = config['--environment']
+    database_required = config['destroy'] or config['create'] or config['restore']
+    if database_required or TEST_MODE:
+        database = config['<database>'].upper()
+    else:
+        database = '[none]'
+
+    # adjust environment-relevant configs
+    own_session = env is None
+    if env is None:
+        env = configure_environment(ENVIRONMENT, QUIET_MODE)
+    else:
+        ENVIRONMENT = env['environment']
+        QUIET_MODE = QUIET_MODE or env['quiet_mode']
+        env['quiet_mode'] = QUIET_MODE
+
+    # validate jobs (environment commands)
+    try:
+        JOBS = int(config['--jobs'])
+    except ValueError:
+        JOBS = 0
+    if JOBS < 1:
+        message = "Jobs '{}' must be a positive number".format(config['--jobs'])
+        if not QUIET_MODE:
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(7)
+
+    # validate eviction (restore commands)
+    if config['--evict'] not in RESTORE_EVICTIONS:
+        message = "Eviction '{0}' Unknown (choose from {1})"\
+                  .format(config['--evict'], ', '.join(RESTORE_EVICTIONS))
+        if not QUIET_MODE:
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(8)
+
+    # validate bloat ratio (stats)
+    if config['--bloat'] is not None:
+        try:
+            bloat = float(config['--bloat'])
+        except ValueError:
+            bloat = -1
+        if bloat < 0:
+            message = "Bloat ratio '{}' must be a number (e.g. 0.25)"\
+                      .format(config['--bloat'])
+            if not QUIET_MODE:
+                print("Command failed: {}".format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(10)
+
+    # validate timeout (create, restore)
+    if config['--timeout'] is not None:
+        try:
+            timeout = float(config['--timeout'])
+        except ValueError:
+            timeout = 0
+        if timeout <= 0:
+            message = "Timeout '{}' must be a positive number of seconds"\
+                      .format(config['--timeout'])
+            if not QUIET_MODE:
+                print("Command failed: {}".format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(13)
+
+    # validate slow ratio (history)
+    try:
+        slow = float(config['--slow'])
+    except ValueError:
+        slow = 0
+    if slow <= 0:
+        message = "Slow ratio '{}' must be a positive number (e.g. 2)"\
+                  .format(config['--slow'])
+        if not QUIET_MODE:
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(15)
+
+    # validate environment
+    if env is None:
+        message = "Environment '{}' Unknown".format(ENVIRONMENT)
+        if not QUIET_MODE:
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(5)
+
+    # validate generation (snapshot commands)
+    generation = generation_name(config['--generation'],
+                                 env['snapshot_suffix'])
+    if generation is None:
+        message = "Generation '{}' must be letters, digits, - or _"\
+                  " and not contain '{}'"\
+                  .format(config['--generation'], env['snapshot_suffix'])
         if not QUIET_MODE:
-            print('Snapshots dropped!')
+            print("Command failed: {}".format(message))
+        else:
+            sys.stderr.write("dbss -- {}".format(message))
+        sys.exit(12)
+
+    env['restore_eviction'] = config['--evict']
+    env['drop_generations'] = config['--drop-generations']
+    env['server_side'] = config['--server-side']
+    env['snapshot_generation'] = generation
+
+    # validate database - ensure in white list
+    if database_required:
+        if database not in env['db_white_list']:
+            message = "Database '{}' Unknown (check help for white list)"\
+                      .format(database)
+            if not QUIET_MODE:
+                print("Command failed: {}".format(message))
+            else:
+                sys.stderr.write("dbss -- {}".format(message))
+            sys.exit(6)
+
+    # tracing (--profile, --trace-file)
+    if config['--profile'] or config['--trace-file']:
+        env['tracer'] = new_tracer(config['--trace-file'])
+
+    # daemon mode, serve until interrupted
+    if config['serve']:
+        serve(config['--listen'],env)
+        sys.exit(0)
+
+    try:
+        with traced('command', command_name(config), env):
+            run_command(config,env,database,JOBS)
+    finally:
+        if config['--profile']:
+            print_profile(env)
+        close_tracer(env)
+        env['tracer'] = None
+        save_history(env)
+
+    # release pooled session
+    if own_session:
+        if not QUIET_MODE and env['db_session']['requests'] > 0:
+            print(session_report(env))
+        close_session(env)
 
     # program clean exit
     sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1135 @@
+"""dbss_simulator -- In-process stand-in for SQL Server (dbss driver)
+
+Models just enough of SQL Server to run dbss without an Enterprise or
+Developer edition server: sys.databases, sys.master_files (data files,
+joined to sys.databases, and layout checksums), master.dbo.sysprocesses,
+sys.dm_io_virtual_file_stats (write counts, snapshot sparse file sizes,
+and joined to sys.databases for snapshot age), sys.dm_db_index_usage_stats
+(time of last client write, joined to snapshots), sys.dm_exec_requests
+(restore progress while its simulated work elapses), user tables
+(sys.dm_db_partition_stats sizes, reads by prewarm), and database
+snapshot create, restore and drop (with the server's rules, e.g. restore
+needs exclusive access and no other snapshots of the source). dbss's
+stored procedure is kept by name once created and, when executed, runs
+its operation through the same statement handlers; its T-SQL is not
+interpreted but modelled in Python, and only the text modelled (by
+checksum) may be installed.
+
+Only the statement shapes dbss issues are understood, anything else is
+refused with a syntax error, so a new statement in dbss.py needs a
+matching handler here.
+
+Select with env['db_driver'] = 'simulator'. Servers live for the life
+of the process (keyed by env['db_server']) and are seeded from the
+white list. Optional env settings...
+
+   sim_latency        seconds of network latency per batch
+   sim_login_latency  seconds per login
+   sim_page_cost      seconds per 1000 pages of snapshot create/restore
+   sim_databases      databases to seed (default: env['db_white_list'])
+   sim_clients        client connections opened per seeded database
+
+Each server counts logins, batches (round trips), statements and rows
+returned, see server_stats. write_database stands in for a client
+changing data (so snapshots grow, copy-on-write).
+"""
+
+import re
+import threading
+import time
+import zlib
+
+# simulated servers by name, shared by all connections in process
+SERVERS = dict()
+SERVERS_LOCK = threading.Lock()
+
+DATA_DIR = r"D:\Program Files\Microsoft SQL Server" \
+           r"\MSSQL10_50.MSSQLSERVER\MSSQL\DATA"
+
+# spid up through 50 are reserved for sql server internals
+FIRST_SPID = 51
+
+# checksum of the dbss procedure text Batch.procedure_operation models
+# ... (see procedure_checksum), a changed procedure is refused until
+# ... the model is brought in line and this updated
+MODELLED_PROCEDURE = 0xb9156cad
+
+
+class SimulatedError(Exception):
+    """SQL Server error raised by simulator (mirrors _mssql message)."""
+
+    def __init__(self, number, text, severity=16):
+        self.number = number
+        self.text = text
+        self.message = "SQL Server message {0}, severity {1}: {2}"\
+                       .format(number, severity, text)
+        Exception.__init__(self, self.message)
+
+
+# server state
+def server_for(env):
+    """Obtain simulated server named in env, seeding it when new."""
+    name = env['db_server']
+    with SERVERS_LOCK:
+        if name not in SERVERS:
+            SERVERS[name] = new_server(env)
+        return SERVERS[name]
+
+
+def reset_servers():
+    """Discard all simulated servers (fresh state for next login)."""
+    with SERVERS_LOCK:
+        SERVERS.clear()
+
+
+def new_server(env):
+    """Create simulated server holding system and seeded databases."""
+    server = dict()
+    server['name'] = env['db_server']
+    server['lock'] = threading.RLock()
+    server['databases'] = dict()
+    server['processes'] = dict()
+    # procedure text by name (dbss's own, see Batch.execute_procedure)
+    server['procedures'] = dict()
+    server['next_database_id'] = 1
+    server['next_spid'] = FIRST_SPID
+    server['stats'] = new_stats()
+    for db in ('master', 'tempdb', 'model', 'msdb'):
+        add_database(server, db, 64)
+    seed_list = env.get('sim_databases', env['db_white_list'])
+    for db in seed_list:
+        add_database(server, db, seed_pages(db))
+    clients = env.get('sim_clients', 0)
+    for db in seed_list:
+        for i in range(clients):
+            open_process(server, None, server['databases'][db]['database_id'])
+    return server
+
+
+def new_stats():
+    """Create zeroed server counters."""
+    stats = dict()
+    stats['logins'] = 0
+    stats['batches'] = 0
+    stats['statements'] = 0
+    stats['rows'] = 0
+    return stats
+
+
+def server_stats(env):
+    """Copy of counters for server named in env."""
+    server = server_for(env)
+    with server['lock']:
+        return dict(server['stats'])
+
+
+def write_database(env, db, pages=1):
+    """Simulate client writing pages of database (as a test would)."""
+    server = server_for(env)
+    with server['lock']:
+        database = find_database(server, db)
+        # log flush on commit, data pages follow at checkpoint
+        database['writes'] += 1
+        database['last_user_update'] = time.time()
+        for snapshot in server['databases'].values():
+            if snapshot['snapshot_of'] == database['name']:
+                # first write of a page copies it to snapshot
+                data_pages = 0
+                for data_file in database['files']:
+                    if data_file['type_desc'] != 'LOG':
+                        data_pages += data_file['size']
+                snapshot['sparse_pages'] = min(data_pages,
+                                               snapshot['sparse_pages'] + pages)
+                snapshot['writes'] += 1
+
+
+def seed_pages(db):
+    """Deterministic data size (8 KB pages) for seeded database."""
+    return 1024 + zlib.crc32(db.encode('utf-8')) % 64000
+
+
+def add_database(server, db, pages, snapshot_of=None, files=None):
+    """Register database (and its files) with server."""
+    database = dict()
+    database['name'] = db
+    database['database_id'] = server['next_database_id']
+    database['state_desc'] = 'ONLINE'
+    database['user_access_desc'] = 'MULTI_USER'
+    database['snapshot_of'] = snapshot_of
+    database['create_date'] = time.time()
+    # writes to files, pages copied into snapshot sparse files
+    database['writes'] = 0
+    database['sparse_pages'] = 0
+    # time of last client write (sys.dm_db_index_usage_stats)
+    database['last_user_update'] = None
+    server['next_database_id'] += 1
+    if files is None:
+        files = list()
+        # every fourth database gets a second data file
+        data_files = 1
+        if zlib.crc32(db.encode('utf-8')) % 4 == 0:
+            data_files = 2
+        for i in range(data_files):
+            data_file = dict()
+            data_file['name'] = db + '_Data' + ('' if i == 0 else str(i + 1))
+            extension = 'mdf' if i == 0 else 'ndf'
+            data_file['physical_name'] = "{0}\\{1}.{2}"\
+                .format(DATA_DIR, data_file['name'], extension)
+            data_file['type_desc'] = 'ROWS'
+            data_file['size'] = pages // data_files
+            files.append(data_file)
+        log_file = dict()
+        log_file['name'] = db + '_Log'
+        log_file['physical_name'] = "{0}\\{1}_log.ldf".format(DATA_DIR, db)
+        log_file['type_desc'] = 'LOG'
+        log_file['size'] = 128
+        files.append(log_file)
+    database['files'] = files
+    # user tables (data read by prewarm), snapshots have their source's
+    database['tables'] = list()
+    if snapshot_of is None:
+        database['tables'] = seed_tables(db, pages)
+    server['databases'][db] = database
+    return database
+
+
+def seed_tables(db, pages):
+    """Deterministic user tables (schema, name, pages, indexes) of database."""
+    tables = list()
+    table_count = 3 + zlib.crc32(db.encode('utf-8')) % 6
+    for i in range(table_count):
+        table = dict()
+        table['schema'] = 'dbo'
+        table['name'] = 'T{0:02d}'.format(i + 1)
+        # largest first, each table half the one before
+        table['pages'] = max(1, pages // (2 ** (i + 1)))
+        table['indexes'] = ['PK_' + table['name'], 'IX_' + table['name']]
+        tables.append(table)
+    return tables
+
+
+def find_database(server, db):
+    """Look up database by name (case-insensitive, as SQL Server)."""
+    for name in server['databases']:
+        if name.upper() == db.upper():
+            return server['databases'][name]
+    return None
+
+
+def database_name(server, database_id):
+    """Look up database name by id."""
+    for database in server['databases'].values():
+        if database['database_id'] == database_id:
+            return database['name']
+    return None
+
+
+def open_process(server, connection, dbid):
+    """Register client process (spid) with server."""
+    spid = server['next_spid']
+    server['next_spid'] += 1
+    process = dict()
+    process['spid'] = spid
+    process['dbid'] = dbid
+    process['connection'] = connection
+    server['processes'][spid] = process
+    return process
+
+
+# client connection
+def connect(env):
+    """Log in to simulated server (driver entry point)."""
+    server = server_for(env)
+    time.sleep(env.get('sim_login_latency', 0))
+    return SimulatedConnection(server, env)
+
+
+class SimulatedConnection(object):
+    """Connection to simulated server, following the _mssql interface."""
+
+    def __init__(self, server, env):
+        self.server = server
+        self.latency = env.get('sim_latency', 0)
+        self.page_cost = env.get('sim_page_cost', 0)
+        self.rows = list()
+        self.connected = True
+        with server['lock']:
+            server['stats']['logins'] += 1
+            master = server['databases']['master']['database_id']
+            self.process = open_process(server, self, master)
+
+    def execute_non_query(self, sql):
+        self.execute(sql)
+        self.rows = list()
+
+    def execute_query(self, sql):
+        self.rows = self.execute(sql)
+
+    def __iter__(self):
+        rows = self.rows
+        self.rows = list()
+        return iter(rows)
+
+    def cancel(self):
+        self.rows = list()
+
+    def close(self):
+        with self.server['lock']:
+            self.disconnect()
+
+    def disconnect(self):
+        """Drop process (server lock held)."""
+        self.connected = False
+        self.server['processes'].pop(self.process['spid'], None)
+
+    def execute(self, sql):
+        """Run batch, return first result set (as list of rows)."""
+        if not self.connected:
+            raise SimulatedError(20047, "DBPROCESS is dead or not enabled.", 9)
+        time.sleep(self.latency)
+        batch = Batch(self)
+        with self.server['lock']:
+            self.server['stats']['batches'] += 1
+            try:
+                batch.run(parse_batch(sql))
+            finally:
+                self.server['stats']['rows'] += len(batch.result or [])
+        # simulated work (e.g. restore i/o) elapses outside server lock
+        if batch.cost > 0:
+            self.work(batch)
+        return batch.result or list()
+
+    def work(self, batch):
+        """Spend batch's cost, listed in dm_exec_requests meanwhile.
+
+        The statement's effect is already applied, KILL only cuts the
+        wait short (with the error the client would see).
+        """
+        request = dict()
+        request['command'] = batch.command
+        request['started'] = time.time()
+        request['cost'] = batch.cost
+        with self.server['lock']:
+            self.process['request'] = request
+        finish = request['started'] + batch.cost
+        try:
+            while time.time() < finish:
+                if not self.connected:
+                    raise SimulatedError(596, "Cannot continue the execution "
+                                         "because the session is in the "
+                                         "kill state.", 21)
+                time.sleep(max(0, min(0.01, finish - time.time())))
+        finally:
+            with self.server['lock']:
+                self.process.pop('request', None)
+
+
+# batch parsing
+# ... a batch is a list of nodes, ('statement', text) or
+# ... ('try', try_nodes, catch_nodes)
+BLOCK_WORDS = ('BEGIN TRY', 'END TRY', 'BEGIN CATCH', 'END CATCH')
+
+
+def split_batch(sql):
+    """Split batch into statements and TRY/CATCH keywords."""
+    tokens = list()
+    current = ''
+    quoted = False
+    position = 0
+    while position < len(sql):
+        char = sql[position]
+        if char == "'":
+            quoted = not quoted
+        if not quoted:
+            if char == ';':
+                tokens.append(current)
+                current = ''
+                position += 1
+                continue
+            word = block_word(sql, position)
+            if word is not None and (position == 0 or not
+                                     (sql[position - 1].isalnum() or
+                                      sql[position - 1] == '_')):
+                tokens.append(current)
+                tokens.append(word)
+                current = ''
+                position += len(word)
+                continue
+        current += char
+        position += 1
+    tokens.append(current)
+    stripped = list()
+    for token in tokens:
+        token = ' '.join(token.split())
+        if token != '':
+            stripped.append(token)
+    return stripped
+
+
+def block_word(sql, position):
+    """TRY/CATCH keyword starting at position (or None)."""
+    for word in BLOCK_WORDS:
+        first, second = word.split(' ')
+        pattern = r'{0}\s+{1}\b'.format(first, second)
+        match = re.compile(pattern, re.IGNORECASE).match(sql, position)
+        if match is not None:
+            # normalized keyword, consumed length comes from match
+            return sql[position:match.end()]
+    return None
+
+
+def parse_batch(sql):
+    """Parse batch text into nodes."""
+    # procedure body is stored, not run (alone in its batch)
+    if re.match(r"\s*CREATE\s+PROCEDURE\b", sql, re.IGNORECASE):
+        return [('statement', ' '.join(sql.split()))]
+    tokens = split_batch(sql)
+    nodes, position = parse_nodes(tokens, 0, None)
+    return nodes
+
+
+def parse_nodes(tokens, position, closing):
+    """Parse tokens until closing keyword, return nodes and position."""
+    nodes = list()
+    while position < len(tokens):
+        token = tokens[position]
+        keyword = ' '.join(token.upper().split())
+        if keyword == closing:
+            return nodes, position + 1
+        if keyword == 'BEGIN TRY':
+            try_nodes, position = parse_nodes(tokens, position + 1, 'END TRY')
+            if position >= len(tokens) or \
+               ' '.join(tokens[position].upper().split()) != 'BEGIN CATCH':
+                raise SimulatedError(102, "Incorrect syntax near 'END TRY'.",
+                                     15)
+            catch_nodes, position = parse_nodes(tokens, position + 1,
+                                                'END CATCH')
+            nodes.append(('try', try_nodes, catch_nodes))
+            continue
+        if keyword in BLOCK_WORDS:
+            raise SimulatedError(102, "Incorrect syntax near '{}'."
+                                 .format(token), 15)
+        nodes.append(('statement', token))
+        position += 1
+    if closing is not None:
+        raise SimulatedError(102, "Incorrect syntax, missing '{}'."
+                             .format(closing), 15)
+    return nodes, position
+
+
+# batch execution
+class Batch(object):
+    """Execution of one batch on a connection (server lock held)."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.server = connection.server
+        self.process = connection.process
+        self.tables = dict()
+        self.variables = dict()
+        self.error = None
+        self.result = None
+        self.cost = 0
+        self.command = None
+
+    def run(self, nodes):
+        for node in nodes:
+            if node[0] == 'try':
+                try:
+                    self.run(node[1])
+                except SimulatedError as e:
+                    outer_error = self.error
+                    self.error = e
+                    self.run(node[2])
+                    self.error = outer_error
+            else:
+                self.statement(node[1])
+
+    def statement(self, sql):
+        self.server['stats']['statements'] += 1
+        for pattern, handler in STATEMENTS:
+            match = pattern.match(sql)
+            if match is not None:
+                rows = handler(self, match)
+                if rows is not None and self.result is None:
+                    self.result = rows
+                return
+        raise SimulatedError(102, "Incorrect syntax near '{}' "
+                             "(statement not modelled by simulator)."
+                             .format(sql[:40]), 15)
+
+    # helpers
+    def database(self, db):
+        database = find_database(self.server, db)
+        if database is None:
+            raise SimulatedError(911, "Database '{}' does not exist. "
+                                 "Make sure that the name is entered "
+                                 "correctly.".format(db))
+        return database
+
+    def value(self, text):
+        """Evaluate literal or error function."""
+        text = text.strip()
+        upper = text.upper()
+        if upper == 'NULL':
+            return None
+        if upper == 'ERROR_NUMBER()':
+            return self.error.number if self.error else None
+        if upper == 'ERROR_MESSAGE()':
+            return self.error.text if self.error else None
+        if text.startswith('@'):
+            if upper not in self.variables:
+                raise SimulatedError(137, "Must declare the scalar variable "
+                                     "\"{}\".".format(text))
+            return self.variables[upper]
+        if text.startswith("N'"):
+            text = text[1:]
+        if text.startswith("'") and text.endswith("'"):
+            return text[1:-1].replace("''", "'")
+        return int(text)
+
+    # statements
+    def noop(self, match):
+        return None
+
+    def use(self, match):
+        database = self.database(match.group(1))
+        self.process['dbid'] = database['database_id']
+
+    def this_spid(self, match):
+        return [make_row([(match.group(1) or '', self.process['spid'])])]
+
+    def exec_requests(self, match):
+        process = self.server['processes'].get(int(match.group(1)))
+        if process is None or process.get('request') is None:
+            return list()
+        request = process['request']
+        # only RESTORE (of the statements dbss runs) reports progress
+        percent = 0.0
+        remaining = 0
+        if request['command'] == 'RESTORE DATABASE':
+            elapsed = time.time() - request['started']
+            percent = min(100.0, 100.0 * elapsed / request['cost'])
+            remaining = max(0, int((request['cost'] - elapsed) * 1000))
+        return [make_row([('command', request['command']),
+                          ('percent_complete', percent),
+                          ('estimated_completion_time', remaining)])]
+
+    def sysprocesses(self, match):
+        dbid_list = None
+        if match.group(1) is not None:
+            dbid_list = list()
+            for name in self.server['databases']:
+                if name_filter(match.group(1), name):
+                    database = self.server['databases'][name]
+                    dbid_list.append(database['database_id'])
+        rows = list()
+        for spid in sorted(self.server['processes']):
+            process = self.server['processes'][spid]
+            if dbid_list is not None and process['dbid'] not in dbid_list:
+                continue
+            if spid > 50:
+                rows.append(make_row([('spid', spid)]))
+        return rows
+
+    def kill(self, match):
+        spid = int(match.group(1))
+        if spid == self.process['spid']:
+            raise SimulatedError(6104, "Cannot use KILL to kill your own "
+                                 "process.")
+        process = self.server['processes'].get(spid)
+        if process is None:
+            raise SimulatedError(6106, "Process ID {} is not an active "
+                                 "process ID.".format(spid))
+        if process['connection'] is not None:
+            process['connection'].disconnect()
+        else:
+            self.server['processes'].pop(spid)
+
+    def databases(self, match):
+        where = match.group(2)
+        rows = list()
+        for name in sorted(self.server['databases']):
+            database = self.server['databases'][name]
+            if where is not None and not name_filter(where, name):
+                continue
+            columns = list()
+            for column in match.group(1).split(','):
+                column = column.strip()
+                columns.append((column, database[column]))
+            rows.append(make_row(columns))
+        return rows
+
+    def master_files(self, match):
+        rows = list()
+        for name in sorted(self.server['databases']):
+            database = self.server['databases'][name]
+            if not name_filter(match.group(1), name):
+                continue
+            for data_file in database['files']:
+                if data_file['type_desc'] == 'LOG':
+                    continue
+                rows.append(make_row([('db', name),
+                                      ('name', data_file['name']),
+                                      ('physical_name',
+                                       data_file['physical_name']),
+                                      ('size', data_file['size'])]))
+        return rows
+
+    def master_file_layouts(self, match):
+        rows = list()
+        for name in sorted(self.server['databases']):
+            database = self.server['databases'][name]
+            if not name_filter(match.group(1), name):
+                continue
+            # stands in for CHECKSUM_AGG, changes with any name or path
+            layout = list()
+            for file_id, data_file in enumerate(database['files']):
+                if data_file['type_desc'] != 'LOG':
+                    layout.append('{0}|{1}|{2}'.format(
+                        file_id + 1, data_file['name'],
+                        data_file['physical_name']))
+            checksum = zlib.crc32('\n'.join(layout).encode('utf-8'))
+            rows.append(make_row([('name', name),
+                                  ('layout', checksum & 0x7fffffff)]))
+        return rows
+
+    def snapshot_writes(self, match):
+        rows = list()
+        for name in sorted(self.server['databases']):
+            snapshot = self.server['databases'][name]
+            if snapshot['snapshot_of'] is None or \
+               not name_filter(match.group(1), name):
+                continue
+            source = self.database(snapshot['snapshot_of'])
+            # no usage stats (NULL) counts as written, as dbss asks
+            written = source['last_user_update'] is None or \
+                source['last_user_update'] > snapshot['create_date']
+            rows.append(make_row([('name', name),
+                                  ('age', int(time.time() -
+                                              snapshot['create_date'])),
+                                  ('written', 1 if written else 0)]))
+        return rows
+
+    def largest_tables(self, match):
+        database = self.database(match.group(2))
+        rows = list()
+        # seeded largest first
+        for table in database['tables'][:int(match.group(1))]:
+            rows.append(make_row([('schema_name', table['schema']),
+                                  ('table_name', table['name']),
+                                  ('pages', table['pages'])]))
+        return rows
+
+    def read_table(self, match):
+        database = self.database(match.group(1))
+        table = None
+        for candidate in database['tables']:
+            if candidate['schema'].upper() == match.group(2).upper() and \
+               candidate['name'].upper() == match.group(3).upper():
+                table = candidate
+        if table is None:
+            raise SimulatedError(208, "Invalid object name '{0}.{1}.{2}'."
+                                 .format(match.group(1), match.group(2),
+                                         match.group(3)))
+        index = match.group(4)
+        if index != '0' and index.upper() not in \
+           [name.upper() for name in table['indexes']]:
+            raise SimulatedError(308, "Index '{0}' on table '{1}' (specified "
+                                 "in the FROM clause) does not exist."
+                                 .format(index, table['name']))
+        # pages read from disk into the buffer pool
+        self.cost += self.connection.page_cost * table['pages'] / 1000.0
+        self.command = 'SELECT'
+        return [make_row([('row_count', table['pages'] * 40)])]
+
+    def virtual_file_stats(self, match):
+        rows = list()
+        for name in sorted(self.server['databases']):
+            database = self.server['databases'][name]
+            if not name_filter(match.group(2), name):
+                continue
+            if database['snapshot_of'] is not None:
+                # sparse file holds only pages copied on write
+                size = database['sparse_pages'] * 8192
+            else:
+                size = 0
+                for data_file in database['files']:
+                    # joined to sys.master_files, log files left out
+                    if match.group(1) and data_file['type_desc'] == 'LOG':
+                        continue
+                    size += data_file['size'] * 8192
+            rows.append(make_row([('name', name),
+                                  ('writes', database['writes']),
+                                  ('bytes', size)]))
+        return rows
+
+    def snapshot_generations(self, match):
+        rows = list()
+        for name in sorted(self.server['databases']):
+            database = self.server['databases'][name]
+            if database['snapshot_of'] is None:
+                continue
+            if not re.match(like_pattern(match.group(1)), name,
+                            re.IGNORECASE):
+                continue
+            age = int(time.time() - database['create_date'])
+            rows.append(make_row([('name', name), ('age', age),
+                                  ('bytes', database['sparse_pages'] * 8192)]))
+        return rows
+
+    def create_snapshot(self, match):
+        snapshot_db = match.group(1)
+        source = self.database(match.group(3))
+        if find_database(self.server, snapshot_db) is not None:
+            raise SimulatedError(1801, "Database '{}' already exists. "
+                                 "Choose a different database name."
+                                 .format(snapshot_db))
+        if source['snapshot_of'] is not None:
+            raise SimulatedError(1823, "A database snapshot cannot be "
+                                 "created because it failed to start.")
+        if source['state_desc'] != 'ONLINE':
+            raise SimulatedError(1823, "A database snapshot cannot be "
+                                 "created because the source is not "
+                                 "online.")
+        clauses = re.findall(r"\(\s*NAME\s*=\s*(\w+)\s*,\s*"
+                             r"FILENAME\s*=\s*'([^']*)'\s*\)",
+                             match.group(2), re.IGNORECASE)
+        source_files = dict()
+        for data_file in source['files']:
+            if data_file['type_desc'] != 'LOG':
+                source_files[data_file['name'].upper()] = data_file
+        files = list()
+        for name, filename in clauses:
+            if name.upper() not in source_files:
+                raise SimulatedError(5014, "The file '{0}' does not exist "
+                                     "in database '{1}'."
+                                     .format(name, source['name']))
+            if self.file_in_use(filename):
+                raise SimulatedError(5170, "Cannot create file '{}' "
+                                     "because it already exists."
+                                     .format(filename))
+            data_file = dict(source_files.pop(name.upper()))
+            data_file['physical_name'] = filename
+            files.append(data_file)
+        if source_files:
+            missing = sorted(source_files)[0]
+            raise SimulatedError(5127, "All files must be specified for "
+                                 "database snapshot creation. Missing the "
+                                 "file \"{}\".".format(missing))
+        add_database(self.server, snapshot_db, 0, source['name'], files)
+        self.cost += self.work_cost(source)
+        self.command = 'CREATE DATABASE'
+
+    def restore_snapshot(self, match):
+        source = self.database(match.group(1))
+        snapshot = find_database(self.server, match.group(2))
+        if snapshot is None or snapshot['snapshot_of'] != source['name']:
+            raise SimulatedError(3137, "Database cannot be reverted. Either "
+                                 "the primary or the snapshot names are "
+                                 "improperly specified, all other snapshots "
+                                 "have not been dropped, or there are "
+                                 "missing files.")
+        for database in self.server['databases'].values():
+            if database['snapshot_of'] == source['name'] and \
+               database is not snapshot:
+                raise SimulatedError(3137, "Database cannot be reverted. "
+                                     "Either the primary or the snapshot "
+                                     "names are improperly specified, all "
+                                     "other snapshots have not been dropped, "
+                                     "or there are missing files.")
+        self.exclusive_access(source)
+        self.cost += self.work_cost(source)
+        self.command = 'RESTORE DATABASE'
+        # pages copied back from snapshot (and log rebuilt)
+        source['writes'] += snapshot['sparse_pages'] + 1
+        # database restarts, index usage stats start over
+        source['last_user_update'] = None
+
+    def drop_database(self, match):
+        database = find_database(self.server, match.group(1))
+        if database is None:
+            raise SimulatedError(3701, "Cannot drop the database '{}', "
+                                 "because it does not exist or you do not "
+                                 "have permission.".format(match.group(1)))
+        for snapshot in self.server['databases'].values():
+            if snapshot['snapshot_of'] == database['name']:
+                raise SimulatedError(3709, "Cannot drop the database while "
+                                     "the database snapshot \"{}\" refers "
+                                     "to it. Drop that database first."
+                                     .format(snapshot['name']))
+        self.exclusive_access(database)
+        del self.server['databases'][database['name']]
+
+    def single_user(self, match):
+        database = self.database(match.group(1))
+        # rollback immediate: other sessions in database are ended
+        for process in list(self.server['processes'].values()):
+            if process['dbid'] == database['database_id'] and \
+               process is not self.process:
+                if process['connection'] is not None:
+                    process['connection'].disconnect()
+                else:
+                    self.server['processes'].pop(process['spid'])
+        database['user_access_desc'] = 'SINGLE_USER'
+
+    def multi_user(self, match):
+        database = self.database(match.group(1))
+        database['user_access_desc'] = 'MULTI_USER'
+
+    def drop_procedure(self, match):
+        self.server['procedures'].pop(match.group(1).upper(), None)
+
+    def create_procedure(self, match):
+        name = match.group(1).upper()
+        if name in self.server['procedures']:
+            raise SimulatedError(2714, "There is already an object named "
+                                 "'{}' in the database.".format(match.group(1)))
+        if procedure_checksum(match.group(0)) != MODELLED_PROCEDURE:
+            raise SimulatedError(50000, "Procedure '{}' is not the one "
+                                 "simulated (update procedure_operation "
+                                 "and MODELLED_PROCEDURE to match)."
+                                 .format(match.group(1)))
+        self.server['procedures'][name] = match.group(0)
+
+    def execute_procedure(self, match):
+        if match.group(1).upper() not in self.server['procedures']:
+            raise SimulatedError(2812, "Could not find stored procedure "
+                                 "'master.dbo.{}'.".format(match.group(1)))
+        parameters = dict()
+        for text in split_values(match.group(2)):
+            name, value = text.split('=', 1)
+            parameters[name.strip().upper()] = self.value(value)
+        operation = parameters['@OPERATION']
+        suffix = parameters['@SUFFIX']
+        rows = list()
+        for db in parameters['@DATABASES'].split(','):
+            db = db.strip()
+            if db == '':
+                continue
+            try:
+                self.procedure_operation(operation, db, suffix,
+                                         parameters['@FILE_TYPE'],
+                                         parameters.get('@EVICT', 'none'))
+                rows.append(make_row([('name', db), ('error_number', 0),
+                                      ('error_message', None)]))
+            except SimulatedError as e:
+                rows.append(make_row([('name', db),
+                                      ('error_number', e.number),
+                                      ('error_message', e.text)]))
+        return rows
+
+    def procedure_operation(self, operation, db, suffix, file_type, evict):
+        """One database's work in dbss procedure (statements it issues)."""
+        source = find_database(self.server, db)
+        state = 'missing' if source is None else source['state_desc']
+        if operation in ('create', 'restore') and state != 'ONLINE':
+            raise SimulatedError(50000, "Database '{0}' is '{1}', status "
+                                 "must be ONLINE".format(db, state))
+        dbss = db + suffix
+        if operation == 'create':
+            if find_database(self.server, dbss) is not None:
+                self.statement('DROP DATABASE {}'.format(dbss))
+            data_files = list()
+            for data_file in source['files']:
+                if data_file['type_desc'] != 'LOG':
+                    data_files.append(data_file)
+            clauses = list()
+            for file_number, data_file in enumerate(data_files):
+                path = data_file['physical_name']
+                filename = path[:path.rfind('.')] + suffix
+                if len(data_files) > 1:
+                    filename += '_{:02d}'.format(file_number + 1)
+                filename += '.' + file_type
+                clauses.append("( NAME = {0}, FILENAME = '{1}' )"
+                               .format(data_file['name'], filename))
+            self.statement('CREATE DATABASE {0} ON {1} AS SNAPSHOT OF {2}'
+                           .format(dbss, ', '.join(clauses), db))
+        elif operation == 'restore':
+            if find_database(self.server, dbss) is None:
+                raise SimulatedError(50000, 'Snapshot {} does not exist'
+                                     .format(dbss))
+            for other in self.source_snapshots(source):
+                if other.upper() != dbss.upper():
+                    self.statement('DROP DATABASE {}'.format(other))
+            if evict == 'kill':
+                for spid in sorted(self.server['processes']):
+                    process = self.server['processes'][spid]
+                    if process['dbid'] == source['database_id'] and \
+                       spid > 50 and process is not self.process:
+                        self.statement('KILL {}'.format(spid))
+            if evict == 'single_user':
+                self.statement('ALTER DATABASE {} SET SINGLE_USER WITH '
+                               'ROLLBACK IMMEDIATE'.format(db))
+            try:
+                self.statement("RESTORE DATABASE {0} FROM DATABASE_SNAPSHOT "
+                               "= '{1}'".format(db, dbss))
+            finally:
+                if evict == 'single_user':
+                    self.statement('ALTER DATABASE {} SET MULTI_USER'
+                                   .format(db))
+        elif operation == 'drop':
+            if source is None:
+                return
+            pattern = like_pattern(dbss.replace('_', '[_]') + '%')
+            for other in self.source_snapshots(source):
+                if re.match(pattern, other, re.IGNORECASE):
+                    self.statement('DROP DATABASE {}'.format(other))
+        else:
+            raise SimulatedError(50000, 'Operation {} unknown'
+                                 .format(operation))
+
+    def source_snapshots(self, source):
+        snapshot_list = list()
+        for name in sorted(self.server['databases']):
+            if self.server['databases'][name]['snapshot_of'] == \
+               source['name']:
+                snapshot_list.append(name)
+        return snapshot_list
+
+    def declare_variable(self, match):
+        self.variables[match.group(1).upper()] = self.value(match.group(2))
+
+    def raiserror(self, match):
+        arguments = list()
+        if match.group(2) is not None:
+            for text in split_values(match.group(2)):
+                arguments.append(self.value(text))
+        raise SimulatedError(50000, raiserror_message(
+            self.value(match.group(1)), arguments))
+
+    def declare_table(self, match):
+        self.tables[match.group(1).upper()] = list()
+
+    def insert_values(self, match):
+        table = self.tables.get(match.group(1).upper())
+        if table is None:
+            raise SimulatedError(1087, "Must declare the table variable "
+                                 "\"{}\".".format(match.group(1)))
+        values = list()
+        for text in split_values(match.group(2)):
+            values.append(self.value(text))
+        table.append(values)
+
+    def select_table(self, match):
+        table = self.tables.get(match.group(2).upper())
+        if table is None:
+            raise SimulatedError(1087, "Must declare the table variable "
+                                 "\"{}\".".format(match.group(2)))
+        columns = list()
+        for column in match.group(1).split(','):
+            columns.append(column.strip())
+        rows = list()
+        for values in table:
+            rows.append(make_row(list(zip(columns, values))))
+        return rows
+
+    def exclusive_access(self, database):
+        """Refuse when other processes use database."""
+        for process in self.server['processes'].values():
+            if process['dbid'] == database['database_id'] and \
+               process is not self.process:
+                raise SimulatedError(3101, "Exclusive access could not be "
+                                     "obtained because the database is in "
+                                     "use.")
+
+    def file_in_use(self, filename):
+        for database in self.server['databases'].values():
+            for data_file in database['files']:
+                if data_file['physical_name'].upper() == filename.upper():
+                    return True
+        return False
+
+    def work_cost(self, database):
+        """Seconds of simulated i/o for snapshot create/restore."""
+        pages = 0
+        for data_file in database['files']:
+            if data_file['type_desc'] != 'LOG':
+                pages += data_file['size']
+        connection = self.connection
+        return connection.page_cost * pages / 1000.0
+
+
+def make_row(columns):
+    """Row keyed by column name and position (as _mssql rows)."""
+    row = dict()
+    for position, (name, value) in enumerate(columns):
+        row[position] = value
+        if name != '':
+            row[name] = value
+    return row
+
+
+def split_values(text):
+    """Split comma-separated values, respecting quotes and parentheses."""
+    values = list()
+    current = ''
+    quoted = False
+    depth = 0
+    for char in text:
+        if char == "'":
+            quoted = not quoted
+        if not quoted:
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif char == ',' and depth == 0:
+                values.append(current)
+                current = ''
+                continue
+        current += char
+    values.append(current)
+    return values
+
+
+def procedure_checksum(text):
+    """Checksum of procedure text, whitespace and dbss version ignored."""
+    text = ' '.join(text.split())
+    text = re.sub(r"-- dbss \S+:", "-- dbss:", text)
+    return zlib.crc32(text.encode('utf-8')) & 0xffffffff
+
+
+def raiserror_message(message, arguments):
+    """Substitute RAISERROR arguments into its message, printf style.
+
+    As on the server, the message is always a format: a % without an
+    argument prints (null), an unknown specification is an error.
+    """
+    arguments = list(arguments)
+
+    def substitute(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is None:
+            raise SimulatedError(2787, "Invalid format specification: "
+                                 "'{}'.".format(match.group(0)))
+        if arguments == []:
+            return '(null)'
+        return str(arguments.pop(0))
+
+    return re.sub(r"%%|%[-+ 0#]*\d*(?:\.\d+)?(?:h|l|I64)?([diosuxX])?",
+                  substitute, message)
+
+
+def name_filter(where, name):
+    """Evaluate dbss name filter (IN list and LIKE terms joined by OR)."""
+    for term in re.split(r'\s+OR\s+', where, flags=re.IGNORECASE):
+        in_match = re.match(r"(?:name|DB_NAME\((?:f\.)?database_id\))\s+IN\s*"
+                            r"\((.*)\)$", term.strip(), re.IGNORECASE)
+        like_match = re.match(r"name\s+LIKE\s+'(.*)'$", term.strip(),
+                              re.IGNORECASE)
+        if in_match is not None:
+            for value in split_values(in_match.group(1)):
+                value = value.strip()
+                if value.startswith("N'"):
+                    value = value[1:]
+                if value.strip("'").replace("''", "'").upper() == \
+                   name.upper():
+                    return True
+        elif like_match is not None:
+            if re.match(like_pattern(like_match.group(1)), name,
+                        re.IGNORECASE):
+                return True
+        else:
+            raise SimulatedError(102, "Incorrect syntax near '{}' "
+                                 "(filter not modelled by simulator)."
+                                 .format(term[:40]), 15)
+    return False
+
+
+def like_pattern(like):
+    """Translate LIKE pattern to regular expression."""
+    pattern = ''
+    position = 0
+    while position < len(like):
+        char = like[position]
+        if char == '[':
+            close = like.index(']', position)
+            pattern += re.escape(like[position + 1:close])
+            position = close + 1
+            continue
+        if char == '%':
+            pattern += '.*'
+        elif char == '_':
+            pattern += '.'
+        else:
+            pattern += re.escape(char)
+        position += 1
+    return pattern + '$'
+
+
+# statement shapes issued by dbss (matched against normalized text)
+STATEMENTS = [
+    (r"SET NOCOUNT (ON|OFF)$", Batch.noop),
+    (r"USE \[?(\w+)\]?$", Batch.use),
+    (r"SELECT @@SPID(?: AS (\w+))?$", Batch.this_spid),
+    (r"SELECT command, percent_complete, estimated_completion_time "
+     r"FROM sys\.dm_exec_requests WHERE session_id = (\d+)$",
+     Batch.exec_requests),
+    (r"SELECT spid FROM master\.dbo\.sysprocesses WHERE spid > 50"
+     r"(?: AND dbid IN \(SELECT database_id FROM sys\.databases "
+     r"WHERE (.*)\))?$", Batch.sysprocesses),
+    (r"KILL (\d+)$", Batch.kill),
+    (r"SELECT ((?:\w+)(?:, \w+)*) FROM sys\.databases"
+     r"(?: WHERE (.*?))?(?: ORDER BY name)?$", Batch.databases),
+    (r"SELECT d\.name AS db, f\.name, f\.physical_name, f\.size "
+     r"FROM sys\.master_files f JOIN sys\.databases d "
+     r"ON d\.database_id = f\.database_id WHERE f\.type_desc<>'LOG' "
+     r"AND d\.(.*) ORDER BY d\.name, f\.file_id$", Batch.master_files),
+    (r"SELECT DB_NAME\(database_id\) AS name, "
+     r"CHECKSUM_AGG\(CHECKSUM\(file_id, name, physical_name\)\) AS layout "
+     r"FROM sys\.master_files WHERE type_desc<>'LOG' AND (.*) "
+     r"GROUP BY database_id$", Batch.master_file_layouts),
+    (r"SELECT DB_NAME\((?:f\.)?database_id\) AS name, "
+     r"(?:SUM\(num_of_writes\) AS writes, )?"
+     r"SUM\((?:f\.)?size_on_disk_bytes\) AS bytes FROM "
+     r"sys\.dm_io_virtual_file_stats\(NULL, NULL\)"
+     r"(?: f (JOIN sys\.master_files m ON m\.database_id = f\.database_id "
+     r"AND m\.file_id = f\.file_id) WHERE m\.type_desc<>'LOG' AND| WHERE) "
+     r"(.*) GROUP BY (?:f\.)?database_id$", Batch.virtual_file_stats),
+    (r"SELECT d\.name, DATEDIFF\(second, d\.create_date, GETDATE\(\)\) "
+     r"AS age, SUM\(f\.size_on_disk_bytes\) AS bytes FROM sys\.databases d "
+     r"JOIN sys\.dm_io_virtual_file_stats\(NULL, NULL\) f "
+     r"ON f\.database_id = d\.database_id "
+     r"WHERE d\.source_database_id IS NOT NULL AND d\.name LIKE '(.*)' "
+     r"GROUP BY d\.name, d\.create_date$", Batch.snapshot_generations),
+    (r"SELECT s\.name, DATEDIFF\(second, s\.create_date, GETDATE\(\)\) "
+     r"AS age, CASE WHEN MAX\(u\.last_user_update\) IS NULL "
+     r"OR MAX\(u\.last_user_update\) > s\.create_date "
+     r"THEN 1 ELSE 0 END AS written FROM sys\.databases s "
+     r"LEFT JOIN sys\.dm_db_index_usage_stats u "
+     r"ON u\.database_id = s\.source_database_id "
+     r"WHERE s\.source_database_id IS NOT NULL AND s\.(.*) "
+     r"GROUP BY s\.name, s\.create_date$", Batch.snapshot_writes),
+    (r"SELECT TOP (\d+) s\.name AS schema_name, o\.name AS table_name, "
+     r"SUM\(p\.used_page_count\) AS pages "
+     r"FROM (\w+)\.sys\.dm_db_partition_stats p "
+     r"JOIN \2\.sys\.objects o ON o\.object_id = p\.object_id "
+     r"JOIN \2\.sys\.schemas s ON s\.schema_id = o\.schema_id "
+     r"WHERE o\.is_ms_shipped = 0 AND p\.index_id IN \(0, 1\) "
+     r"GROUP BY s\.name, o\.name ORDER BY pages DESC$", Batch.largest_tables),
+    (r"SELECT COUNT_BIG\(\*\) AS row_count FROM (\w+)\.(\w+)\.(\w+) "
+     r"WITH \(INDEX\((\w+)\), NOLOCK\)$", Batch.read_table),
+    (r"CREATE DATABASE (\w+) ON (.*) AS SNAPSHOT OF (\w+)$",
+     Batch.create_snapshot),
+    (r"RESTORE DATABASE (\w+) FROM DATABASE_SNAPSHOT = '(\w+)'$",
+     Batch.restore_snapshot),
+    (r"DROP DATABASE (\w+)$", Batch.drop_database),
+    (r"ALTER DATABASE (\w+) SET SINGLE_USER WITH ROLLBACK IMMEDIATE$",
+     Batch.single_user),
+    (r"ALTER DATABASE (\w+) SET MULTI_USER$", Batch.multi_user),
+    (r"IF OBJECT_ID\('dbo\.(\w+)', 'P'\) IS NOT NULL "
+     r"DROP PROCEDURE dbo\.\1$", Batch.drop_procedure),
+    (r"CREATE PROCEDURE dbo\.(\w+) .* END$", Batch.create_procedure),
+    (r"EXEC master\.dbo\.(\w+) (.*)$", Batch.execute_procedure),
+    (r"DECLARE (@\w+) TABLE \(.*\)$", Batch.declare_table),
+    (r"DECLARE (@\w+) \w+(?:\(\d+\))? = (.*)$", Batch.declare_variable),
+    (r"RAISERROR\((@\w+|N?'.*?'), \d+, \d+(?:, (.*))?\)$", Batch.raiserror),
+    (r"INSERT INTO (@\w+) VALUES \((.*)\)$", Batch.insert_values),
+    (r"SELECT (.*) FROM (@\w+)$", Batch.select_table),
+]
+COMPILED_STATEMENTS = list()
+for pattern, handler in STATEMENTS:
+    COMPILED_STATEMENTS.append((re.compile(pattern, re.IGNORECASE), handler))
+STATEMENTS = COMPILED_STATEMENTS
@@ -0,0 +1,122 @@
+"""pytest_dbss -- pytest plugin restoring databases dirtied by tests
+
+The baseline is taken once per session (missing snapshots created, changed
+databases reverted). After each test using fixture 'dbss', databases the test
+wrote to (write counts and snapshot sizes moved, see dbss change detection)
+are restored, along with any it named by marker or dbss.mark(). Fixture
+'dbss_module' does the same once per module, for modules whose tests may
+share state. With --dbss-prewarm, restored databases have their hot tables
+read back into memory before the next test starts.
+
+Enable with 'pytest -p pytest_dbss --dbss-environment=sim', or list
+'pytest_dbss' in a conftest.py's pytest_plugins. Without an environment,
+tests using the fixtures are skipped.
+
+Example:
+   @pytest.mark.dbss_dirty('CXSCORE')
+   def test_scoring(dbss):
+       ...
+"""
+
+import pytest
+
+import dbss
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('dbss', 'database snapshots (dbss)')
+    group.addoption('--dbss-environment', default=None,
+                    help='dbss environment to baseline and restore')
+    group.addoption('--dbss-jobs', type=int, default=1,
+                    help='databases restored at once [default: 1]')
+    group.addoption('--dbss-recreate-baseline', action='store_true',
+                    default=False,
+                    help='recreate every snapshot at session start')
+    group.addoption('--dbss-prewarm', action='store_true', default=False,
+                    help='read hot tables into memory after each restore')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'dbss_dirty(*databases): databases '
+                            'the test changes, restored after it')
+
+
+class DirtyTracker(object):
+    """Databases to restore at the end of a test (or module)."""
+
+    def __init__(self,env,jobs,prewarm=False):
+        self.env = env
+        self.jobs = jobs
+        self.prewarm = prewarm
+        self.marked = set()
+        self.restored = list()
+
+    def mark(self,*db_list):
+        """Restore databases afterwards, whether or not writes were seen."""
+        for db in db_list:
+            self.marked.add(db)
+
+    def revert(self):
+        """Restore marked and dirty databases, return those restored."""
+        db_list = dbss.dirty_databases(self.env)
+        for db in sorted(self.marked):
+            if db not in db_list:
+                db_list.append(db)
+        self.restored = list()
+        if db_list != []:
+            # dirty ones already known, no second survey (force)
+            self.restored = dbss.restore_databases(self.env, db_list, True,
+                                                   self.jobs)
+        if self.prewarm and self.restored != []:
+            dbss.prewarm_databases(self.env, self.restored)
+        self.marked = set()
+        return self.restored
+
+
+def marked_databases(node):
+    """Databases named by dbss_dirty markers of test (or module)."""
+    db_list = list()
+    for marker in node.iter_markers('dbss_dirty'):
+        db_list.extend(marker.args)
+    return db_list
+
+
+@pytest.fixture(scope='session')
+def dbss_environment(request):
+    """Environment with baseline taken, closed at end of session."""
+    config = request.config
+    environment = config.getoption('--dbss-environment')
+    if environment is None:
+        pytest.skip('no dbss environment (--dbss-environment)')
+    env = dbss.open_environment(environment)
+    try:
+        dbss.take_baseline(env, None,
+                           config.getoption('--dbss-recreate-baseline'),
+                           config.getoption('--dbss-jobs'))
+        if config.getoption('--dbss-prewarm'):
+            dbss.prewarm_databases(env)
+        yield env
+    finally:
+        dbss.close_environment(env)
+
+
+@pytest.fixture(scope='module')
+def dbss_module(request, dbss_environment):
+    """Tracker reverting databases dirtied by module, after its tests."""
+    tracker = DirtyTracker(dbss_environment,
+                           request.config.getoption('--dbss-jobs'),
+                           request.config.getoption('--dbss-prewarm'))
+    tracker.mark(*marked_databases(request.node))
+    yield tracker
+    tracker.revert()
+
+
+@pytest.fixture(name='dbss')
+def dbss_fixture(request, dbss_environment):
+    """Tracker reverting databases dirtied by test, after it."""
+    tracker = DirtyTracker(dbss_environment,
+                           request.config.getoption('--dbss-jobs'),
+                           request.config.getoption('--dbss-prewarm'))
+    tracker.mark(*marked_databases(request.node))
+    yield tracker
+    tracker.revert()
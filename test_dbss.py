@@ -0,0 +1,1252 @@
+"""Tests of dbss, pytest_dbss and bench_dbss against the simulated server."""
+
+import json
+import os
+import re
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import bench_dbss
+import dbss
+import dbss_simulator
+
+pytest_plugins = ['pytester']
+
+
+@pytest.fixture
+def env(tmp_path):
+    """Library environment on a fresh simulated server, baseline taken."""
+    dbss_simulator.reset_servers()
+    env = dbss.open_environment('sim')
+    env['state_dir'] = str(tmp_path)
+    env['job_poll_interval'] = 0.05
+    dbss.take_baseline(env)
+    yield env
+    dbss.close_environment(env)
+
+
+def generation_environment(env,generation):
+    """Copy of env working on another snapshot generation."""
+    generation_env = dict(env)
+    generation_env['snapshot_generation'] = generation
+    return generation_env
+
+
+# library interface
+
+def test_dirty_and_restore_databases(env):
+    db = env['db_white_list'][0]
+    assert dbss.dirty_databases(env) == []
+    dbss_simulator.write_database(env, db)
+    assert dbss.dirty_databases(env) == [db]
+    assert dbss.restore_databases(env) == [db]
+    assert dbss.dirty_databases(env) == []
+
+
+def test_restore_databases_forced(env):
+    db_list = env['db_white_list'][:2]
+    assert dbss.restore_databases(env) == []
+    assert dbss.restore_databases(env, db_list, True) == sorted(db_list)
+
+
+def test_unknown_database(env):
+    with pytest.raises(dbss.DbssError) as e:
+        dbss.restore_databases(env, ['NOPE'])
+    assert e.value.code == 6
+
+
+def test_unknown_environment():
+    with pytest.raises(dbss.DbssError) as e:
+        dbss.open_environment('nope')
+    assert e.value.code == 5
+
+
+# tracing
+
+def test_statement_labels():
+    assert dbss.statement_label('SET NOCOUNT ON; USE master; DROP DATABASE X_dbss;') \
+        == 'DROP DATABASE'
+    assert dbss.statement_label('SELECT name FROM master.sys.databases;') \
+        == 'SELECT FROM sys.databases'
+    assert dbss.statement_label('USE master;\nBEGIN TRY\n SELECT 1;\nEND TRY') \
+        == 'BATCH TRY/CATCH'
+
+
+def test_trace_file_spans(env, tmp_path):
+    trace_file = str(tmp_path / 'trace.jsonl')
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['revert_environment', '--force', '--jobs=2', '--quiet',
+                   '--environment=sim', '--trace-file=' + trace_file], env)
+    assert e.value.code == 0
+    with open(trace_file) as trace:
+        span_list = [json.loads(line) for line in trace]
+    span_ids = set(span['id'] for span in span_list)
+    root_list = [span for span in span_list if span['parent'] is None]
+    assert [(span['kind'], span['name']) for span in root_list] == \
+        [('command', 'revert_environment')]
+    # worker spans hang off the command, every parent recorded
+    assert all(span['parent'] in span_ids for span in span_list
+               if span['parent'] is not None)
+    database_list = [span['name'] for span in span_list
+                     if span['kind'] == 'database']
+    assert sorted(database_list) == sorted(env['db_white_list'])
+    assert 'RESTORE DATABASE' in [span['name'] for span in span_list
+                                  if span['kind'] == 'statement']
+    assert env['tracer'] is None
+
+
+def test_profile_and_failed_statement(env, capsys):
+    env['tracer'] = dbss.new_tracer()
+    with pytest.raises(SystemExit):
+        dbss.sql_command('DROP DATABASE NOPE;', env, 99)
+    dbss.survey_databases(env, refresh=True)
+    span_list = env['tracer']['spans']
+    assert [span['error'] for span in span_list] == [3701, None]
+    assert span_list[1]['rows'] > 0
+    dbss.print_profile(env)
+    profile = capsys.readouterr().err.split('Profile (')[1]
+    assert 'SELECT FROM sys.databases' in profile
+    assert re.search(r'DROP DATABASE +1 .* 1$', profile, re.M)
+    dbss.close_tracer(env)
+
+
+# offline commands
+
+OFFLINE_PROBE = """
+import sys
+import dbss
+try:
+    dbss.main(sys.argv[1:])
+except SystemExit as e:
+    code = e.code
+loaded = [name for name in ('docopt', 'dbss_simulator', '_mssql', 'pymssql',
+                            'pyodbc', 'sqlite3') if name in sys.modules]
+sys.stdout.write('exit {0} loaded {1}\\n'.format(code, ' '.join(loaded)))
+"""
+
+
+def test_offline_arguments():
+    assert dbss.offline_arguments(['list']) == ('list', None, 'test')
+    assert dbss.offline_arguments(['test', 'cxscore', '--environment=sim']) \
+        == ('test', 'CXSCORE', 'sim')
+    for argv in (['test'], ['list', '--quiet'], ['survey'], ['list', 'X']):
+        assert dbss.offline_arguments(argv) is None
+
+
+@pytest.mark.parametrize('argv', [['--version'], ['--help'],
+                                  ['list', '--environment=sim'],
+                                  ['test', 'CXSCORE', '--environment=sim']])
+def test_offline_commands_load_no_driver(tmp_path, argv):
+    environ = dict(os.environ, HOME=str(tmp_path))
+    probe = subprocess.check_output(
+        [sys.executable, '-c', OFFLINE_PROBE] + argv, env=environ,
+        cwd=os.path.dirname(os.path.abspath(dbss.__file__)))
+    # neither docopt nor any driver imported
+    assert probe.decode('utf-8').splitlines()[-1] == 'exit 0 loaded '
+
+
+# database drivers
+
+class FakeOdbcError(Exception):
+    pass
+
+
+class FakeCursor(object):
+    """Cursor of FakeOdbc: a row count, then one result set."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.sets = [None, (('name',), [('CXSCORE',), ('CXSERVER',)])]
+
+    def execute(self, sql):
+        if self.connection.lost:
+            raise FakeOdbcError('08S01', 'Communication link failure')
+        self.connection.executed.append(sql)
+
+    def nextset(self):
+        if self.sets == []:
+            return False
+        result = self.sets.pop(0)
+        self.description = None
+        self.rows = list()
+        if result is not None:
+            self.description, self.rows = result
+            self.description = [(column,) for column in self.description]
+        return True
+
+    def cancel(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeOdbc(object):
+    """Stand-in for the pyodbc module, records connect arguments."""
+
+    Error = FakeOdbcError
+
+    def __init__(self):
+        self.lost = False
+        self.executed = list()
+        self.connect_args = None
+
+    def connect(self, connection_string, autocommit=False):
+        self.connect_args = (connection_string, autocommit)
+        return self
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+def test_unknown_driver(env, capsys):
+    env['db_driver'] = 'nope'
+    env['quiet_mode'] = True
+    with pytest.raises(SystemExit) as e:
+        dbss.load_driver(env)
+    assert e.value.code == 4
+    assert "Driver 'nope' Unknown" in capsys.readouterr().err
+
+
+def test_driver_not_installed(env, monkeypatch, capsys):
+    monkeypatch.setitem(sys.modules, 'pyodbc', None)
+    env['db_driver'] = 'pyodbc'
+    env['quiet_mode'] = True
+    with pytest.raises(SystemExit) as e:
+        dbss.load_driver(env)
+    assert e.value.code == 4
+    assert 'could not be loaded' in capsys.readouterr().err
+
+
+def test_odbc_connection_adapter(env):
+    pyodbc = FakeOdbc()
+    connection = dbss.OdbcConnection(pyodbc, env)
+    connection_string, autocommit = pyodbc.connect_args
+    # snapshot DDL needs autocommit
+    assert autocommit
+    assert 'SERVER={}'.format(env['db_server']) in connection_string
+    connection.execute_query('SELECT name FROM sys.databases;')
+    rows = list(connection)
+    assert rows[0] == {0: 'CXSCORE', 'name': 'CXSCORE'}
+    assert len(rows) == 2
+    pyodbc.lost = True
+    with pytest.raises(FakeOdbcError):
+        connection.execute_non_query('DROP DATABASE X;')
+    assert not connection.connected
+
+
+def test_driver_error_details(env):
+    with pytest.raises(SystemExit):
+        dbss.sql_command('DROP DATABASE NOPE;', env, 99)
+    connection = env['db_session']['connection']
+    with pytest.raises(dbss_simulator.SimulatedError) as e:
+        connection.execute_non_query('DROP DATABASE NOPE;')
+    assert dbss.driver_error_number(e.value) == 3701
+    assert "'NOPE'" in dbss.driver_message(e.value)
+    assert dbss.driver_error_number(FakeOdbcError('08S01', 'lost')) == '08S01'
+
+
+# database sessions
+
+def test_session_reused(env):
+    logins = env['db_session']['logins']
+    for i in range(3):
+        dbss.survey_databases(env, refresh=True)
+    assert env['db_session']['logins'] == logins
+    assert env['db_session']['requests'] >= 3
+
+
+def test_session_reconnects_after_lost_link(env):
+    dbss.survey_databases(env, refresh=True)
+    logins = env['db_session']['logins']
+    connection = env['db_session']['connection']
+    server = dbss_simulator.server_for(env)
+    # server side kill, as KILL or a timeout would leave it
+    with server['lock']:
+        connection.disconnect()
+    assert dbss.survey_databases(env, refresh=True) != {}
+    assert env['db_session']['logins'] == logins + 1
+    assert env['db_session']['connection'] is not connection
+
+
+def test_close_session(env):
+    dbss.survey_databases(env, refresh=True)
+    connection = env['db_session']['connection']
+    dbss.close_session(env)
+    assert env['db_session']['connection'] is None
+    assert not connection.connected
+
+
+# catalog cache
+
+def ignore_drops(monkeypatch):
+    """Have DROP DATABASE succeed without dropping (cache still told)."""
+    sql_command = dbss.sql_command
+
+    def lost_drop(sql,env,err_code):
+        if not sql.startswith('DROP DATABASE'):
+            sql_command(sql,env,err_code)
+
+    monkeypatch.setattr(dbss, 'sql_command', lost_drop)
+
+
+def test_survey_served_from_cache(env):
+    batches = dbss_simulator.server_stats(env)['batches']
+    dbss.survey_databases(env)
+    assert dbss_simulator.server_stats(env)['batches'] == batches
+    dbss.survey_databases(env, refresh=True)
+    assert dbss_simulator.server_stats(env)['batches'] == batches + 1
+
+
+def test_cache_follows_own_ddl(env):
+    db = env['db_white_list'][0]
+    dbss_simulator.write_database(env, db)
+    dbss.generate_baseline(env, 1)
+    snapshot_db = dbss.snapshot_name(db, env)
+    assert dbss.survey_databases(env) == dbss.survey_databases(env, refresh=True)
+    assert snapshot_db in dbss.survey_databases(env)
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_clean_slate_verifies_drops(env, monkeypatch, capsys, jobs):
+    ignore_drops(monkeypatch)
+    env['quiet_mode'] = True
+    drop_list, outcomes = dbss.clean_slate(env, jobs, False)
+    assert set(outcomes.values()) == set([80])
+    assert sorted(outcomes) == sorted(drop_list)
+    assert 'could not be dropped' in capsys.readouterr().err
+
+
+def test_destroy_verifies_drop(env, monkeypatch):
+    ignore_drops(monkeypatch)
+    db = env['db_white_list'][0]
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['destroy', db, '--quiet', '--environment=sim'], env)
+    assert e.value.code == 81
+
+
+# catalog queries
+
+def test_survey_filtered_on_server(env):
+    server = dbss_simulator.server_for(env)
+    with server['lock']:
+        dbss_simulator.add_database(server, 'OTHERDB', 8)
+        dbss_simulator.add_database(server, 'OTHERXdbss', 8)
+    rows = dbss_simulator.server_stats(env)['rows']
+    db_survey = dbss.survey_databases(env, refresh=True)
+    assert 'OTHERDB' not in db_survey
+    # suffix matched literally, its '_' is no wildcard
+    assert 'OTHERXdbss' not in db_survey
+    assert sorted(db_survey) == sorted(
+        list(env['db_white_list']) +
+        [dbss.snapshot_name(db, env) for db in env['db_white_list']])
+    assert dbss_simulator.server_stats(env)['rows'] == rows + len(db_survey)
+
+
+def test_rows_abandoned_early_keep_session(env):
+    sql = "SELECT name, state_desc FROM sys.databases;"
+    for row in dbss.sql_rows(sql, env, 99):
+        assert set(row) == set(['name', 'state_desc'])
+        break
+    logins = env['db_session']['logins']
+    assert len(dbss.sql_query(sql, env, 99)) > 1
+    assert env['db_session']['logins'] == logins
+
+
+def test_sql_quoting():
+    assert dbss.sql_name_list(["A", "O'B"]) == "'A', 'O''B'"
+    assert dbss.sql_like_literal('_dbss%') == '[_]dbss[%]'
+
+
+# batched execution
+
+def hold_open(env,db):
+    """Open a client connection to database (blocks exclusive access)."""
+    server = dbss_simulator.server_for(env)
+    with server['lock']:
+        return dbss_simulator.open_process(
+            server, None, server['databases'][db]['database_id'])['spid']
+
+
+def test_batch_failure_does_not_stop_others(env):
+    batch_result = dbss.sql_batch(
+        [('NOPE', 'DROP DATABASE NOPE;'),
+         ('CXSCORE', "RAISERROR(N'%s', 16, 1, N'kept going');")], env, 99)
+    assert batch_result['NOPE'][0] == 3701
+    assert batch_result['CXSCORE'] == (50000, 'kept going')
+
+
+def test_restore_batch_outcomes(env, capsys):
+    env['quiet_mode'] = True
+    busy_db, missing_db, db = env['db_white_list'][:3]
+    hold_open(env, busy_db)
+    dbss.drop_database(dbss.snapshot_name(missing_db, env), env)
+    batches = dbss_simulator.server_stats(env)['batches']
+    outcomes = dbss.restore_snapshots_batch([busy_db, missing_db, db], env)
+    assert outcomes == {busy_db: 87, missing_db: 11, db: 0}
+    # restores travel in one batch, verified by one catalog read
+    assert dbss_simulator.server_stats(env)['batches'] == batches + 2
+    err = capsys.readouterr().err
+    assert 'in use' in err and 'does not exist' in err
+
+
+def test_drop_batch_outcomes(env):
+    db = env['db_white_list'][0]
+    dbss_list = [dbss.snapshot_name(db, env), db]
+    env['quiet_mode'] = True
+    outcomes = dbss.drop_snapshots_batch(dbss_list, env)
+    # source database is refused before the batch is sent
+    assert outcomes == {dbss_list[0]: 0, db: 84}
+    assert dbss_list[0] not in dbss.survey_databases(env, refresh=True)
+
+
+# connection eviction
+
+def open_spids(env):
+    return set(dbss_simulator.server_for(env)['processes'])
+
+
+def test_kill_scoped_to_databases(env):
+    db, other_db = env['db_white_list'][:2]
+    spid = hold_open(env, db)
+    other_spid = hold_open(env, other_db)
+    dbss.survey_databases(env, refresh=True)
+    logins = env['db_session']['logins']
+    dbss.kill_connections(env, [db])
+    assert spid not in open_spids(env)
+    assert other_spid in open_spids(env)
+    # own pooled session spared
+    dbss.survey_databases(env, refresh=True)
+    assert env['db_session']['logins'] == logins
+
+
+def test_kill_server_wide(env):
+    spid_list = [hold_open(env, db) for db in env['db_white_list'][:2]]
+    dbss.kill_connections(env)
+    assert open_spids(env).isdisjoint(spid_list)
+    assert env['db_session']['connection'].connected
+
+
+@pytest.mark.parametrize('eviction', ['kill', 'single_user'])
+def test_restore_evicts_connections(env, eviction):
+    db = env['db_white_list'][0]
+    spid = hold_open(env, db)
+    dbss_simulator.write_database(env, db)
+    env['restore_eviction'] = eviction
+    dbss.restore_snapshot(db, env)
+    assert spid not in open_spids(env)
+    assert dbss.survey_databases(env, refresh=True)[db] == 'ONLINE'
+
+
+def test_restore_without_eviction_fails_in_use(env):
+    db = env['db_white_list'][0]
+    hold_open(env, db)
+    env['quiet_mode'] = True
+    with pytest.raises(SystemExit) as e:
+        dbss.restore_snapshot(db, env)
+    assert e.value.code == 87
+
+
+# multiple hosts
+
+@pytest.fixture
+def hosts_env(tmp_path):
+    """Library environment spread over three simulated hosts."""
+    dbss_simulator.reset_servers()
+    env = dbss.open_environment('sim_hosts')
+    env['state_dir'] = str(tmp_path)
+    dbss.take_baseline(env)
+    yield env
+    dbss.close_environment(env)
+
+
+def test_hosts_partition_white_list(hosts_env):
+    host_list = dbss.database_hosts(hosts_env)
+    assert host_list == ['sim_test_01', 'sim_test_02', 'sim_test_03']
+    db_list = list()
+    for server in host_list:
+        host_env = dbss.host_environment(server, hosts_env)
+        for db in host_env['db_white_list']:
+            assert dbss.database_host(db, hosts_env) == server
+        db_list.extend(host_env['db_white_list'])
+        # each host logged in once, for its own databases
+        assert dbss_simulator.server_stats(host_env)['logins'] == 1
+        assert sorted(dbss.survey_databases(host_env)) == sorted(
+            list(host_env['db_white_list']) +
+            [dbss.snapshot_name(db, host_env)
+             for db in host_env['db_white_list']])
+    assert sorted(db_list) == sorted(hosts_env['db_white_list'])
+
+
+def test_hosts_restore_across_hosts(hosts_env):
+    db_list = list()
+    for server in dbss.database_hosts(hosts_env):
+        host_env = dbss.host_environment(server, hosts_env)
+        db_list.append(host_env['db_white_list'][0])
+        dbss_simulator.write_database(host_env, db_list[-1])
+    assert dbss.dirty_databases(hosts_env) == sorted(db_list)
+    assert dbss.restore_databases(hosts_env) == sorted(db_list)
+    assert dbss.dirty_databases(hosts_env) == []
+
+
+def test_fan_out_result_first_failing_host(hosts_env):
+    def host_task(host_env):
+        if host_env['db_server'] != 'sim_test_01':
+            sys.exit(int(host_env['db_server'][-1]) + 70)
+        return host_env['db_white_list']
+
+    stdout = sys.stdout
+    host_results = dbss.fan_out(host_task, hosts_env)
+    assert sys.stdout is stdout
+    assert [code for host_env, code, result in host_results] == [0, 72, 73]
+    assert dbss.fan_out_result(host_results) == 72
+
+
+def test_hosts_summary_merged(hosts_env, monkeypatch, capsys):
+    db = [db for db in hosts_env['db_white_list'] if db.startswith('PX')][0]
+    fail_restore(monkeypatch, db)
+    hosts_env['quiet_mode'] = False
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['revert_environment', '--force',
+                   '--environment=sim_hosts'], hosts_env)
+    assert e.value.code == 89
+    out = capsys.readouterr().out
+    assert 'Summary: {} succeeded, 1 failed.'\
+        .format(len(hosts_env['db_white_list']) - 1) in out
+
+
+# revert_environment
+
+def test_revert_skips_unchanged(env):
+    db = env['db_white_list'][0]
+    dbss_simulator.write_database(env, db)
+    skipped_list, outcomes = dbss.revert_environment(env, 1, False, False)
+    assert db not in skipped_list
+    assert sorted(skipped_list + [db]) == sorted(env['db_white_list'])
+    assert dbss.dirty_databases(env) == []
+
+
+def test_revert_forced(env):
+    skipped_list, outcomes = dbss.revert_environment(env, 1, True, True)
+    assert skipped_list == []
+    assert outcomes == dict.fromkeys(env['db_white_list'], 0)
+
+
+def test_revert_after_other_generation_created(env):
+    # a newer generation's mark must not hide baseline changes
+    db = env['db_white_list'][0]
+    dbss_simulator.write_database(env, db)
+    nightly_env = generation_environment(env, 'nightly')
+    dbss.create_snapshot(db, nightly_env)
+    dbss.mark_unchanged([db], nightly_env)
+    env['drop_generations'] = True
+    skipped_list, outcomes = dbss.revert_environment(env, 1, False, False)
+    assert db not in skipped_list
+    assert dbss.dirty_databases(env) == []
+
+
+# snapshot generations
+
+def create_generations(env,db,generation_list):
+    for generation in generation_list:
+        dbss.create_snapshot(db, generation_environment(env, generation))
+
+
+def test_generations_kept_without_limits(env):
+    db = env['db_white_list'][0]
+    create_generations(env, db, ['n1', 'n2', 'n3', 'n4'])
+    assert dbss.apply_retention([db], env) == []
+    assert len(dbss.other_generations(db, env)) == 4
+
+
+def test_generations_evicted_over_set_limit(env):
+    db = env['db_white_list'][0]
+    create_generations(env, db, ['n1', 'n2', 'n3'])
+    env['generation_max_count'] = 3
+    nightly_env = generation_environment(env, 'n3')
+    dbss.apply_retention([db], nightly_env)
+    assert dbss.other_generations(db, env) == [db + '_dbss_n2',
+                                               db + '_dbss_n3']
+
+
+def test_restore_refuses_to_drop_generations(env, capsys):
+    db = env['db_white_list'][0]
+    create_generations(env, db, ['nightly'])
+    with pytest.raises(SystemExit) as e:
+        dbss.restore_snapshot(db, env)
+    assert e.value.code == 17
+    assert dbss.other_generations(db, env) == [db + '_dbss_nightly']
+    env['drop_generations'] = True
+    dbss.restore_snapshot(db, env)
+    assert dbss.other_generations(db, env) == []
+
+
+def test_batch_and_procedure_refuse_to_drop_generations(env, capsys):
+    db_list = env['db_white_list'][:2]
+    create_generations(env, db_list[0], ['nightly'])
+    outcomes = dbss.restore_snapshots_batch(db_list, env)
+    assert outcomes == {db_list[0]: 17, db_list[1]: 0}
+    dbss.install_procedure(env)
+    outcomes = dbss.call_procedure('restore', db_list, env)
+    assert outcomes == {db_list[0]: 17, db_list[1]: 0}
+    assert dbss.other_generations(db_list[0], env) != []
+
+
+def test_refresh_skips_database_with_generations(env):
+    db_list = env['db_white_list'][:2]
+    create_generations(env, db_list[0], ['nightly'])
+    dbss_simulator.write_database(env, db_list[0])
+    assert dbss.refresh_snapshot(db_list[0], env) is False
+    assert dbss.other_generations(db_list[0], env) != []
+    assert dbss.refresh_snapshot(db_list[1], env) is True
+
+
+# snapshot growth
+
+def bloat(env,db):
+    # every data page written, the snapshot holds a full copy
+    dbss_simulator.write_database(env, db, 10 ** 6)
+
+
+def test_snapshot_sizes_and_bloat(env):
+    db_list = env['db_white_list'][:2]
+    bloat(env, db_list[0])
+    sizes = dbss.survey_snapshot_sizes(db_list, env)
+    assert dbss.bloat_ratio(sizes[db_list[0]]) == 1.0
+    assert dbss.bloat_ratio(sizes[db_list[1]]) == 0.0
+    assert dbss.bloated_snapshots(sizes, 0.5, env) == [db_list[0]]
+
+
+def test_refresh_snapshots_reports_generations_first(env, capsys):
+    db_list = env['db_white_list'][:2]
+    create_generations(env, db_list[0], ['nightly'])
+    for db in db_list:
+        bloat(env, db)
+    assert dbss.refresh_snapshots(env, db_list) == ([db_list[1]],
+                                                    [db_list[0]])
+    assert 'not refreshed' in capsys.readouterr().err
+    sizes = dbss.survey_snapshot_sizes(db_list, env)
+    assert dbss.bloated_snapshots(sizes, 0.5, env) == [db_list[0]]
+    assert dbss.other_generations(db_list[0], env) == \
+        [db_list[0] + '_dbss_nightly']
+    assert dbss.dirty_databases(env, [db_list[1]]) == []
+
+
+def test_stats_refresh_exits_when_generations_left(env, capsys):
+    db = env['db_white_list'][0]
+    create_generations(env, db, ['nightly'])
+    bloat(env, db)
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['stats', '--refresh', '--bloat=0.5', '--quiet',
+                   '--environment=sim'], env)
+    assert e.value.code == 17
+
+
+# generate_baseline
+
+def test_generate_baseline_keeps_current(env):
+    current_list, outcomes = dbss.generate_baseline(env, 1)
+    assert sorted(current_list) == sorted(env['db_white_list'])
+    assert outcomes is None
+
+
+def test_generate_baseline_recreates_written(env):
+    db = env['db_white_list'][0]
+    dbss_simulator.write_database(env, db)
+    current_list, outcomes = dbss.generate_baseline(env, 1)
+    assert db not in current_list
+    assert len(current_list) == len(env['db_white_list']) - 1
+
+
+def test_generate_baseline_resumes(env, monkeypatch):
+    create_snapshot = dbss.create_snapshot
+    created_list = list()
+
+    def interrupted_create(db,env):
+        if len(created_list) == 2:
+            raise KeyboardInterrupt
+        create_snapshot(db,env)
+        created_list.append(db)
+
+    monkeypatch.setattr(dbss, 'create_snapshot', interrupted_create)
+    with pytest.raises(KeyboardInterrupt):
+        dbss.generate_baseline(env, 1, True)
+    monkeypatch.setattr(dbss, 'create_snapshot', create_snapshot)
+    # snapshots created before the interruption are kept
+    current_list, outcomes = dbss.generate_baseline(env, 1)
+    assert sorted(current_list) == sorted(created_list)
+
+
+# environment jobs
+
+def fail_restore(monkeypatch,failing_db):
+    """Have restore_snapshot exit 76 for one database."""
+    restore_snapshot = dbss.restore_snapshot
+
+    def failing_restore(db,env):
+        if db == failing_db:
+            sys.exit(76)
+        restore_snapshot(db,env)
+
+    monkeypatch.setattr(dbss, 'restore_snapshot', failing_restore)
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_revert_collects_failures(env, monkeypatch, jobs):
+    db = env['db_white_list'][1]
+    fail_restore(monkeypatch, db)
+    skipped_list, outcomes = dbss.revert_environment(env, jobs, False, True)
+    assert outcomes.pop(db) == 76
+    assert sorted(outcomes) == sorted(env['db_white_list'][:1] +
+                                      env['db_white_list'][2:])
+    assert set(outcomes.values()) == set([0])
+
+
+@pytest.mark.parametrize('jobs', ['1', '3'])
+def test_revert_summarizes_failures(env, monkeypatch, capsys, jobs):
+    db = env['db_white_list'][1]
+    fail_restore(monkeypatch, db)
+    env['quiet_mode'] = False
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['revert_environment', '--force', '--jobs=' + jobs,
+                   '--environment=sim'], env)
+    assert e.value.code == 89
+    out = capsys.readouterr().out
+    summary = 'Summary: {} succeeded, 1 failed.'\
+              .format(len(env['db_white_list']) - 1)
+    assert summary in out
+    assert "'{}' failed (exit code 76)".format(db) in out
+
+
+def test_job_narration_lines_kept_whole(env, capsys):
+    def narrating_task(db,env):
+        for word in ('one', 'line', 'per', 'database'):
+            sys.stdout.write(word + ' ')
+        sys.stdout.write(db + '\n')
+
+    db_list = env['db_white_list']
+    outcomes = dbss.run_environment_jobs(narrating_task, db_list, env, 4)
+    assert set(outcomes.values()) == set([0])
+    line_list = capsys.readouterr().out.splitlines()
+    assert sorted(line_list) == sorted('one line per database ' + db
+                                       for db in db_list)
+    assert not isinstance(sys.stdout, dbss.LineOutput)
+
+
+# operation history
+
+def record_runs(env,operation,seconds):
+    """Record one successful run of operation per database, as long as given."""
+    for db in seconds:
+        dbss.record_history(operation, db, env, time.time() - seconds[db], 0)
+    dbss.save_history(env)
+
+
+def test_order_by_expected_history(env):
+    # slower by history, though later by size
+    fast_db, slow_db = dbss.order_by_size(env['db_white_list'][:2], env)
+    record_runs(env, 'restore_snapshot', {slow_db: 100.0, fast_db: 0.001})
+    assert dbss.order_by_expected(dbss.restore_snapshot,
+                                  [fast_db, slow_db], env) == [slow_db, fast_db]
+
+
+def test_order_by_expected_drops_by_source(env):
+    dbss_list = [dbss.snapshot_name(db, env) for db in env['db_white_list'][:2]]
+    fast_dbss, slow_dbss = dbss.order_by_size(dbss_list, env)
+    # drops are recorded as drop_database, against the source database
+    record_runs(env, 'drop_database',
+                {dbss.original_db_name(slow_dbss, env): 100.0,
+                 dbss.original_db_name(fast_dbss, env): 0.001})
+    assert dbss.order_by_expected(dbss.destroy_snapshot, dbss_list, env) == \
+        [slow_dbss, fast_dbss]
+
+
+def test_batched_runs_not_expected(env):
+    db = env['db_white_list'][0]
+    dbss.record_batch('restore_snapshot', {db: 0}, env, time.time() - 100)
+    dbss.save_history(env)
+    assert dbss.expected_durations([db], 'restore_snapshot', env) == {}
+    assert dbss.read_history(env, 'restore_snapshot', [db])[0]['batched']
+
+
+# benchmarks
+
+def bench_settings(tmp_path):
+    settings = dict()
+    settings['latency'] = 0
+    settings['login_latency'] = 0
+    settings['page_cost'] = 0
+    settings['state_dir'] = str(tmp_path)
+    return settings
+
+
+def bench_scenario(name):
+    for scenario in bench_dbss.SCENARIOS:
+        if scenario[0] == name:
+            return scenario
+
+
+def test_bench_scenario_counts(tmp_path):
+    result = bench_dbss.run_scenario(bench_scenario('revert_environment_force'),
+                                     3, bench_settings(tmp_path))
+    assert result['exit_code'] == 0
+    assert result['databases'] == 3
+    # one session for the run, restores each a round trip
+    assert result['logins'] == 1
+    assert result['batches'] >= 3
+
+
+def test_bench_compare_reports():
+    earlier = {'command': 'survey', 'databases': 1, 'exit_code': 0,
+               'wall_time': 1.0, 'logins': 1, 'batches': 2,
+               'statements': 2, 'rows': 4}
+    result = dict(earlier)
+    assert bench_dbss.compare_reports({'results': [result]},
+                                      {'results': [earlier]}, 1.5) == []
+    result['batches'] = 3
+    result['wall_time'] = 2.0
+    regressions = bench_dbss.compare_reports({'results': [result]},
+                                             {'results': [earlier]}, 1.5)
+    assert regressions == ['survey (1 databases): batches 3, was 2',
+                           'survey (1 databases): wall time 2.0s, was 1.0s']
+
+
+def test_bench_report_and_baseline(tmp_path, capsys):
+    output = str(tmp_path / 'bench.json')
+    argv = ['--sizes=2', '--commands=survey,restore', '--latency=0',
+            '--login-latency=0', '--output=' + output]
+    bench_dbss.main(argv)
+    with open(output) as report_file:
+        report = json.load(report_file)
+    assert sorted(result['command'] for result in report['results']) == \
+        ['restore', 'survey']
+    assert set(result['exit_code'] for result in report['results']) == set([0])
+    # same counts against itself, timing allowance kept generous
+    bench_dbss.main(argv[:-1] + ['--output=' + str(tmp_path / 'again.json'),
+                                 '--baseline=' + output, '--tolerance=100'])
+    assert 'REGRESSIONS' not in capsys.readouterr().out
+
+
+# snapshot plans
+
+def reopen_environment(env):
+    """Fresh environment of a later run, sharing env's state_dir."""
+    later_env = dbss.open_environment(env['environment'])
+    later_env['state_dir'] = env['state_dir']
+    return later_env
+
+
+def count_datafile_surveys(monkeypatch):
+    """Record database lists of each survey_datafiles call."""
+    survey_datafiles = dbss.survey_datafiles
+    call_list = list()
+
+    def counted_survey(db_list,env,testing=False):
+        call_list.append(sorted(db_list))
+        return survey_datafiles(db_list,env,testing)
+
+    monkeypatch.setattr(dbss, 'survey_datafiles', counted_survey)
+    return call_list
+
+
+def move_data_file(env,db,path):
+    """Move database's first data file on the simulated server."""
+    server = dbss_simulator.server_for(env)
+    with server['lock']:
+        dbss_simulator.find_database(server, db)['files'][0]['physical_name'] = path
+
+
+def test_snapshot_plans_persisted(env):
+    with open(os.path.join(env['state_dir'], 'plans_sim.json')) as plans_file:
+        plans = json.load(plans_file)[env['db_server']]
+    assert sorted(plans) == sorted(env['db_white_list'])
+    db = env['db_white_list'][0]
+    assert plans[db]['fingerprint'] is not None
+    assert [plan_file['name'] for plan_file in plans[db]['files']][0] == \
+        db + '_Data'
+
+
+def test_snapshot_plans_reused_by_later_run(env, monkeypatch):
+    call_list = count_datafile_surveys(monkeypatch)
+    later_env = reopen_environment(env)
+    try:
+        dbss.generate_baseline(later_env, 1, True)
+    finally:
+        dbss.close_environment(later_env)
+    assert call_list == []
+
+
+def test_snapshot_plan_follows_moved_file(env, monkeypatch):
+    db = env['db_white_list'][0]
+    moved_path = r'E:\moved\{}_Data.mdf'.format(db)
+    move_data_file(env, db, moved_path)
+    call_list = count_datafile_surveys(monkeypatch)
+    later_env = reopen_environment(env)
+    try:
+        dbss.generate_baseline(later_env, 1, True)
+    finally:
+        dbss.close_environment(later_env)
+    # only the moved database's files read again
+    assert call_list == [[db]]
+    assert [path for path in snapshot_files(env, db)
+            if path.startswith('E:\\moved\\')] != []
+
+
+# datafile prefetch
+
+def test_prefetch_reads_files_once(env):
+    # files seen by take_baseline forgotten
+    dbss.catalog_invalidate(env)
+    batches = dbss_simulator.server_stats(env)['batches']
+    db_list = list(env['db_white_list'])
+    file_survey = dbss.prefetch_datafiles(db_list, env)
+    assert sorted(file_survey) == sorted(db_list)
+    dbss.prefetch_datafiles(db_list[:2], env)
+    sizes = dbss.survey_database_sizes(db_list[2:], env)
+    assert all(sizes[db] > 0 for db in db_list[2:])
+    # one query for the whole white list, later calls served by it
+    assert dbss_simulator.server_stats(env)['batches'] == batches + 1
+
+
+def test_prefetch_covers_white_list_without_plans(env, monkeypatch, tmp_path):
+    call_list = count_datafile_surveys(monkeypatch)
+    planless_env = reopen_environment(env)
+    planless_env['state_dir'] = str(tmp_path / 'planless')
+    try:
+        dbss.generate_baseline(planless_env, 1, True)
+    finally:
+        dbss.close_environment(planless_env)
+    # first create fetches files of every database lacking a plan
+    assert call_list == [sorted(env['db_white_list'])]
+
+
+# prewarm
+
+def record_commands(monkeypatch):
+    """Record SQL of each sql_command call (still executed)."""
+    sql_command = dbss.sql_command
+    sql_list = list()
+
+    def recorded_command(sql,env,err_code):
+        sql_list.append(sql)
+        sql_command(sql,env,err_code)
+
+    monkeypatch.setattr(dbss, 'sql_command', recorded_command)
+    return sql_list
+
+
+def test_prewarm_statement():
+    assert dbss.prewarm_statement('CXSCORE', 'dbo.T01') == \
+        'SELECT COUNT_BIG(*) AS row_count FROM CXSCORE.dbo.T01 ' \
+        'WITH (INDEX(0), NOLOCK);'
+    assert 'WITH (INDEX(IX_T01), NOLOCK)' in \
+        dbss.prewarm_statement('CXSCORE', 'dbo.T01:IX_T01')
+
+
+def test_prewarm_largest_tables_one_batch(env, monkeypatch):
+    sql_list = record_commands(monkeypatch)
+    db = env['db_white_list'][0]
+    env['prewarm_top'] = 2
+    dbss.prewarm_databases(env, [db])
+    assert len(sql_list) == 1
+    assert re.findall(r'FROM (\S+) ', sql_list[0]) == \
+        [db + '.dbo.T01', db + '.dbo.T02']
+
+
+def test_prewarm_objects_configured(env, monkeypatch):
+    sql_list = record_commands(monkeypatch)
+    db = env['db_white_list'][0]
+    env['prewarm_objects'] = {db: ['dbo.T03:IX_T03']}
+    dbss.prewarm_databases(env, [db])
+    assert sql_list == [dbss.prewarm_statement(db, 'dbo.T03:IX_T03')]
+
+
+def test_prewarm_failure_names_database(env):
+    db_list = env['db_white_list'][:3]
+    env['prewarm_objects'] = {db_list[1]: ['dbo.NOPE']}
+    with pytest.raises(dbss.DbssError) as e:
+        dbss.prewarm_databases(env, db_list)
+    assert e.value.code == 89
+    assert '{} (94)'.format(db_list[1]) in str(e.value)
+
+
+def test_revert_prewarms_restored(env, capsys):
+    db = env['db_white_list'][0]
+    dbss_simulator.write_database(env, db)
+    env['quiet_mode'] = False
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['revert_environment', '--prewarm', '--environment=sim'],
+                  env)
+    assert e.value.code == 0
+    assert 'Prewarmed 1 database(s)' in capsys.readouterr().out
+
+
+# background jobs
+
+def test_job_failure_finishes(env, monkeypatch):
+    def failing_create(db,env):
+        raise ValueError('simulated failure')
+
+    monkeypatch.setattr(dbss, 'create_snapshot', failing_create)
+    job = dbss.submit_job('create', env['db_white_list'][0], env)
+    progress = dbss.wait_job(job, env, 10)
+    assert progress['state'] == 'failed'
+    assert progress['exit_code'] == 1
+
+
+def test_job_cancel_reports_state(env):
+    db = env['db_white_list'][0]
+    env['sim_page_cost'] = 10.0
+    job = dbss.submit_job('restore', db, env)
+    progress = dbss.wait_job(job, env, 0.2)
+    assert progress['state'] == 'cancelled'
+    assert progress['left_state'] == dbss.survey_databases(env, refresh=True)[db]
+
+
+# restore eviction
+
+def test_raiserror_message_is_not_a_format(env):
+    declare = "DECLARE @message nvarchar(2048) = N'disk 100% full';\n"
+    batch_result = dbss.sql_batch(
+        [('CXSCORE', declare + "RAISERROR(N'%s', 16, 1, @message);"),
+         ('CXSERVER', declare + "RAISERROR(@message, 16, 1);")], env, 99)
+    assert batch_result['CXSCORE'] == (50000, 'disk 100% full')
+    # as on the server, a message used as format is misread
+    assert batch_result['CXSERVER'][0] == 2787
+
+
+def test_single_user_restore_keeps_error_message(env):
+    db = env['db_white_list'][0]
+    dbss.drop_snapshot(db, env)
+    plain_result = dbss.sql_batch([(db, dbss.restore_statement(db, env))],
+                                  env, 87)
+    env['restore_eviction'] = 'single_user'
+    single_user_result = dbss.sql_batch(
+        [(db, dbss.restore_statement(db, env))], env, 87)
+    assert single_user_result[db][1] == plain_result[db][1]
+    assert dbss.survey_databases(env, refresh=True)[db] == 'ONLINE'
+
+
+# server-side execution
+
+def snapshot_files(env,db):
+    """Physical names of simulated snapshot's files."""
+    server = dbss_simulator.server_for(env)
+    snapshot = dbss_simulator.find_database(server, dbss.snapshot_name(db, env))
+    return sorted(data_file['physical_name'] for data_file in snapshot['files'])
+
+
+def test_procedure_definition_is_well_formed():
+    sql = dbss.procedure_definition()
+    upper = sql.upper()
+    for opening, closing in (('BEGIN TRY', 'END TRY'),
+                             ('BEGIN CATCH', 'END CATCH')):
+        assert upper.count(opening) == upper.count(closing)
+    assert len(re.findall(r'\b(?:BEGIN|CASE)\b', upper)) == \
+        len(re.findall(r'\bEND\b', upper))
+    assert sql.count("'") % 2 == 0
+    # messages are never used as formats
+    for arguments in re.findall(r'RAISERROR\((.*?),', sql):
+        assert arguments.startswith("N'")
+    # file clauses as snapshot_statement builds them
+    text = ' '.join(sql.split())
+    assert "type_desc <> N'LOG'" in text
+    assert "RIGHT(N'0' + CAST(file_number AS nvarchar(10)), 2)" in text
+
+
+def test_install_refuses_procedure_not_simulated(env, monkeypatch, capsys):
+    definition = dbss.procedure_definition
+    monkeypatch.setattr(dbss, 'procedure_definition',
+                        lambda: definition().replace('NOCOUNT ON', 'NOCOUNT OFF'))
+    with pytest.raises(SystemExit) as e:
+        dbss.install_procedure(env)
+    assert e.value.code == 96
+
+
+def test_server_side_create_matches_client_files(env):
+    server = dbss_simulator.server_for(env)
+    for db in env['db_white_list']:
+        database = dbss_simulator.find_database(server, db)
+        if len([f for f in database['files'] if f['type_desc'] != 'LOG']) > 1:
+            break
+    client_files = snapshot_files(env, db)
+    dbss.install_procedure(env)
+    assert dbss.call_procedure('create', [db], env) == {db: 0}
+    assert snapshot_files(env, db) == client_files
+
+
+def test_server_side_environment_runs(env):
+    dbss.install_procedure(env)
+    env['server_side'] = True
+    db = env['db_white_list'][0]
+    dbss_simulator.write_database(env, db)
+    skipped_list, outcomes = dbss.revert_environment(env, 1, False, False)
+    assert outcomes == {db: 0}
+    assert dbss.dirty_databases(env) == []
+    current_list, outcomes = dbss.generate_baseline(env, 1, True)
+    assert outcomes == dict.fromkeys(env['db_white_list'], 0)
+    drop_list, outcomes = dbss.clean_slate(env, 1, False)
+    assert sorted(outcomes) == sorted(drop_list)
+    assert set(outcomes.values()) == set([0])
+    assert dbss.survey_generations(env) == []
+
+
+def test_server_side_failure_per_database(env, capsys):
+    dbss.install_procedure(env)
+    db = env['db_white_list'][0]
+    dbss.drop_snapshot(db, env)
+    outcomes = dbss.call_procedure('restore', env['db_white_list'][:2], env)
+    assert outcomes == {db: 87, env['db_white_list'][1]: 0}
+    assert 'does not exist' in capsys.readouterr().err
+
+
+# daemon
+
+def test_daemon_address_loopback_only():
+    assert dbss.daemon_address('127.0.0.1:7733')[1] == ('127.0.0.1', 7733)
+    assert dbss.daemon_address('[::1]:7733')[1] == ('::1', 7733)
+    for address in ('0.0.0.0:7733', 'db01:7733', '7733'):
+        with pytest.raises(ValueError):
+            dbss.daemon_address(address)
+
+
+def test_serve_refuses_other_hosts(env, capsys):
+    with pytest.raises(SystemExit) as e:
+        dbss.serve('0.0.0.0:7733', env)
+    assert e.value.code == 16
+
+
+def test_daemon_request_runs_command(env):
+    response = dbss.daemon_request(['survey'], env)
+    assert response['status'] == 0
+    assert 'CXSCORE' in response['output']
+
+
+def test_daemon_request_refuses_trace_and_profile(env, tmp_path):
+    trace_file = tmp_path / 'trace.json'
+    for option in ('--trace-file={}'.format(trace_file),
+                   '--trace={}'.format(trace_file), '--profile', '--prof'):
+        response = dbss.daemon_request(['survey', option], env)
+        assert response['status'] == 2
+        assert 'not served' in response['output']
+    assert not trace_file.exists()
+
+
+def test_daemon_request_failure_invalidates_catalog(env, monkeypatch):
+    env['catalog_ttl'] = dbss.DAEMON_CATALOG_TTL
+    dbss.survey_databases(env)
+    assert env['catalog_cache']['survey'] is not None
+
+    def failing_restore(db,env):
+        raise ValueError('simulated failure')
+
+    monkeypatch.setattr(dbss, 'restore_snapshot', failing_restore)
+    response = dbss.daemon_request(['restore', 'CXSCORE'], env)
+    assert response['status'] == 1
+    assert env['catalog_cache']['survey'] is None
+
+
+def start_daemon(env):
+    """Serve env on its default Unix socket (thread), return address."""
+    address = dbss.daemon_socket(env)
+    env['quiet_mode'] = True
+    thread = threading.Thread(target=dbss.serve, args=(None, env))
+    thread.daemon = True
+    thread.start()
+    for i in range(100):
+        if os.path.exists(address):
+            break
+        time.sleep(0.05)
+    return address
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='no Unix sockets')
+def test_daemon_serves_unix_socket(env, capsys):
+    address = start_daemon(env)
+    # owner only
+    assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+    db = env['db_white_list'][0]
+    dbss_simulator.write_database(env, db)
+    response = dbss.call_daemon(address, ['restore', db, '--quiet'])
+    assert response['status'] == 0
+    assert dbss.dirty_databases(env) == []
+    response = dbss.call_daemon(address, ['restore', 'NOPE', '--quiet'])
+    assert response['status'] == 6
+    # thin client relays output and exit status
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['call', 'survey', '--listen=' + address])
+    assert e.value.code == 0
+    assert db in capsys.readouterr().out
+
+
+def test_call_without_daemon(tmp_path, capsys):
+    with pytest.raises(SystemExit) as e:
+        dbss.main(['call', 'survey', '--quiet',
+                   '--listen=' + str(tmp_path / 'none.sock')])
+    assert e.value.code == 9
+    assert 'unavailable' in capsys.readouterr().err
+
+
+# pytest plugin
+
+PLUGIN_TESTS = """
+import pytest
+
+import dbss as dbss_library
+import dbss_simulator
+
+
+def restored(env):
+    db_list = list()
+    for record in env['history']['records']:
+        if record['operation'] == 'restore_snapshot':
+            db_list.append(record['database'])
+    return db_list
+
+
+def test_writes(dbss):
+    dbss_simulator.write_database(dbss.env, 'CXSCORE')
+    assert dbss_library.dirty_databases(dbss.env) == ['CXSCORE']
+
+
+def test_written_restored(dbss):
+    assert dbss_library.dirty_databases(dbss.env) == []
+    assert restored(dbss.env) == ['CXSCORE']
+
+
+@pytest.mark.dbss_dirty('CXSERVER')
+def test_marker(dbss):
+    pass
+
+
+def test_marker_restored(dbss):
+    assert restored(dbss.env) == ['CXSCORE', 'CXSERVER']
+    dbss.mark('IXLOG')
+
+
+def test_mark_restored(dbss):
+    assert restored(dbss.env) == ['CXSCORE', 'CXSERVER', 'IXLOG']
+"""
+
+
+def test_plugin_restores_after_tests(pytester):
+    dbss_simulator.reset_servers()
+    pytester.makepyfile(PLUGIN_TESTS)
+    result = pytester.runpytest('-p', 'pytest_dbss', '--dbss-environment=sim')
+    result.assert_outcomes(passed=5)
+
+
+def test_plugin_skips_without_environment(pytester):
+    pytester.makepyfile(PLUGIN_TESTS)
+    result = pytester.runpytest('-p', 'pytest_dbss')
+    result.assert_outcomes(skipped=5)